@@ -13,31 +13,51 @@ HTTPServer
 
 # Python imports
 import os
+import io
+import time
+import functools
+import queue
 import threading
+import asyncio
 import json
 import zlib
+from itertools import islice
 from collections import OrderedDict
 import configparser
 from urllib.parse import urlparse, parse_qs
 from socketserver import ThreadingMixIn, TCPServer
 from http.server import SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+from http.client import parse_headers
+from http import HTTPStatus
 
 # Third party imports
 from bacpypes.debugging import bacpypes_debugging, ModuleLogger
 from bacpypes.consolelogging import ConfigArgumentParser
 from bacpypes.core import run, deferred, stop
 from bacpypes.iocb import IOCB
+from bacpypes.task import RecurringFunctionTask
 from bacpypes.pdu import Address, GlobalBroadcast
 from bacpypes.apdu import (ReadPropertyRequest, WhoIsRequest,
                            ReadPropertyMultipleRequest, PropertyIdentifier,
                            PropertyReference, ReadAccessSpecification,
-                           ReadPropertyMultipleACK,)
+                           ReadPropertyMultipleACK, SimpleAckPDU,)
 from bacpypes.primitivedata import Unsigned, ObjectIdentifier
 from bacpypes.constructeddata import Array
+from bacpypes.basetypes import ErrorType
 from bacpypes.app import BIPSimpleApplication
 from bacpypes.object import get_object_class, get_datatype
 from bacpypes.local.device import LocalDeviceObject
 
+# Local imports
+from bacnet_utils import (iocb_future, PresentValueCache, SingleFlight,
+                          ReadBatcher, DEFAULT_MAX_APDU,
+                          compile_read_access_specs, compile_read_plan,
+                          split_read_access_specs, request_io_bounded,
+                          decode_property_value, COVValueStore, ChangeFeed)
+from timeseries import TimeSeriesStore
+from metrics import Registry, render_stats, CONTENT_TYPE
+from tracing import tracer, JSONLFile, TRACE_HEADER
+
 
 # Initialization
 # some debugging
@@ -51,14 +71,91 @@ parser = ConfigArgumentParser(description=__doc__)
 parser.add_argument("--host", type=str, help="server host")
 # add an option for the server port
 parser.add_argument("--port", type=int, help="server port")
+# present value cache settings
+parser.add_argument("--cache-ttl", type=float, default=1.0,
+                    help="seconds a read value is served from the cache")
+parser.add_argument("--cache-size", type=int, default=1024,
+                    help="maximum number of cached values")
+# merge single reads to the same device into ReadPropertyMultiple
+parser.add_argument("--batch-window", type=float, default=0,
+                    help="milliseconds to collect reads to the same device "
+                    "into one ReadPropertyMultiple request. 0 disables")
+# large ReadPropertyMultiple requests are split to fit the device
+parser.add_argument("--rpm-concurrency", type=int, default=2,
+                    help="pending requests of one split ReadPropertyMultiple")
+# objects kept up to date by COV notifications instead of reads
+parser.add_argument("--cov", type=str, nargs="*", default=[],
+                    help="subscribe to objects like "
+                    "<address>/<object type>:<object instance number>")
+parser.add_argument("--cov-lifetime", type=int, default=300,
+                    help="seconds before a COV subscription is renewed")
+# values watched by /stream clients are read by one shared poller
+parser.add_argument("--stream-interval", type=float, default=1.0,
+                    help="seconds between reads of values watched by "
+                    "/stream clients")
+# serve HTTP from one asyncio event loop instead of a thread per request
+parser.add_argument("--asyncio", action="store_true",
+                    help="use the asyncio HTTP server")
+# time series store written by main.py, queried at /history
+parser.add_argument("--history", type=str, default=None,
+                    help="directory of the time series store")
+# spans of each request are appended to this JSON lines file
+parser.add_argument("--trace", type=str, default=None,
+                    help="JSON lines file of request traces")
 DEFAULT_CONFIG_PATH = r"./weather_config.ini"
 
 # reference a simple application
 this_application = None
 server = None
 
-# TODO
-# Cache control heder?
+# values recently read from the network, shared by every request
+cache = PresentValueCache()
+# pending requests that identical requests attach to
+inflight = SingleFlight()
+# collects single reads into ReadPropertyMultiple requests (see main)
+batcher = None
+# pending requests of one split ReadPropertyMultiple request
+rpm_concurrency = 2
+# values pushed by COV notifications (see main)
+cov = None
+# changed values sent to /stream clients
+feed = ChangeFeed()
+# devices with a pending read of watched values
+_polling = set()
+# seconds between comments that keep idle /stream connections open
+STREAM_KEEPALIVE = 15
+# seconds between reads of values watched by /stream clients
+stream_interval = 1.0
+# time series store of polled observations (see main)
+history = None
+# most samples, or intervals with step, in one /history response
+HISTORY_MAX_POINTS = 10000
+
+# request counters and latencies served at /metrics
+metrics = Registry()
+http_requests = metrics.counter(
+    'bacnet_http_requests_total', 'HTTP requests by route and status',
+    ('route', 'status'))
+http_latency = metrics.histogram(
+    'bacnet_http_request_duration_seconds', 'HTTP request latency',
+    ('route',))
+http_in_flight = metrics.gauge(
+    'bacnet_http_requests_in_flight', 'HTTP requests being served',
+    ('route',))
+bacnet_latency = metrics.histogram(
+    'bacnet_request_duration_seconds',
+    'Latency of BACnet requests sent on the network', ('service',))
+bacnet_outcomes = metrics.counter(
+    'bacnet_iocb_total', 'Completed BACnet requests by outcome and the '
+    'type of the response or error', ('service', 'outcome', 'type'))
+bacnet_in_flight = metrics.gauge(
+    'bacnet_iocbs_in_flight', 'BACnet requests waiting for a response',
+    ('service',))
+metrics.gauge('bacnet_threads', 'Threads of the server process',
+              function=threading.active_count)
+# route label of each path. Other paths share the label 'other'
+ROUTES = ('read', 'whois', 'cache', 'stream', 'history',
+          'readpropertymultiple', 'favicon.ico', 'metrics')
 
 # favorite icon
 favicon = zlib.decompress(
@@ -66,6 +163,714 @@ favicon = zlib.decompress(
     )
 
 
+#%%
+#
+#   Request building and response decoding
+#   Shared by HTTPRequestHandler and AsyncHTTPServer
+#
+
+
+def _form_read_request(args):
+    """Build a ReadPropertyRequest from the path of a read request
+    inputs
+    -------
+    args : (list) path pieces after 'read' like
+        [<address>, <object type>:<object instance number>, <property>]
+        The property defaults to presentValue
+    outputs
+    -------
+    request : (bacpypes.apdu.ReadPropertyRequest)
+    """
+    addr, obj_id = args[:2]
+    obj_id = ObjectIdentifier(obj_id).value
+
+    # get the object type
+    if not get_object_class(obj_id[0]):
+        raise ValueError("unknown object type")
+
+    # implement a default property, the bain of committee meetings
+    if len(args) == 3:
+        prop_id = args[2]
+    else:
+        prop_id = "presentValue"
+
+    # look for its datatype, an easy way to see if the property is
+    # appropriate for the object
+    datatype = get_datatype(obj_id[0], prop_id)
+    if not datatype:
+        raise ValueError("invalid property for object type")
+
+    # build a request
+    request = ReadPropertyRequest(
+        objectIdentifier=obj_id, propertyIdentifier=prop_id
+    )
+    request.pduDestination = Address(addr)
+
+    # look for an optional array index
+    if len(args) == 5:
+        request.propertyArrayIndex = int(args[4])
+
+    return request
+
+
+def _decode_read_response(apdu):
+    """Convert the property value of a ReadPropertyACK to a python value"""
+
+    value = decode_property_value(
+        apdu.objectIdentifier[0], apdu.propertyIdentifier,
+        apdu.propertyArrayIndex, apdu.propertyValue
+    )
+
+    # convert the value to a dict if possible
+    if hasattr(value, "dict_contents"):
+        value = value.dict_contents(as_class=OrderedDict)
+
+    return value
+
+
+def _form_read_access_spec_list(body_json):
+    """Validate the body of a readpropertymultiple request and build the
+    read access specifications for it. Raises ValueError with a message for
+    the client if the body is not valid
+    inputs
+    -------
+    body_json : (dict) like
+        {'address':'192.168.1.100',
+         'bacnet_objects': [{'object': 'analogValue:1',
+                             'property': 'presentValue'},
+                            {'object': 'analogValue:2',
+                             'property': 'presentValue'}]}
+    outputs
+    -------
+    read_access_spec_list : (list) of
+        bacpypes.apdu.ReadAccessSpecification
+    """
+    # Error check request
+    if not 'bacnet_objects' in body_json.keys():
+        # Improperty structured JSON request
+        msg = ('Bad request format. "bacnet_objects" must be a key '+
+               'in the request body JSON oject. Got {}'.format(str(body_json.keys()))
+               )
+        raise ValueError(msg)
+
+    if body_json['bacnet_objects'].__len__() == 0:
+        # No objects defined in list
+        msg = ('No BACnet object specifiers were passed. '+
+               'Must include specifiers like {"object":"analogValue:1",' +
+               '"property":"presentValue"}'
+               )
+        raise ValueError(msg)
+
+    # The same body is sent every poll, so the validation is cached by its
+    # objects and properties
+    plan = [(bacnet_object['object'], bacnet_object['property'])
+            for bacnet_object in body_json['bacnet_objects']]
+    read_access_spec_list = compile_read_access_specs(plan)
+
+    return read_access_spec_list
+
+
+def _decode_ReadPropertyMultiple_response(apdu):
+    """Convert a ReadPropertyMultipleACK to a dictionary of python values.
+    Raises TypeError if apdu is not an acknowledgement
+    outputs
+    -------
+    results : (dict) Formatted like
+        results = {"('analogValue', 1)" : {'presentValue':'1',
+                                           'objectName':'some_name',
+                                           'arrayResult':[1,2,3]},
+                   "('analogValue', 2)" : {'presentValue':'4'}
+                   }
+    """
+    # Acknowledgement response
+    if not isinstance(apdu, ReadPropertyMultipleACK):
+        msg = ('Received improper read property multiple response. ' +
+               'The expected response type was an acknowledgement, ' +
+               'got {}'.format(str(type(apdu)))
+               )
+        raise TypeError(msg)
+
+    results = {}
+
+    # loop through the results
+    for result in apdu.listOfReadAccessResults:
+        # Object identifiers are top
+        objectIdentifier = result.objectIdentifier
+        results.setdefault(str(objectIdentifier), {})
+
+        for element in result.listOfResults:
+            # Properties and array elements of each object are bottom
+            propertyIdentifier = element.propertyIdentifier
+            propertyArrayIndex = element.propertyArrayIndex
+            readResult = element.readResult
+
+            if readResult.propertyAccessError:
+                results[str(objectIdentifier)][str(propertyIdentifier)] = \
+                    readResult.propertyAccessError
+                continue # Skip this result
+
+            # Form the message response
+            propertyValue = readResult.propertyValue
+            dtype = get_datatype(objectIdentifier[0], propertyIdentifier)
+            if issubclass(dtype, Array) and (propertyArrayIndex is not None):
+                # The property value is an array of values
+                if propertyArrayIndex == 0:
+                    # Result is the first index of array
+                    # See http://kargs.net/BACnet/Foundations2015-Developer-Q-A.pdf
+                    value = propertyValue.cast_out(Unsigned)
+                else:
+                    # Cast BACnet array to python array with elements
+                    # Matching the BACnet array subtype
+                    # [BACint, BACint, BACint] -> [pyint, pyint, pyint]
+                    value = propertyValue.cast_out(dtype.subtype)
+            else:
+                # The value is not an array (single value)
+                value = propertyValue.cast_out(dtype)
+
+            results[str(objectIdentifier)][str(propertyIdentifier)] = value
+
+    return results
+
+
+def _form_stream_keys(query):
+    """Validate the query of a stream request and find the values the
+    client watches
+    inputs
+    -------
+    query : (dict) parsed query of
+        /stream?address=<address>&object=<object type>:<instance>
+        object may be repeated. property defaults to presentValue and is
+        given once for all objects or once for each object
+    outputs
+    -------
+    keys : (list) of (address, objectIdentifier, propertyIdentifier,
+        propertyArrayIndex) like the present value cache key
+    """
+    addresses = query.get('address', [])
+    objects = query.get('object', [])
+    if not addresses or not objects:
+        raise ValueError('Bad request format. "address" and at least one ' +
+                         '"object" are required like ' +
+                         '/stream?address=192.168.1.100&object=analogValue:1')
+
+    properties = query.get('property', ['presentValue'])
+    if len(properties) == 1:
+        properties = properties * len(objects)
+    elif len(properties) != len(objects):
+        raise ValueError('Give one "property" for all objects or one for ' +
+                         'each object. Got {} objects and {} properties'\
+                         .format(len(objects), len(properties)))
+    if 'all' in properties:
+        raise ValueError('Property "all" can not be streamed')
+
+    body_json = {'address': addresses[0],
+                 'bacnet_objects': [{'object': obj_id, 'property': prop_id}
+                                    for obj_id, prop_id in
+                                    zip(objects, properties)]}
+    read_access_spec_list = _form_read_access_spec_list(body_json)
+    address = str(Address(addresses[0]))
+
+    return [(address,
+             tuple(read_access_spec.objectIdentifier),
+             read_access_spec.listOfPropertyReferences[0].propertyIdentifier,
+             None)
+            for read_access_spec in read_access_spec_list]
+
+
+def _form_history_response(args, query):
+    """Answer a query of the time series store
+    inputs
+    -------
+    args : (list) of path pieces after /history,
+        [<object type>:<instance>] or [<object type>:<instance>, <property>]
+    query : (dict) parsed query. station is required when the store has
+        more than one station. from and to are seconds since the epoch.
+        With step the samples are aggregated into intervals of step seconds
+    outputs
+    -------
+    (status, result) : result is a dictionary for status 200 and an error
+        message otherwise
+
+    Example
+    /history/analogInput:1?station=north&from=1607800000&step=3600
+    """
+    if history is None:
+        return (404, 'History is not enabled. Start the server with --history')
+    if not args or not args[0]:
+        return (400, 'Bad request format. Expected ' +
+                '/history/<object type>:<instance>/<property>' +
+                '?station=&from=&to=&step=')
+
+    try:
+        obj_id = ObjectIdentifier(args[0]).value
+        prop_id = args[1] if len(args) > 1 and args[1] else 'presentValue'
+        start = float(query.get('from', [0])[0])
+        end = float(query['to'][0]) if 'to' in query else None
+        step = float(query['step'][0]) if 'step' in query else None
+    except Exception as err:
+        return (400, 'Bad request format. {}'.format(err))
+
+    stations = history.stations()
+    if 'station' in query:
+        station = query['station'][0]
+    elif len(stations) == 1:
+        station = stations[0]
+    else:
+        return (400, 'station is required. Stations are {}'.format(stations))
+    if station not in stations:
+        return (404, 'Unknown station {}'.format(station))
+
+    result = {'station': station,
+              'object': args[0],
+              'property': prop_id,
+              'from': start,
+              'to': end,
+              'step': step}
+    try:
+        if step is None:
+            samples = history.read(station, obj_id, prop_id, start, end)
+            result['columns'] = ['time', 'value']
+        else:
+            # A small step can make an interval of every sample
+            samples = history.downsample(station, obj_id, prop_id, start,
+                                         end, step)
+            result['columns'] = ['time', 'mean', 'min', 'max', 'count']
+        points = list(islice(samples, HISTORY_MAX_POINTS + 1))
+        result['truncated'] = len(points) > HISTORY_MAX_POINTS
+        result['points'] = points[:HISTORY_MAX_POINTS]
+    except ValueError as err:
+        return (400, str(err))
+
+    return (200, result)
+
+
+def _encode_event(values):
+    """Format changed values as a server-sent event. The data is JSON in the
+    same format as a readpropertymultiple response"""
+    results = {}
+    for (_address, obj_id, prop_id, _index), value in values.items():
+        results.setdefault(str(obj_id), {})[str(prop_id)] = value
+    return b'data: ' + _encode_results(results) + b'\n\n'
+
+
+def _encode_results(results):
+    """Serialize a results dictionary to JSON bytes"""
+    try:
+        msg = bytes(json.dumps(results), 'utf-8')
+    except TypeError:
+        # Cannot serialize value of results
+        msg = bytes(json.dumps(results, default=lambda o: str(o)), 'utf-8')
+    return msg
+
+
+#%%
+#
+#   Request submission
+#
+
+
+def _request_key(request):
+    """Requests with equal keys read the same values and can share an IOCB"""
+    if isinstance(request, ReadPropertyRequest):
+        return ('readProperty',) + _read_cache_key(request)
+
+    read_access_specs = tuple(
+        (tuple(read_access_spec.objectIdentifier),
+         tuple((prop_reference.propertyIdentifier,
+                prop_reference.propertyArrayIndex)
+               for prop_reference in read_access_spec.listOfPropertyReferences))
+        for read_access_spec in request.listOfReadAccessSpecs)
+    return ('readPropertyMultiple', str(request.pduDestination),
+            read_access_specs)
+
+
+def _submit_request(request, timeout):
+    """Give a request to the BACnet application and return its IOCB.
+    If an identical request is still pending its IOCB is returned instead
+    and nothing is sent. The timeout of the first request applies to all
+    requests sharing the IOCB"""
+    return _submit_requests([request], timeout)[0]
+
+
+def _submit_requests(requests, timeout):
+    """Give the parts of a split request to the BACnet application, at most
+    rpm_concurrency at a time. The timeout covers all parts.
+    See _submit_request
+    outputs
+    -------
+    iocbs : (list) IOCB of each request"""
+    iocbs = []
+    leaders = []
+
+    for request in requests:
+        def make_iocb(request=request):
+            iocb = IOCB(request)
+            iocb.set_timeout(timeout, err=TimeoutError)
+            return iocb
+
+        iocb, leader = inflight.join(_request_key(request), make_iocb)
+        iocbs.append(iocb)
+        if leader:
+            leaders.append(iocb)
+        elif _debug:
+            _log.debug("    - sharing pending iocb: %r", iocb)
+
+    if batcher is not None:
+        request_io = batcher.request_io
+    else:
+        request_io = this_application.request_io
+
+    for iocb in leaders:
+        _track_iocb(iocb)
+    if len(leaders) == 1:
+        deferred(request_io, leaders[0])
+    elif leaders:
+        deferred(request_io_bounded, request_io, leaders, rpm_concurrency)
+
+    return iocbs
+
+
+def _split_ReadPropertyMultiple_request(request):
+    """Split a ReadPropertyMultipleRequest into requests whose request and
+    response fit the maximum APDU and segmentation of the device
+    outputs
+    -------
+    requests : (list) of ReadPropertyMultipleRequest"""
+    max_apdu, segmentation = _device_info(request.pduDestination)
+    max_segments = this_application.localDevice.maxSegmentsAccepted or 1
+    groups = split_read_access_specs(request.listOfReadAccessSpecs,
+                                     max_apdu, segmentation, max_segments)
+    if len(groups) == 1:
+        return [request]
+
+    requests = []
+    for read_access_spec_list in groups:
+        part = ReadPropertyMultipleRequest(
+            listOfReadAccessSpecs=read_access_spec_list)
+        part.pduDestination = request.pduDestination
+        requests.append(part)
+    if _debug:
+        _log.debug("    - split into %r requests", len(requests))
+
+    return requests
+
+
+def _device_info(address):
+    """The maxApduLengthAccepted and segmentationSupported of a device from
+    its I-Am. Devices that have not sent an I-Am are assumed to accept
+    DEFAULT_MAX_APDU without segmentation"""
+    device_info = this_application.deviceInfoCache.get_device_info(address)
+    if device_info is None:
+        return DEFAULT_MAX_APDU, 'noSegmentation'
+    return (device_info.maxApduLengthAccepted,
+            device_info.segmentationSupported)
+
+
+#%%
+#
+#   Streaming
+#
+
+
+def _poll_watched():
+    """Read every value watched by /stream clients and publish it to the
+    change feed. One ReadPropertyMultiple is sent to each device no matter
+    how many clients watch it. Values kept up to date by COV are not read.
+    Runs every --stream-interval seconds in the BACnet application thread
+    """
+    keys_by_address = {}
+    for key in feed.watched():
+        if cov is not None and cov.get(key)[0]:
+            # Published by COV notifications
+            continue
+        keys_by_address.setdefault(key[0], []).append(key)
+
+    for address, keys in keys_by_address.items():
+        if address in _polling:
+            # The last read has not completed
+            continue
+
+        prop_references = OrderedDict()
+        for _address, obj_id, prop_id, _index in keys:
+            prop_references.setdefault(obj_id, []).append(
+                PropertyReference(propertyIdentifier=prop_id))
+        request = ReadPropertyMultipleRequest(
+            listOfReadAccessSpecs=[
+                ReadAccessSpecification(objectIdentifier=obj_id,
+                                        listOfPropertyReferences=references)
+                for obj_id, references in prop_references.items()])
+        request.pduDestination = Address(address)
+
+        requests = _split_ReadPropertyMultiple_request(request)
+        _polling.add(address)
+        iocbs = _submit_requests(requests, timeout=max(stream_interval, 5))
+        pending = [len(iocbs)]
+        for request, iocb in zip(requests, iocbs):
+            iocb.add_callback(_publish_watched, address, request, pending)
+
+    return
+
+
+def _publish_watched(iocb, address, request, pending):
+    """Publish the values of one read started by _poll_watched"""
+    pending[0] -= 1
+    if pending[0] == 0:
+        _polling.discard(address)
+
+    if not iocb.ioResponse:
+        return
+    try:
+        results = inflight.decode(iocb, _decode_ReadPropertyMultiple_response)
+    except TypeError:
+        return
+    _cache_ReadPropertyMultiple_results(request, results)
+
+    values = {}
+    for read_access_spec in request.listOfReadAccessSpecs:
+        obj_id = tuple(read_access_spec.objectIdentifier)
+        for prop_reference in read_access_spec.listOfPropertyReferences:
+            prop_id = prop_reference.propertyIdentifier
+            value = results.get(str(obj_id), {}).get(str(prop_id))
+            if value is None or isinstance(value, ErrorType):
+                continue
+            values[(address, obj_id, prop_id, None)] = value
+    feed.publish(values)
+
+    return
+
+
+#%%
+#
+#   Present value cache
+#
+
+
+def _max_age(headers):
+    """Read the X-bacnet-max-age request header. This is the oldest cached
+    value in seconds the client accepts. 0 bypasses the cache. Returns None
+    when the header is missing so the cache ttl is used"""
+    max_age = headers.get('X-bacnet-max-age')
+    if max_age is None:
+        return None
+    try:
+        return max(float(max_age), 0)
+    except ValueError:
+        return None
+
+
+def _cached_value(key, max_age=None):
+    """Look up a value pushed by COV notifications, then a value in the
+    cache. A max_age of 0 bypasses both
+    outputs
+    -------
+    (hit, value) : (tuple) see PresentValueCache.get"""
+    if cov is not None and max_age != 0:
+        hit, value = cov.get(key)
+        if hit:
+            return hit, value
+    return cache.get(key, max_age)
+
+
+def _read_cache_key(request):
+    """Cache key of a ReadPropertyRequest"""
+    return (str(request.pduDestination),
+            tuple(request.objectIdentifier),
+            request.propertyIdentifier,
+            request.propertyArrayIndex)
+
+
+def _split_cached_specs(request, max_age=None):
+    """Answer the parts of a ReadPropertyMultipleRequest that are in the
+    cache
+    outputs
+    -------
+    (results, missing) : results has the cached values in the same format as
+        _decode_ReadPropertyMultiple_response. missing is the list of
+        ReadAccessSpecification that must be read from the device
+    """
+    address = str(request.pduDestination)
+    results = {}
+    missing = []
+
+    for read_access_spec in request.listOfReadAccessSpecs:
+        obj_id = tuple(read_access_spec.objectIdentifier)
+        prop_reference_list = []
+
+        for prop_reference in read_access_spec.listOfPropertyReferences:
+            prop_id = prop_reference.propertyIdentifier
+            if prop_id == 'all':
+                # The set of properties is only known by the device
+                prop_reference_list.append(prop_reference)
+                continue
+
+            key = (address, obj_id, prop_id, prop_reference.propertyArrayIndex)
+            hit, value = _cached_value(key, max_age)
+            if hit:
+                results.setdefault(str(obj_id), {})[str(prop_id)] = value
+            else:
+                prop_reference_list.append(prop_reference)
+
+        if prop_reference_list:
+            missing.append(ReadAccessSpecification(
+                objectIdentifier=obj_id,
+                listOfPropertyReferences=prop_reference_list
+                ))
+
+    return results, missing
+
+
+def _cache_ReadPropertyMultiple_results(request, results):
+    """Store every value read by a ReadPropertyMultipleRequest. Property
+    access errors are not cached"""
+    address = str(request.pduDestination)
+
+    for read_access_spec in request.listOfReadAccessSpecs:
+        obj_id = tuple(read_access_spec.objectIdentifier)
+        for prop_id, value in results.get(str(obj_id), {}).items():
+            if isinstance(value, ErrorType):
+                continue
+            cache.put((address, obj_id, prop_id, None), value)
+
+    return
+
+
+def _cache_stats():
+    """Requests answered without a new network request"""
+    stats = cache.stats()
+    stats['shared'] = inflight.stats()['shared']
+    if batcher is not None:
+        stats.update(batcher.stats())
+    if cov is not None:
+        stats['cov'] = cov.stats()
+    stats['stream'] = feed.stats()
+    return stats
+
+
+def _route(path):
+    """Metrics label of a request path"""
+    args = urlparse(path).path.split("/")
+    if len(args) > 1 and args[1] in ROUTES:
+        return args[1]
+    return 'other'
+
+
+def _track_iocb(iocb):
+    """Count and time an IOCB until it completes. Call before the IOCB is
+    given to the application"""
+    service = type(iocb.args[0]).__name__
+    bacnet_in_flight.inc(service)
+    iocb.add_callback(_iocb_complete, service, time.perf_counter())
+    return
+
+
+def _iocb_complete(iocb, service, start):
+    bacnet_in_flight.dec(service)
+    bacnet_latency.observe(time.perf_counter() - start, service)
+
+    error = iocb.ioError
+    if error is TimeoutError or isinstance(error, TimeoutError):
+        outcome, kind = 'timeout', 'TimeoutError'
+    elif error:
+        outcome = 'ioError'
+        kind = error.__name__ if isinstance(error, type) \
+            else type(error).__name__
+    else:
+        outcome, kind = 'ack', type(iocb.ioResponse).__name__
+    bacnet_outcomes.inc(service, outcome, kind)
+
+    return
+
+
+def _metrics_payload():
+    """/metrics response. Cache statistics are added as gauges"""
+    lines = render_stats('bacnet_cache', _cache_stats(),
+                         'Present value cache statistic')
+    lines.extend(render_stats(
+        'bacnet_rpm_plan_cache',
+        compile_read_plan.cache_info()._asdict(),
+        'Compiled readpropertymultiple request cache statistic'))
+    return (metrics.render() + '\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _instrumented(method):
+    """Count and time the requests served by a method of
+    HTTPRequestHandler"""
+    @functools.wraps(method)
+    def wrapper(self):
+        route = _route(self.path)
+        self._status = None
+        start = time.perf_counter()
+        try:
+            # Continue the trace of the client
+            with http_in_flight.track(route), \
+                    tracer.span('http.' + self.command, route=route,
+                                parent=self.headers.get(TRACE_HEADER)):
+                return method(self)
+        finally:
+            http_latency.observe(time.perf_counter() - start, route)
+            http_requests.inc(route, str(self._status))
+    return wrapper
+
+
+def _merge_results(results, other):
+    """Merge the object results of other into results"""
+    for obj_id, properties in other.items():
+        results.setdefault(obj_id, {}).update(properties)
+    return results
+
+
+#%%
+#
+#   COVApplication
+#
+
+
+@bacpypes_debugging
+class COVApplication(BIPSimpleApplication):
+    """BIPSimpleApplication that gives COV notifications to the value store"""
+
+    def confirmation(self, apdu):
+        """Drop a response to an earlier request. Requests to a device are
+        sent one at a time, and the response is given to the active request.
+        When a request times out before the device answers a retry of it,
+        the late answer would otherwise complete the next request"""
+        sieve = self.queue_by_address.get(apdu.pduSource)
+        if sieve is None or sieve.active_iocb is None:
+            # No request is waiting for a response from this address
+            if _debug:
+                COVApplication._debug("    - unexpected response %r", apdu)
+            return
+
+        invoke_id = sieve.active_iocb.args[0].apduInvokeID
+        if invoke_id is not None and apdu.apduInvokeID != invoke_id:
+            if _debug:
+                COVApplication._debug("    - late response %r", apdu)
+            return
+
+        super().confirmation(apdu)
+        return
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        if _debug:
+            COVApplication._debug("do_UnconfirmedCOVNotificationRequest %r",
+                                  apdu)
+        if cov is not None:
+            cov.notification(apdu)
+        return
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        if _debug:
+            COVApplication._debug("do_ConfirmedCOVNotificationRequest %r",
+                                  apdu)
+        if cov is not None:
+            cov.notification(apdu)
+
+        # success
+        response = SimpleAckPDU(context=apdu)
+        self.response(response)
+        return
+
+
 #%%
 #
 #   HTTPRequestHandler
@@ -75,12 +880,26 @@ favicon = zlib.decompress(
 @bacpypes_debugging
 class HTTPRequestHandler(BaseHTTPRequestHandler):
 
+    # Keep connections open between requests. Every response must have a
+    # Content-Length
+    protocol_version = "HTTP/1.1"
+    # Seconds an idle connection holds its thread
+    timeout = 60
+
     def do_HEAD(self):
         self.send_response(200)
-        self.send_header(b"Content-Type", "text/html")
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", 0)
         self.end_headers()
         return None
 
+    def send_response(self, code, message=None):
+        # Kept for the request metrics
+        self._status = code
+        super().send_response(code, message)
+        return
+
+    @_instrumented
     def do_GET(self):
         """
         Example
@@ -89,7 +908,9 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         http://localhost/whois/<address>/<object type>:<object instance number>
         http://localhost/read/<address>/<object type>:<object instance number>/<property>
         Example
-        http://localhost:8081/read/192.168.1.100/analogValue:0/presentValue"""
+        http://localhost:8081/read/192.168.1.100/analogValue:0/presentValue
+        http://localhost/history/<object type>:<instance>/<property>?station=<name>&from=<seconds>&to=<seconds>&step=<seconds>
+        http://localhost/metrics"""
         if _debug:
             HTTPRequestHandler._debug("do_GET")
 
@@ -117,34 +938,44 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         elif args[1] == "whois":
             self.send_response(202)
             self.do_whois(args[2:])
+        elif args[1] == "cache":
+            self.send_response(200)
+            self._write_json(_cache_stats())
+        elif args[1] == "metrics":
+            self.send_response(200)
+            self._write(CONTENT_TYPE, _metrics_payload())
+        elif args[1] == "stream":
+            self.do_stream(parsed_query)
+        elif args[1] == "history":
+            status, result = _form_history_response(args[2:], parsed_query)
+            self.send_response(status)
+            if status == 200:
+                self._write_json(result)
+            else:
+                self._write("text/plain", bytes(result, 'utf-8'))
         elif args[1] == "readpropertymultiple":
             self.send_response(404)
-            self.send_header(b"Content-Type", "text/plain")
-            self.end_headers()
             msg = ("'readpropertymultiple' API request must be POST request")
-            self.wfile.write(bytes(msg, 'utf-8'))
+            self._write("text/plain", bytes(msg, 'utf-8'))
         elif args[1] == "favicon.ico":
             self.send_response(200)
-            self.send_header("Content-Type", "image/x-icon")
-            self.send_header("Content-Length", len(favicon))
-            self.end_headers()
-            self.wfile.write(favicon)
+            self._write("image/x-icon", favicon)
         else:
             self.send_response(400)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"'read' or 'whois' expected")
+            self._write("text/plain", b"'read' or 'whois' expected")
 
         return
 
 
+    @_instrumented
     def do_POST(self):
         """
         Example
         """
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length)
-        body_json = json.loads(body.decode('utf-8'))
+        with tracer.span('parse'):
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(content_length)
+            body_json = json.loads(body.decode('utf-8'))
 
         # Print current thread for help
         cur_thread = threading.current_thread()
@@ -169,9 +1000,8 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
         else:
             self.send_response(400)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"'readpropertymultiple' expected from POST request")
+            self._write("text/plain",
+                        b"'readpropertymultiple' expected from POST request")
 
         return
 
@@ -182,49 +1012,31 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             HTTPRequestHandler._debug("do_read %r", args)
 
         try:
-            addr, obj_id = args[:2]
-            obj_id = ObjectIdentifier(obj_id).value
-
-            # get the object type
-            if not get_object_class(obj_id[0]):
-                raise ValueError("unknown object type")
-
-            # implement a default property, the bain of committee meetings
-            if len(args) == 3:
-                prop_id = args[2]
-            else:
-                prop_id = "presentValue"
-
-            # look for its datatype, an easy way to see if the property is
-            # appropriate for the object
-            datatype = get_datatype(obj_id[0], prop_id)
-            if not datatype:
-                raise ValueError("invalid property for object type")
-
             # build a request
-            request = ReadPropertyRequest(
-                objectIdentifier=obj_id, propertyIdentifier=prop_id
-            )
-            request.pduDestination = Address(addr)
-
-            # look for an optional array index
-            if len(args) == 5:
-                request.propertyArrayIndex = int(args[4])
+            with tracer.span('build_request'):
+                request = _form_read_request(args)
             if _debug:
                 HTTPRequestHandler._debug("    - request: %r", request)
 
-            # make an IOCB
-            iocb = IOCB(request)
-            timeout = int(self.headers.get('X-bacnet-timeout', 5))
-            iocb.set_timeout(timeout, err=TimeoutError)
-            if _debug:
-                HTTPRequestHandler._debug("    - iocb: %r", iocb)
+            # answer from the cache if the value was read recently
+            cache_key = _read_cache_key(request)
+            hit, value = _cached_value(cache_key, _max_age(self.headers))
+            if hit:
+                if _debug:
+                    HTTPRequestHandler._debug("    - cached: %r", value)
+                self._write_json({"value": value})
+                return
 
-            # give it to the application
-            deferred(this_application.request_io, iocb)
+            # give it to the application, or share an identical request
+            # that is already pending
+            timeout = int(self.headers.get('X-bacnet-timeout', 5))
+            with tracer.span('iocb_wait'):
+                iocb = _submit_request(request, timeout)
+                if _debug:
+                    HTTPRequestHandler._debug("    - iocb: %r", iocb)
 
-            # Wait for it to complete
-            iocb.wait()
+                # Wait for it to complete
+                iocb.wait()
 
             # filter out errors and aborts
             if iocb.ioError:
@@ -236,36 +1048,11 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     HTTPRequestHandler._debug(
                         "    - response: %r", iocb.ioResponse
                     )
-                apdu = iocb.ioResponse
-
-                # find the datatype
-                datatype = get_datatype(
-                    apdu.objectIdentifier[0], apdu.propertyIdentifier
-                )
-                if _debug:
-                    HTTPRequestHandler._debug("    - datatype: %r", datatype)
-                if not datatype:
-                    raise TypeError("unknown datatype")
-
-                # special case for array parts, others are managed by cast_out
-                if issubclass(datatype, Array) and (
-                    apdu.propertyArrayIndex is not None
-                ):
-                    if apdu.propertyArrayIndex == 0:
-                        datatype = Unsigned
-                    else:
-                        datatype = datatype.subtype
-                    if _debug:
-                        HTTPRequestHandler._debug(
-                            "    - datatype: %r", datatype
-                        )
-
-                # convert the value to a dict if possible
-                value = apdu.propertyValue.cast_out(datatype)
-                if hasattr(value, "dict_contents"):
-                    value = value.dict_contents(as_class=OrderedDict)
+                with tracer.span('cast_out'):
+                    value = inflight.decode(iocb, _decode_read_response)
                 if _debug:
                     HTTPRequestHandler._debug("    - value: %r", value)
+                cache.put(cache_key, value)
 
                 result = {"value": value}
 
@@ -273,22 +1060,76 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             HTTPRequestHandler._exception("exception: %r", err)
             result = {"exception": str(err)}
 
+        self._write_json(result)
+
+    def _write_json(self, result):
         # encode the results as JSON, convert to bytes
-        result_bytes = json.dumps(result).encode("utf-8")
+        with tracer.span('json_encode'):
+            result_bytes = json.dumps(result).encode("utf-8")
 
         # write the result
-        self.send_header('Content-Type', 'Application/json')
+        self._write("application/json", result_bytes)
+
+    def _write(self, content_type, payload):
+        # Content-Length marks the end of the response on a kept open
+        # connection
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", len(payload))
         self.end_headers()
-        self.wfile.write(result_bytes)
+        self.wfile.write(payload)
+
 
+    def do_stream(self, query):
+        """Send server-sent events with the values that changed until the
+        client disconnects
+        Example
+        http://localhost:8081/stream?address=192.168.1.100&object=analogValue:1&object=analogValue:2
+        data: {"('analogValue', 1)": {"presentValue": 72.5}}
+        """
+        if _debug:
+            HTTPRequestHandler._debug("do_stream %r", query)
+
+        try:
+            keys = _form_stream_keys(query)
+        except ValueError as e:
+            self.send_response(400)
+            self._write("text/plain", bytes(str(e), 'utf-8'))
+            return
+
+        events = queue.Queue()
+        token = feed.subscribe(keys, events.put)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # The response ends when the connection closes
+        self.send_header("Connection", "close")
+        self.close_connection = True
+        self.end_headers()
+
+        try:
+            while True:
+                try:
+                    payload = _encode_event(
+                        events.get(timeout=STREAM_KEEPALIVE))
+                except queue.Empty:
+                    # A comment, so closed connections are noticed
+                    payload = b': keep-alive\n\n'
+                self.wfile.write(payload)
+                self.wfile.flush()
+        except (ConnectionError, OSError):
+            # The client disconnected
+            pass
+        finally:
+            feed.unsubscribe(token)
+
+        return
 
     def do_whois(self, args):
 
         NOT_IMPLEMENTED = True
         if NOT_IMPLEMENTED:
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(NotImplementedError('WhoIs not implemented'))
+            self._write("text/plain", b"WhoIs not implemented")
             return
 
         if _debug:
@@ -317,6 +1158,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                 HTTPRequestHandler._debug("    - iocb: %r", iocb)
 
             # Give it to the application
+            _track_iocb(iocb)
             deferred(this_application.request_io, iocb)
             iocb.wait()
 
@@ -366,19 +1208,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         except Exception as err:
             HTTPRequestHandler._exception("exception: %r", err)
             result = {"exception": str(err)}
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
             result_bytes = json.dumps(result).encode("utf-8")
-            self.wfile.write(result_bytes)
+            self._write("application/json", result_bytes)
             return
 
         # encode the results as JSON, convert to bytes
         result_bytes = json.dumps(result).encode("utf-8")
 
         # write the result
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(result_bytes)
+        self._write("application/json", result_bytes)
         return
 
     def _form_ReadPropertyMultiple_request(self, args, body_json):
@@ -403,113 +1241,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                                    {'object': 'analogValue:3',
                                     'property': 'presentValue'}]}
         """
-        # Error check request
-        if body_json['bacnet_objects'].__len__() == 0:
-            # No objects defined in list
-            msg = ('No BACnet object specifiers were passed. '+
-                   'Must include specifiers like {"object":"analogValue:1",' +
-                   '"property":"presentValue"}'
-                   )
-            if _debug:
-                HTTPRequestHandler._debug("    - body_json: %r", msg)
-            self.send_header('Content-Type','text/plain')
-            self.end_headers()
-            self.wfile.write(bytes(msg, 'utf-8'))
-            raise ValueError(msg)
-
-        if not 'bacnet_objects' in body_json.keys():
-            # Improperty structured JSON request
-            msg = ('Bad request format. "bacnet_objects" must be a key '+
-                   'in the request body JSON oject. Got {}'.format(str(body_json.keys()))
-                   )
+        try:
+            read_access_spec_list = _form_read_access_spec_list(body_json)
+        except ValueError as e:
+            # Report the bad request to the client
+            msg = str(e)
             if _debug:
                 HTTPRequestHandler._debug("    - body_json: %r", msg)
-            self.send_header('Content-Type','text/plain')
-            self.end_headers()
-            self.wfile.write(bytes(msg, 'utf-8'))
-            raise ValueError(msg)
-
-        # Build Read Access Spec List
-        read_access_spec_list = []
-        """Formatted like
-        results = {'analogValue:1' : {'presentValue':'1',
-                                      'objectName':'some_name',
-                                      'arrayResult':[1,2,3]},
-                   'analogValue:2' : {'presentValue':'4'}
-                   }"""
-
-        for bacnet_object in body_json['bacnet_objects']:
-
-            # Property reference list (for EACH object being requested)
-            prop_reference_list = []
-            try:
-                # What is the object identifier?
-                obj_id = ObjectIdentifier(bacnet_object['object']).value
-                # Get the object type
-                if not get_object_class(obj_id[0]):
-                    # The passed value is not a valid BACnet object type
-                    msg = ('The requested Object Identifier is not a valid BACnet '+
-                           'object type. Got {}'.format(str(obj_id))
-                           )
-                    if _debug:
-                        HTTPRequestHandler._debug("    - obj_id: %r", msg)
-                    self.send_header('Content-Type','text/plain')
-                    self.end_headers()
-                    self.wfile.write(bytes(msg, 'utf-8'))
-                    raise ValueError(msg)
-            except ValueError:
-                # The passed value is not a valid BACnet object type
-                msg = ('The requested Object Identifier is not a valid BACnet '+
-                       'object type. Got {}'.format(str(obj_id))
-                       )
-                if _debug:
-                    HTTPRequestHandler._debug("    - objectID: %r", msg)
-                self.send_header('Content-Type','text/plain')
-                self.end_headers()
-                self.wfile.write(bytes(msg, 'utf-8'))
-                raise ValueError(msg)
-
-            # Property ID
-            prop_id = bacnet_object['property']
-            if prop_id not in PropertyIdentifier.enumerations:
-                # Invalid property identifier - usually 'presentValue' or 'all'
-                msg = ('Invalid BACnet property. Valid propery must be one of '+
-                       '{}'.format(str(PropertyIdentifier.enumerations.keys()))
-                       )
-                if _debug:
-                    HTTPRequestHandler._debug("    - bac property: %r", msg)
-                self.send_header('Content-Type','text/plain')
-                self.end_headers()
-                self.wfile.write(bytes(msg, 'utf-8'))
-                raise ValueError(msg)
-
-            # Object datatype
-            datatype = get_datatype(obj_id[0], prop_id)
-            if (datatype is None) and (prop_id != 'all'):
-                # For converting between BACnet data types and pyton types
-                msg = ('Invalid combination of BACnet object type and property ID '+
-                       'Got {}, {}'.format(str(obj_id), str(prop_id))
-                       )
-                if _debug:
-                    HTTPRequestHandler._debug("    - datatype: %r", msg)
-                self.send_header('Content-Type','text/plain')
-                self.end_headers()
-                self.wfile.write(bytes(msg, 'utf-8'))
-                raise ValueError(msg)
-
-            # Build property reference
-            # Not sure what this is - check ASHRAE standard lol
-            prop_reference = PropertyReference(propertyIdentifier=prop_id)
-            # Array index for BACnet objects with multiple values
-            # Array index not supported for this API - just get the whole array
-            prop_reference_list.append(prop_reference)
-
-            # Build read access specification
-            read_access_spec = ReadAccessSpecification(
-                objectIdentifier=obj_id,
-                listOfPropertyReferences=prop_reference_list
-                )
-            read_access_spec_list.append(read_access_spec)
+            self._write("text/plain", bytes(msg, 'utf-8'))
+            raise
 
         # Build request
         request = ReadPropertyMultipleRequest(
@@ -543,121 +1283,77 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                             data=json.dumps(body),
                             timeout=2)
         """
-        # Init results JSON
-        results = {}
         try:
-            request = self._form_ReadPropertyMultiple_request(args, body_json)
+            with tracer.span('build_request'):
+                request = self._form_ReadPropertyMultiple_request(args,
+                                                                  body_json)
         except ValueError as e:
-            # Headers were already written
+            # Headers and the error message were already written
             if _debug:
                 HTTPRequestHandler._debug("    - request: %r", str(e))
-            self.send_header('Content-Type','text/plain')
-            self.end_headers()
-            self.wfile.write(str(e))
-            self.wfile.write(b'End of response')
             return
 
-        # Make IOControlBlock
-        iocb = IOCB(request)
-        timeout = int(self.headers.get('X-bacnet-timeout', 4))
-        iocb.set_timeout(timeout, err=TimeoutError)
-        # Give iocb to app
-        deferred(this_application.request_io, iocb)
-        # Wait for completion
-        iocb.wait()
-
-        """Format of the response
-        ObjectIdentifier
-            PropertyIdentifier : PropertyValue
-        """
-
-        # Success
-        if iocb.ioResponse:
-            apdu = iocb.ioResponse
-
-            # Acknowledgement response
-            if not isinstance(apdu, ReadPropertyMultipleACK):
-                msg = ('Received improper read property multiple response. ' +
-                       'The expected response type was an acknowledgement, ' +
-                       'got {}'.format(str(type(apdu)))
-                       )
-                self.send_header("Content-Type", "text/plain")
-                self.end_headers()
-                self.wfile.write(bytes(msg, 'utf-8'))
+        # Values read within the cache lifetime are not read again
+        results, missing = _split_cached_specs(request, _max_age(self.headers))
+        if _debug:
+            HTTPRequestHandler._debug("    - cached: %r", results)
+
+        if missing:
+            request.listOfReadAccessSpecs = missing
+            # Large requests are split to fit the device
+            requests = _split_ReadPropertyMultiple_request(request)
+
+            # Give the requests to the app, or share identical requests
+            # that are already pending
+            timeout = int(self.headers.get('X-bacnet-timeout', 4))
+            with tracer.span('iocb_wait', requests=len(requests)):
+                iocbs = _submit_requests(requests, timeout)
+                # Wait for completion
+                for iocb in iocbs:
+                    iocb.wait()
+
+            """Format of the response
+            ObjectIdentifier
+                PropertyIdentifier : PropertyValue
+            """
+
+            failed = [iocb for iocb in iocbs if not iocb.ioResponse]
+            if failed:
+                # Error
+                iocb = failed[0]
+                msg = ('Received improper BACnet response \n' +
+                       'args : {}\n' +
+                       'kwargs : {}\n' +
+                       'ioState : {}\n' +
+                       'ioComplete : {}\n' +
+                       'ioCallback : {}\n' +
+                       'ioResponse : {}')
+                msg = msg.format(iocb.args, iocb.kwargs,
+                                 iocb.ioState, iocb.ioComplete,
+                                 iocb.ioCallback, iocb.ioResponse)
+                self._write("text/plain", bytes(msg, 'utf-8'))
                 return
 
-            # loop through the results
-            for result in apdu.listOfReadAccessResults:
-                # Object identifiers are top
-                objectIdentifier = result.objectIdentifier
-                results[str(objectIdentifier)] = {}
-
-                for element in result.listOfResults:
-                    # Properties and array elements of each object are bottom
-                    propertyIdentifier = element.propertyIdentifier
-                    propertyArrayIndex = element.propertyArrayIndex
-                    readResult = element.readResult
-
-                    if readResult.propertyAccessError:
-                        results[str(objectIdentifier)][str(propertyIdentifier)] = \
-                            readResult.propertyAccessError
-                        continue # Skip this result
-
-                    # Form the message response
-                    propertyValue = readResult.propertyValue
-                    dtype = get_datatype(objectIdentifier[0], propertyIdentifier)
-                    if issubclass(dtype, Array) and (propertyArrayIndex is not None):
-                        # The property value is an array of values
-                        if propertyArrayIndex == 0:
-                            # Result is the first index of array
-                            # See http://kargs.net/BACnet/Foundations2015-Developer-Q-A.pdf
-                            value = propertyValue.cast_out(Unsigned)
-                        else:
-                            # Cast BACnet array to python array with elements
-                            # Matching the BACnet array subtype
-                            # [BACint, BACint, BACint] -> [pyint, pyint, pyint]
-                            value = propertyValue.cast_out(dtype.subtype)
-                    else:
-                        # The value is not an array (single value)
-                        value = propertyValue.cast_out(dtype)
-
-                    # Form response JSON object
-                    """results = {'analogValue:1' : {'presentValue':'1',
-                                                     'objectName':'some_name',
-                                                     'arrayResult':[1,2,3]},
-                                  'analogValue:2' : {'presentValue':'4'}
-                                  }
-                    """
-                    results[str(objectIdentifier)][str(propertyIdentifier)] = value
-        else:
-            # Error
-            msg = ('Received improper BACnet response \n' +
-                   'args : {}\n' +
-                   'kwargs : {}\n' +
-                   'ioState : {}\n' +
-                   'ioComplete : {}\n' +
-                   'ioCallback : {}\n' +
-                   'ioResponse : {}')
-            msg = msg.format(iocb.args, iocb.kwargs,
-                             iocb.ioState, iocb.ioComplete,
-                             iocb.ioCallback, iocb.ioResponse)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(bytes(msg, 'utf-8'))
-            return
+            for request, iocb in zip(requests, iocbs):
+                # Success
+                try:
+                    with tracer.span('cast_out'):
+                        fetched = inflight.decode(
+                            iocb, _decode_ReadPropertyMultiple_response)
+                except TypeError as e:
+                    # Not a ReadPropertyMultipleACK
+                    self._write("text/plain", bytes(str(e), 'utf-8'))
+                    return
+                _cache_ReadPropertyMultiple_results(request, fetched)
+                _merge_results(results, fetched)
 
         # Write the response
-        try:
-            msg = bytes(json.dumps(results), 'utf-8')
-        except TypeError:
-            # Cannot serialize value of results
-            msg = bytes(json.dumps(results, default=lambda o: str(o)), 'utf-8')
+        with tracer.span('json_encode'):
+            msg = _encode_results(results)
 
         if _debug:
             HTTPRequestHandler._debug("    - response: %r", str(msg))
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(msg)
+        self._write("application/json", msg)
 
         return
 
@@ -665,7 +1361,431 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
 
 class ThreadedTCPServer(ThreadingMixIn, TCPServer):
-    pass
+    # Idle keep-alive connections must not keep the process open
+    daemon_threads = True
+
+
+#%%
+#
+#   AsyncHTTPServer
+#
+
+
+@bacpypes_debugging
+class AsyncHTTPServer:
+    """HTTP front-end served from one asyncio event loop instead of one
+    thread per request. Each connection is a task and each BACnet request is
+    awaited as a future (see bacnet_utils.iocb_future), so a pending IOCB does
+    not hold a thread. Serves the same routes as HTTPRequestHandler
+
+    The event loop runs in the thread that calls serve_forever(). The BACnet
+    application runs in its own thread through bacpypes.core.run
+
+    Example
+    -------
+    server = AsyncHTTPServer((host, port))
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    ...
+    server.shutdown()
+    """
+
+    # Limits on the request head and body
+    max_header_lines = 100
+    max_body_size = 1 << 20
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._closed = None
+        self._shutdown_request = False
+        self._connections = {}
+
+        return
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called"""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+        return
+
+    async def _serve(self):
+        self._closed = self.loop.create_future()
+        if self._shutdown_request:
+            self._closed.set_result(None)
+
+        host, port = self.server_address
+        self._server = await asyncio.start_server(
+            self.handle_connection, host, port)
+        if _debug:
+            AsyncHTTPServer._debug("serving on %r", self.server_address)
+
+        try:
+            await self._closed
+        finally:
+            self._server.close()
+            # Drop idle keep-alive connections
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+        return
+
+    def shutdown(self):
+        """Stop serving. Safe to call from any thread"""
+        self._shutdown_request = True
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._close)
+        return
+
+    def _close(self):
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+        return
+
+    def server_close(self):
+        return
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests on one connection. Connections are kept open
+        between requests unless the client asks to close them"""
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, path, version = \
+                        request_line.decode('iso-8859-1').split()
+                    if not version.startswith('HTTP/'):
+                        raise ValueError(version)
+                except ValueError:
+                    await self._send_response(writer, 400, "text/plain",
+                                              b"Bad request line", False)
+                    break
+
+                # Read the request headers
+                header_lines = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    header_lines.append(line)
+                    if len(header_lines) > self.max_header_lines:
+                        break
+                if len(header_lines) > self.max_header_lines:
+                    await self._send_response(writer, 431, "text/plain",
+                                              b"Too many headers", False)
+                    break
+                headers = parse_headers(
+                    io.BytesIO(b''.join(header_lines) + b'\r\n'))
+
+                connection = headers.get('Connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+
+                content_length, error = self._content_length(method, headers)
+                if error is not None:
+                    # The rest of the connection can't be read as requests
+                    status, content_type, payload = error
+                    await self._send_response(writer, status, content_type,
+                                              payload, False)
+                    break
+                body = await reader.readexactly(content_length)
+
+                if _debug:
+                    AsyncHTTPServer._debug("    - request: %r %r", method, path)
+
+                route = _route(path)
+                if method == 'GET' and route == "stream":
+                    # The response lasts until the connection closes
+                    with http_in_flight.track(route):
+                        status = await self.do_stream(path, writer)
+                    http_requests.inc(route, str(status))
+                    break
+                elif method == 'HEAD':
+                    response = (200, "text/html", b"")
+                else:
+                    start = time.perf_counter()
+                    with http_in_flight.track(route), \
+                            tracer.span('http.' + method, route=route,
+                                        parent=headers.get(TRACE_HEADER)):
+                        response = await self.do_method(method, path,
+                                                        headers, body)
+                    http_latency.observe(time.perf_counter() - start, route)
+                    http_requests.inc(route, str(response[0]))
+
+                status, content_type, payload = response
+                await self._send_response(writer, status, content_type,
+                                          payload, keep_alive)
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            pass
+
+        except Exception as err:
+            AsyncHTTPServer._exception("exception: %r", err)
+
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+        return
+
+    def _content_length(self, method, headers):
+        """The length of the request body. Chunked bodies are not supported
+        outputs
+        -------
+        (content_length, error) error is the (status, content_type, payload)
+        response to a body that can't be read, or None"""
+        if 'Transfer-Encoding' in headers:
+            return 0, (501, "text/plain",
+                       b"Transfer-Encoding is not supported")
+
+        values = headers.get_all('Content-Length', [])
+        if not values:
+            if method == 'POST':
+                return 0, (411, "text/plain", b"Content-Length required")
+            return 0, None
+        if len(values) > 1 or not values[0].strip().isdecimal():
+            return 0, (400, "text/plain", b"Bad Content-Length")
+
+        content_length = int(values[0])
+        if content_length > self.max_body_size:
+            return 0, (413, "text/plain", b"Request body too large")
+        return content_length, None
+
+    async def _send_response(self, writer, status, content_type, payload,
+                             keep_alive):
+        head = ["{} {} {}".format(self.protocol_version, status,
+                                  HTTPStatus(status).phrase),
+                "Content-Type: {}".format(content_type),
+                "Content-Length: {}".format(len(payload)),
+                "Connection: {}".format("keep-alive" if keep_alive else "close"),
+                "", ""]
+        writer.write(bytes("\r\n".join(head), 'iso-8859-1') + payload)
+        await writer.drain()
+        return
+
+    async def do_method(self, method, path, headers, body):
+        """The response to a GET or POST request
+        outputs
+        -------
+        (status, content_type, payload)"""
+        if method == 'GET':
+            return await self.do_GET(path, headers)
+        elif method == 'POST':
+            return await self.do_POST(path, headers, body)
+        return (501, "text/plain",
+                bytes("Unsupported method {}".format(method), 'utf-8'))
+
+    async def do_GET(self, path, headers):
+        """Same routes as HTTPRequestHandler.do_GET
+        outputs
+        -------
+        (status, content_type, payload)"""
+
+        # find the pieces
+        args = urlparse(path).path.split("/")
+
+        if args[1] == "read":
+            return await self.do_read(args[2:], headers)
+        elif args[1] == "whois":
+            return (202, "text/plain", b"WhoIs not implemented")
+        elif args[1] == "cache":
+            return (200, "application/json",
+                    json.dumps(_cache_stats()).encode("utf-8"))
+        elif args[1] == "metrics":
+            return (200, CONTENT_TYPE, _metrics_payload())
+        elif args[1] == "history":
+            status, result = _form_history_response(
+                args[2:], parse_qs(urlparse(path).query))
+            if status == 200:
+                return (status, "application/json",
+                        json.dumps(result).encode("utf-8"))
+            return (status, "text/plain", bytes(result, 'utf-8'))
+        elif args[1] == "readpropertymultiple":
+            msg = ("'readpropertymultiple' API request must be POST request")
+            return (404, "text/plain", bytes(msg, 'utf-8'))
+        elif args[1] == "favicon.ico":
+            return (200, "image/x-icon", favicon)
+        else:
+            return (400, "text/plain", b"'read' or 'whois' expected")
+
+    async def do_stream(self, path, writer):
+        """Same as HTTPRequestHandler.do_stream. Writes to the connection
+        until the client disconnects or the server shuts down
+        outputs
+        -------
+        status : (int) of the response"""
+        try:
+            keys = _form_stream_keys(parse_qs(urlparse(path).query))
+        except ValueError as e:
+            await self._send_response(writer, 400, "text/plain",
+                                      bytes(str(e), 'utf-8'), False)
+            return 400
+
+        events = asyncio.Queue()
+
+        def _callback(values):
+            # Called from the BACnet thread
+            if not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(events.put_nowait, values)
+            return
+
+        token = feed.subscribe(keys, _callback)
+        head = ["{} 200 OK".format(self.protocol_version),
+                "Content-Type: text/event-stream",
+                "Cache-Control: no-cache",
+                "Connection: close",
+                "", ""]
+
+        try:
+            writer.write(bytes("\r\n".join(head), 'iso-8859-1'))
+            await writer.drain()
+            while not self._closed.done():
+                get = asyncio.ensure_future(events.get())
+                await asyncio.wait([get, self._closed],
+                                   timeout=STREAM_KEEPALIVE,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if get.done():
+                    payload = _encode_event(get.result())
+                else:
+                    get.cancel()
+                    # A comment, so closed connections are noticed
+                    payload = b': keep-alive\n\n'
+                writer.write(payload)
+                await writer.drain()
+        finally:
+            feed.unsubscribe(token)
+
+        return 200
+
+    async def do_POST(self, path, headers, body):
+        """Same routes as HTTPRequestHandler.do_POST
+        outputs
+        -------
+        (status, content_type, payload)"""
+
+        # find the pieces
+        args = urlparse(path).path.split("/")
+
+        if args[1] == "readpropertymultiple":
+            try:
+                body_json = json.loads(body.decode('utf-8'))
+            except ValueError as e:
+                return (400, "text/plain", bytes(str(e), 'utf-8'))
+            return await self.do_ReadPropertyMultiple(args, body_json, headers)
+        else:
+            msg = b"'readpropertymultiple' expected from POST request"
+            return (400, "text/plain", msg)
+
+    async def _request_io(self, request, timeout):
+        """Give a request to the BACnet application and wait for the IOCB
+        without blocking the event loop. Identical pending requests share
+        one IOCB"""
+        iocb = _submit_request(request, timeout)
+        future = iocb_future(iocb, self.loop)
+        return await future
+
+    async def do_read(self, args, headers):
+
+        if _debug:
+            AsyncHTTPServer._debug("do_read %r", args)
+
+        try:
+            request = _form_read_request(args)
+
+            # answer from the cache if the value was read recently
+            cache_key = _read_cache_key(request)
+            hit, value = _cached_value(cache_key, _max_age(headers))
+            if hit:
+                result = {"value": value}
+                return (202, "application/json",
+                        json.dumps(result).encode("utf-8"))
+
+            timeout = int(headers.get('X-bacnet-timeout', 5))
+            with tracer.span('iocb_wait'):
+                iocb = await self._request_io(request, timeout)
+
+            # filter out errors and aborts
+            if iocb.ioError:
+                result = {"error": str(iocb.ioError)}
+            else:
+                with tracer.span('cast_out'):
+                    value = inflight.decode(iocb, _decode_read_response)
+                cache.put(cache_key, value)
+                result = {"value": value}
+
+        except Exception as err:
+            AsyncHTTPServer._exception("exception: %r", err)
+            result = {"exception": str(err)}
+
+        return (202, "application/json", json.dumps(result).encode("utf-8"))
+
+    async def do_ReadPropertyMultiple(self, args, body_json, headers):
+
+        if _debug:
+            AsyncHTTPServer._debug("do_ReadPropertyMultiple %r", body_json)
+
+        try:
+            read_access_spec_list = _form_read_access_spec_list(body_json)
+        except (ValueError, KeyError, AttributeError) as e:
+            return (202, "text/plain", bytes(str(e), 'utf-8'))
+
+        request = ReadPropertyMultipleRequest(
+            listOfReadAccessSpecs=read_access_spec_list,
+            )
+        request.pduDestination = Address(body_json['address'])
+
+        # Values read within the cache lifetime are not read again
+        results, missing = _split_cached_specs(request, _max_age(headers))
+        if not missing:
+            return (202, "application/json", _encode_results(results))
+        request.listOfReadAccessSpecs = missing
+
+        # Large requests are split to fit the device
+        requests = _split_ReadPropertyMultiple_request(request)
+        timeout = int(headers.get('X-bacnet-timeout', 4))
+        with tracer.span('iocb_wait', requests=len(requests)):
+            iocbs = _submit_requests(requests, timeout)
+            iocbs = await asyncio.gather(
+                *[iocb_future(iocb, self.loop) for iocb in iocbs])
+
+        for request, iocb in zip(requests, iocbs):
+            if not iocb.ioResponse:
+                msg = ('Received improper BACnet response \n' +
+                       'ioState : {}\n' +
+                       'ioError : {}')
+                msg = msg.format(iocb.ioState, iocb.ioError)
+                return (202, "text/plain", bytes(msg, 'utf-8'))
+
+            try:
+                with tracer.span('cast_out'):
+                    fetched = inflight.decode(
+                        iocb, _decode_ReadPropertyMultiple_response)
+            except TypeError as e:
+                return (202, "text/plain", bytes(str(e), 'utf-8'))
+            _cache_ReadPropertyMultiple_results(request, fetched)
+            _merge_results(results, fetched)
+
+        with tracer.span('json_encode'):
+            payload = _encode_results(results)
+        return (202, "application/json", payload)
 
 
 #
@@ -673,7 +1793,8 @@ class ThreadedTCPServer(ThreadingMixIn, TCPServer):
 #
 
 def main(child_thread=False):
-    global this_application, server, server_thread, bac_thread
+    global this_application, server, server_thread, bac_thread, batcher
+    global rpm_concurrency, cov, stream_interval, history
 
     try:
 
@@ -687,17 +1808,58 @@ def main(child_thread=False):
             _log.debug("initialization")
             _log.debug("    - args: %r", args)
 
+        # Configure the present value cache
+        cache.ttl = args.cache_ttl
+        cache.max_size = args.cache_size
+
         # Make a device object
         this_device = LocalDeviceObject(ini=args.ini)
 
         # Make a simple application
-        this_application = BIPSimpleApplication(this_device, args.ini.address)
+        this_application = COVApplication(this_device, args.ini.address)
+
+        rpm_concurrency = args.rpm_concurrency
+
+        # Merge concurrent single reads to the same device
+        if args.batch_window > 0:
+            batcher = ReadBatcher(this_application.request_io,
+                                  window=args.batch_window / 1000,
+                                  device_info=_device_info)
+
+        # Keep subscribed objects up to date without polling
+        if args.cov:
+            cov = COVValueStore(this_application.request_io,
+                                lifetime=args.cov_lifetime,
+                                on_change=feed.publish)
+            for cov_object in args.cov:
+                addr, obj_id = cov_object.split("/")[:2]
+                deferred(cov.subscribe, Address(addr),
+                         ObjectIdentifier(obj_id).value)
+
+        # Answer /history queries from the store written by main.py
+        if args.history:
+            history = TimeSeriesStore(args.history)
+
+        # Time the stages of each request
+        if args.trace:
+            tracer.sink = JSONLFile(args.trace)
+
+        # One poller reads the values watched by /stream clients
+        stream_interval = args.stream_interval
+        poll_task = RecurringFunctionTask(stream_interval * 1000,
+                                          _poll_watched)
+        deferred(poll_task.install_task)
 
         # local host, special port
-        server = ThreadedTCPServer((args.host, args.port), HTTPRequestHandler)
+        if args.asyncio:
+            # One event loop serves every request
+            server = AsyncHTTPServer((args.host, args.port))
+        else:
+            server = ThreadedTCPServer((args.host, args.port),
+                                       HTTPRequestHandler)
 
-        # Start a thread with the server -- that thread will then start a thread
-        # for each request
+        # Start a thread with the server -- the threaded server will then
+        # start a thread for each request
         server_thread = threading.Thread(target=server.serve_forever)
 
         # exit the server thread when the main thread terminates
@@ -14,6 +14,7 @@ from queue import Queue, Empty
 import time
 import subprocess
 import re
+import socket
 
 # Third party imports
 import requests
@@ -21,14 +22,17 @@ from bacpypes.core import run, stop
 from bacpypes.consolelogging import ConfigArgumentParser
 from bacpypes.iocb import IOCB
 from bacpypes.pdu import Address
-from bacpypes.apdu import ReadPropertyRequest
-from bacpypes.primitivedata import ObjectIdentifier
+from bacpypes.apdu import ReadPropertyRequest, ReadPropertyACK
+from bacpypes.primitivedata import ObjectIdentifier, Real
+from bacpypes.constructeddata import Any
+from bacpypes.task import TaskManager
 from bacpypes.app import BIPSimpleApplication
 from bacpypes.object import get_object_class, get_datatype
 from bacpypes.local.device import LocalDeviceObject
 
 # Local imports
-from BACnetHTTPServer import HTTPRequestHandler, ThreadedTCPServer
+from BACnetHTTPServer import (HTTPRequestHandler, ThreadedTCPServer,
+                              AsyncHTTPServer)
 import BACnetHTTPServer
 
 # Globals & Declarations
@@ -36,6 +40,7 @@ process_queue = Queue()
 ini_file = "./bacnet_client.ini"
 HOST, PORT = 'localhost','8081'
 BAC_SERVER_ADDRESS = '192.168.1.100'
+ASYNC_HTTP_PORT = 18082
 
 # Check if network interface is active
 def _check_network_interface_windows(interface_name):
@@ -326,6 +331,55 @@ def read_process():
         print(line)
     return
 
+class COVApplicationTest(unittest.TestCase):
+    """Responses given to COVApplication.confirmation while a request to
+    the device is active. Nothing is sent back by the device address"""
+
+    def setUp(self):
+        TaskManager()
+        this_device = LocalDeviceObject(
+            objectName='COVApplicationTest', objectIdentifier=('device', 599),
+            maxApduLengthAccepted=1024, segmentationSupported='segmentedBoth',
+            vendorIdentifier=15)
+        self.application = BACnetHTTPServer.COVApplication(
+            this_device, Address('127.0.0.3:47811'))
+        self.addCleanup(self.application.mux.directPort.handle_close)
+
+        self.request = ReadPropertyRequest(
+            objectIdentifier=('analogInput', 1),
+            propertyIdentifier='presentValue')
+        self.request.pduDestination = Address('127.0.0.4')
+        self.iocb = IOCB(self.request)
+        self.application.request_io(self.iocb)
+        return
+
+    def _ack(self, source, invoke_id):
+        apdu = ReadPropertyACK(objectIdentifier=('analogInput', 1),
+                               propertyIdentifier='presentValue',
+                               propertyValue=Any(Real(72.5)))
+        apdu.pduSource = Address(source)
+        apdu.apduInvokeID = invoke_id
+        return apdu
+
+    def test_confirmation(self):
+        invoke_id = self.request.apduInvokeID
+        self.assertIsNotNone(invoke_id)
+
+        # The answer to an earlier request does not complete this one
+        self.application.confirmation(
+            self._ack('127.0.0.4', (invoke_id + 1) % 256))
+        self.assertIsNone(self.iocb.ioResponse)
+
+        # No request is waiting for an answer from this address
+        self.application.confirmation(self._ack('127.0.0.5', invoke_id))
+        self.assertIsNone(self.iocb.ioResponse)
+
+        ack = self._ack('127.0.0.4', invoke_id)
+        self.application.confirmation(ack)
+        self.assertIs(self.iocb.ioResponse, ack)
+        return
+
+
 class OfflineBacnetTest(unittest.TestCase):
 
     def setUp(self):
@@ -525,6 +579,146 @@ class OfflineBacnetTest(unittest.TestCase):
         return None
 
 
+def _read_response(stream):
+    """Read one HTTP response from a socket file
+    outputs
+    -------
+    (status, headers, body) or None if the connection closed"""
+    status_line = stream.readline()
+    if not status_line:
+        return None
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = stream.readline().decode('iso-8859-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip()] = value.strip()
+    body = stream.read(int(headers.get('Content-Length', 0)))
+    return status, headers, body
+
+
+class AsyncHTTPServerTest(unittest.TestCase):
+    """Requests written on a loopback socket to AsyncHTTPServer. The routes
+    used do not send BACnet requests"""
+
+    def setUp(self):
+        self.server = AsyncHTTPServer(('127.0.0.1', ASYNC_HTTP_PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        # Wait for the server to listen
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', ASYNC_HTTP_PORT)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        return
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server_thread.join(5)
+        return
+
+    def _connect(self):
+        sock = socket.create_connection(('127.0.0.1', ASYNC_HTTP_PORT),
+                                        timeout=5)
+        self.addCleanup(sock.close)
+        return sock, sock.makefile('rb')
+
+    def test_pipelined(self):
+        """Requests written at once are answered in order on one
+        connection"""
+        sock, stream = self._connect()
+        sock.sendall(b'GET /whois HTTP/1.1\r\nHost: x\r\n\r\n' +
+                     b'HEAD / HTTP/1.1\r\nHost: x\r\n\r\n' +
+                     b'POST /readpropertymultiple HTTP/1.1\r\n' +
+                     b'Content-Length: 3\r\n\r\n{x}' +
+                     b'GET /nothing HTTP/1.1\r\n\r\n')
+
+        status, headers, body = _read_response(stream)
+        self.assertEqual(status, 202)
+        self.assertEqual(body, b'WhoIs not implemented')
+        self.assertEqual(headers['Connection'], 'keep-alive')
+        status, headers, body = _read_response(stream)
+        self.assertEqual((status, body), (200, b''))
+        # Invalid JSON
+        status, headers, body = _read_response(stream)
+        self.assertEqual(status, 400)
+        status, headers, body = _read_response(stream)
+        self.assertEqual(body, b"'read' or 'whois' expected")
+
+        # The connection is still open
+        sock.sendall(b'HEAD / HTTP/1.1\r\n\r\n')
+        self.assertEqual(_read_response(stream)[0], 200)
+        return
+
+    def test_connection_close(self):
+        """The connection is closed after the response to a request with
+        Connection: close, or an HTTP/1.0 request"""
+        for request in (b'HEAD / HTTP/1.1\r\nConnection: close\r\n\r\n',
+                        b'HEAD / HTTP/1.0\r\n\r\n'):
+            sock, stream = self._connect()
+            sock.sendall(request + b'HEAD / HTTP/1.1\r\n\r\n')
+            status, headers, body = _read_response(stream)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['Connection'], 'close')
+            self.assertIsNone(_read_response(stream))
+        return
+
+    def test_bad_request_line(self):
+        for request_line in (b'GET /whois\r\n', b'GET / HTTP/1.1 x\r\n',
+                             b'GET / FOO\r\n'):
+            sock, stream = self._connect()
+            sock.sendall(request_line + b'\r\n')
+            status, headers, body = _read_response(stream)
+            self.assertEqual(status, 400)
+            self.assertEqual(body, b'Bad request line')
+            self.assertIsNone(_read_response(stream))
+        return
+
+    def test_content_length(self):
+        """Bodies that can't be read are answered and the connection is
+        closed"""
+        size = str(AsyncHTTPServer.max_body_size + 1).encode()
+        cases = [
+            (b'Content-Length: ' + size + b'\r\n', 413),
+            (b'', 411),
+            (b'Content-Length: -1\r\n', 400),
+            (b'Content-Length: abc\r\n', 400),
+            (b'Content-Length: 2\r\nContent-Length: 3\r\n', 400),
+            (b'Transfer-Encoding: chunked\r\n', 501),
+            ]
+        for header, expect in cases:
+            sock, stream = self._connect()
+            sock.sendall(b'POST /readpropertymultiple HTTP/1.1\r\n' +
+                         header + b'\r\n')
+            status, headers, body = _read_response(stream)
+            self.assertEqual(status, expect, header)
+            self.assertEqual(headers['Connection'], 'close')
+            self.assertIsNone(_read_response(stream))
+        return
+
+    def test_disconnect_mid_body(self):
+        """A client that closes the connection before the end of the body
+        gets no response, and the server keeps serving"""
+        sock, stream = self._connect()
+        sock.sendall(b'POST /readpropertymultiple HTTP/1.1\r\n' +
+                     b'Content-Length: 100\r\n\r\n{"address"')
+        sock.shutdown(socket.SHUT_WR)
+        self.assertIsNone(_read_response(stream))
+
+        sock, stream = self._connect()
+        sock.sendall(b'HEAD / HTTP/1.1\r\n\r\n')
+        self.assertEqual(_read_response(stream)[0], 200)
+        return
+
+
 if __name__ == '__main__':
     # Three ways to run test suites or their methods
 
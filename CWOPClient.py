@@ -8,18 +8,28 @@ Created on Sun Nov  1 13:39:53 2020
 # Python imports
 import asyncio
 import socket
+import random
+import time
 
 # Third party imports
 
 # Local imports
 from coordinate import Latitude, Longitude
-from CWOPpdu import CWOPPDU
+from CWOPpdu import CWOPPDU, LoginLine
+from tracing import tracer
 
 # Declarations
 SERVER_HOST = 'cwop.aprs.net'
 SERVER_PORT = 14580
 _debug = False
 pdu = False # No default for sending message
+# Seconds without a line from the server before the connection is considered
+# dead. APRS-IS servers send a comment line about every 20 seconds
+IDLE_TIMEOUT = 120
+# Seconds to wait before connecting again after a failed connection. Doubles
+# for each failure up to RECONNECT_MAX
+RECONNECT_MIN = 1
+RECONNECT_MAX = 300
 
 #%%
 
@@ -94,6 +104,270 @@ async def cwop_client(pdu, SERVER_HOST, SERVER_PORT):
     return
 
 
+class APRSISSession:
+    """A long lived connection to an APRS-IS server. The session logs in once
+    and every packet is written to the same connection, so packets of many
+    stations are pipelined without a new connection and login for each.
+    Lines from the server (software banner, login acknowledgement and
+    keepalive comments) are read and discarded in the background.
+
+    A connection that closes or goes quiet for idle_timeout seconds is opened
+    again on the next send. After a failed connection, send raises
+    ConnectionError without connecting until the backoff delay has passed.
+    The delay doubles with each failure from RECONNECT_MIN to RECONNECT_MAX.
+    A connection counts as failed until the server sends a line
+
+    Example
+    -------
+    session = APRSISSession(LoginLine('FW8400').login_line)
+    await session.send(pdu.pdu_data_packet)
+    await session.send_many([pdu1.pdu_data_packet, pdu2.pdu_data_packet])
+    await session.close()
+    """
+
+    def __init__(self, login_line, host=SERVER_HOST, port=SERVER_PORT,
+                 idle_timeout=IDLE_TIMEOUT, connect_timeout=10):
+        """
+        Parameters
+        ----------
+        login_line : (bytes) like CWOPpdu.LoginLine.login_line
+        host : (str) APRS-IS server
+        port : (int)
+        idle_timeout : (float) seconds without a line from the server before
+            the connection is closed
+        connect_timeout : (float) seconds to wait for a connection
+        """
+        self.login_line = login_line
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.connects = 0
+        self.packets_sent = 0
+        self._writer = None
+        self._reader_task = None
+        self._lock = None
+        self._failures = 0
+        self._next_attempt = 0
+
+        return
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def _connect(self):
+        """Open the connection and log in"""
+        delay = self._next_attempt - time.monotonic()
+        if delay > 0:
+            msg = ('Not connected to {}:{}. Next connection attempt in ' +
+                   '{:.0f} seconds').format(self.host, self.port, delay)
+            raise ConnectionError(msg)
+
+        if _debug:
+            print('Client connecting to server\n')
+        with tracer.span('aprs.connect', host=self.host):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self._backoff()
+                msg = 'Connection to {}:{} failed. {}'.format(
+                    self.host, self.port, repr(e))
+                raise ConnectionError(msg) from e
+
+            # Log in
+            if _debug:
+                print('Client sending login line {}\n'.format(
+                    self.login_line))
+            try:
+                writer.write(self.login_line + b'\r\n')
+                await writer.drain()
+            except OSError as e:
+                writer.close()
+                self._backoff()
+                msg = 'Login to {}:{} failed. {}'.format(
+                    self.host, self.port, repr(e))
+                raise ConnectionError(msg) from e
+
+        # The connection counts as failed until the server sends a line (see
+        # _read_lines). A server that accepts the connection and drops it
+        # is not connected to again before the backoff delay
+        self._backoff()
+        self._writer = writer
+        self._reader_task = asyncio.ensure_future(
+            self._read_lines(reader, writer))
+        self.connects += 1
+
+        return
+
+    def _backoff(self):
+        """Count a failed connection and delay the next attempt"""
+        self._failures += 1
+        backoff = min(RECONNECT_MIN * 2 ** (self._failures - 1),
+                      RECONNECT_MAX)
+        # Jitter, so many clients do not reconnect at once
+        self._next_attempt = time.monotonic() + \
+            backoff * random.uniform(0.8, 1.0)
+        return
+
+    async def _read_lines(self, reader, writer):
+        """Discard lines from the server until it disconnects or goes
+        quiet"""
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(),
+                                              self.idle_timeout)
+                if not line:
+                    # The server closed the connection
+                    break
+                if self._failures:
+                    # The server answered, so the connection is working
+                    self._failures = 0
+                    self._next_attempt = 0
+                if _debug:
+                    print('Client Received {}\n'.format(line))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+        return
+
+    async def send(self, packet):
+        """Send one APRS packet
+        Parameters
+        ----------
+        packet : (bytes) like CWOPPDU.pdu_data_packet, without the line end
+        """
+        await self.send_many([packet])
+        return
+
+    async def send_many(self, packets):
+        """Write APRS packets back to back on the connection. The packets are
+        written again on a new connection if the connection was lost
+        Parameters
+        ----------
+        packets : (list) of bytes
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        data = b''.join(packet + b'\r\n' for packet in packets)
+
+        async with self._lock:
+            for attempt in range(2):
+                if not self.connected:
+                    await self._connect()
+                try:
+                    if _debug:
+                        print('Client Sending data {}\n'.format(data))
+                    self._writer.write(data)
+                    await self._writer.drain()
+                    break
+                except ConnectionError:
+                    self._writer.close()
+                    if attempt:
+                        raise
+
+        self.packets_sent += len(packets)
+
+        return
+
+    async def close(self):
+        """Close the connection"""
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+        if self._reader_task is not None:
+            await self._reader_task
+        self._writer = None
+        self._reader_task = None
+
+        return
+
+
+class APRSISSessions:
+    """One APRSISSession for each provider ID. APRS-IS may drop a packet
+    whose source callsign is not the callsign that logged in, so the packets
+    of each station are sent on a connection logged in with its own provider
+    ID. Packets are routed by the callsign before '>'. Sessions are opened
+    on the first packet of each provider ID
+
+    Has the send, send_many and close methods of APRSISSession, so packets of
+    many stations can be sent from one spool (see CWOPSpool.forward_spool)
+
+    Example
+    -------
+    sessions = APRSISSessions()
+    await sessions.send(pdu.pdu_data_packet)
+    await sessions.close()
+    """
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, **kwargs):
+        """
+        Parameters
+        ----------
+        host : (str) APRS-IS server
+        port : (int)
+        kwargs : passed to each APRSISSession, like idle_timeout
+        """
+        self.host = host
+        self.port = port
+        self.sessions = {}
+        self._kwargs = kwargs
+
+        return
+
+    @property
+    def connects(self):
+        return sum(session.connects for session in self.sessions.values())
+
+    @property
+    def packets_sent(self):
+        return sum(session.packets_sent
+                   for session in self.sessions.values())
+
+    def session(self, provider_id):
+        """The APRSISSession logged in as provider_id"""
+        session = self.sessions.get(provider_id)
+        if session is None:
+            session = APRSISSession(LoginLine(provider_id).login_line,
+                                    self.host, self.port, **self._kwargs)
+            self.sessions[provider_id] = session
+        return session
+
+    async def send(self, packet):
+        await self.send_many([packet])
+        return
+
+    async def send_many(self, packets):
+        """Write packets on the session of their provider ID. Raises the
+        error of the first session that fails. Packets of the sessions before
+        it were sent
+        Parameters
+        ----------
+        packets : (list) of bytes like CWOPPDU.pdu_data_packet
+        """
+        groups = {}
+        for packet in packets:
+            provider_id = packet.split(b'>', 1)[0].decode('ascii')
+            groups.setdefault(provider_id, []).append(packet)
+
+        for provider_id, group in groups.items():
+            await self.session(provider_id).send_many(group)
+
+        return
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        return
+
+
 def _standard_socket():
     """Dont use this method, even though it works to send data through a
     standard socket"""
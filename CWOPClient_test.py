@@ -10,13 +10,15 @@ import asyncio
 import unittest
 from datetime import datetime
 import socket
+import time
 
 # Third party imports
 
 # Local imports
 from coordinate import Latitude, Longitude
-from CWOPpdu import CWOPPDU
-from CWOPClient import cwop_client
+from CWOPpdu import CWOPPDU, LoginLine
+from CWOPClient import cwop_client, APRSISSession, APRSISSessions
+import CWOPClient
 
 # Declarations
 SERVER_HOST = 'cwop.aprs.net'
@@ -26,7 +28,7 @@ SERVER_PORT = 14580
 #%%
 
 
-def _manual_test():
+async def _manual_test():
     _debug = True
     data_packet = b'FW8400>APRS,TCPIP*:@110649z2945.13N/09532.50W_.../...g...t...r...p...P...b...h...'
     login_line = b'user FW8400 pass -1 vers PythonCWOP 1.0'
@@ -96,9 +98,207 @@ class CWOPClientTest(unittest.TestCase):
         return
 
 
+class StandInServer:
+    """Local APRS-IS stand in. Records the lines of each connection and
+    sends a banner and keepalive comments like an APRS-IS server"""
+
+    def __init__(self, keepalive=0.05):
+        self.keepalive = keepalive
+        self.connections = [] # list of lines received on each connection
+        self.writers = []
+        # Close connections without a line, like a full server
+        self.refuse = False
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, host='127.0.0.1', port=0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def handle(self, reader, writer):
+        lines = []
+        self.connections.append(lines)
+        if self.refuse:
+            writer.close()
+            return
+        self.writers.append(writer)
+        writer.write(b'# aprsc 2.1.10\r\n')
+        keepalive = asyncio.ensure_future(self._keepalive(writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                lines.append(line)
+        finally:
+            keepalive.cancel()
+            writer.close()
+
+    async def _keepalive(self, writer):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            writer.write(b'# aprsc 2.1.10 keepalive\r\n')
+
+    def drop(self):
+        """Close every open connection"""
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    async def stop(self):
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class APRSISSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.login_line = LoginLine('FW8400').login_line
+        self.packets = [b'FW8400>APRS,TCPIP*:@110649z2945.13N/09532.50W_1',
+                        b'EW9876>APRS,TCPIP*:@110649z2945.13N/09532.50W_2',
+                        b'FW8400>APRS,TCPIP*:@110649z2945.13N/09532.50W_3']
+        return
+
+    def _run(self, test):
+        async def run():
+            server = await StandInServer().start()
+            try:
+                await test(server)
+            finally:
+                await server.stop()
+        asyncio.run(run())
+        return
+
+    def test_pipeline(self):
+        """One login for all packets, keepalive lines are discarded"""
+        async def test(server):
+            session = APRSISSession(self.login_line, '127.0.0.1', server.port)
+            await session.send(self.packets[0])
+            await asyncio.sleep(0.2) # Several server keepalives
+            await session.send_many(self.packets[1:])
+            await session.close()
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(len(server.connections), 1)
+            self.assertEqual(server.connections[0],
+                             [self.login_line + b'\r\n'] +
+                             [packet + b'\r\n' for packet in self.packets])
+            self.assertEqual(session.connects, 1)
+            self.assertEqual(session.packets_sent, 3)
+            # The server answered
+            self.assertEqual(session._failures, 0)
+        self._run(test)
+        return
+
+    def test_reconnect(self):
+        """A connection closed by the server is opened again and logged in"""
+        async def test(server):
+            session = APRSISSession(self.login_line, '127.0.0.1', server.port)
+            await session.send(self.packets[0])
+            server.drop()
+            await asyncio.sleep(0.05)
+            self.assertFalse(session.connected)
+
+            await session.send(self.packets[1])
+            await session.close()
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(session.connects, 2)
+            self.assertEqual(len(server.connections), 2)
+            self.assertEqual(server.connections[1],
+                             [self.login_line + b'\r\n',
+                              self.packets[1] + b'\r\n'])
+        self._run(test)
+        return
+
+    def test_idle_timeout(self):
+        """A server that goes quiet is disconnected"""
+        async def test(server):
+            server.keepalive = 10
+            session = APRSISSession(self.login_line, '127.0.0.1', server.port,
+                                    idle_timeout=0.1)
+            await session.send(self.packets[0])
+            self.assertTrue(session.connected)
+            await asyncio.sleep(0.3)
+            self.assertFalse(session.connected)
+            await session.close()
+        self._run(test)
+        return
+
+    def test_backoff(self):
+        """No connection attempts before the backoff delay passed"""
+        async def test(server):
+            port = server.port
+            await server.stop()
+            session = APRSISSession(self.login_line, '127.0.0.1', port)
+            with self.assertRaises(ConnectionError):
+                await session.send(self.packets[0])
+            with self.assertRaises(ConnectionError) as context:
+                await session.send(self.packets[0])
+            self.assertIn('Next connection attempt', str(context.exception))
+            self.assertEqual(session._failures, 1)
+
+            # The delay doubles for each failure
+            session._next_attempt = 0
+            with self.assertRaises(ConnectionError):
+                await session.send(self.packets[0])
+            self.assertEqual(session._failures, 2)
+            self.assertGreater(session._next_attempt - time.monotonic(),
+                               CWOPClient.RECONNECT_MIN)
+        self._run(test)
+        return
+
+    def test_sessions(self):
+        """Packets are sent on a connection logged in with their provider
+        ID"""
+        async def test(server):
+            sessions = APRSISSessions('127.0.0.1', server.port)
+            await sessions.send(self.packets[0])
+            await sessions.send_many(self.packets[1:])
+            await sessions.close()
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(sorted(sessions.sessions), ['EW9876', 'FW8400'])
+            self.assertEqual(sessions.connects, 2)
+            self.assertEqual(sessions.packets_sent, 3)
+            self.assertEqual(server.connections[0],
+                             [LoginLine('FW8400').login_line + b'\r\n',
+                              self.packets[0] + b'\r\n',
+                              self.packets[2] + b'\r\n'])
+            self.assertEqual(server.connections[1],
+                             [LoginLine('EW9876').login_line + b'\r\n',
+                              self.packets[1] + b'\r\n'])
+        self._run(test)
+        return
+
+    def test_backoff_dropped(self):
+        """A server that accepts the connection and closes it without a
+        line is not connected to again before the backoff delay"""
+        async def test(server):
+            server.refuse = True
+            session = APRSISSession(self.login_line, '127.0.0.1', server.port)
+            try:
+                await session.send(self.packets[0])
+            except ConnectionError:
+                pass
+            await asyncio.sleep(0.05)
+            self.assertFalse(session.connected)
+
+            with self.assertRaises(ConnectionError) as context:
+                await session.send(self.packets[1])
+            self.assertIn('Next connection attempt', str(context.exception))
+            self.assertEqual(len(server.connections), 1)
+            self.assertEqual(session._failures, 1)
+            await session.close()
+        self._run(test)
+        return
+
+
 
 if __name__ == '__main__':
     unittest.main(CWOPClientTest())
+    unittest.main(APRSISSessionTest())
 
 
 
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec  5 10:12:40 2020
+
+Store and forward of CWOP packets. Packets that could not be sent are kept
+in a SQLite database, and sent when the APRS-IS server can be reached again.
+The database outlives restarts of the process
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import sqlite3
+import time
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+DEFAULT_SPOOL_PATH = 'CWOPSpool.sqlite3'
+# The oldest packets are dropped past this many packets
+MAX_PACKETS = 10000
+# Packets older than this many seconds are dropped. The APRS timestamp only
+# holds the day of the month, so old observations are not useful
+MAX_AGE = 24 * 60 * 60
+# Free database pages are returned to the file system after this many
+# packets are removed
+COMPACT_AFTER = 1000
+_debug = False
+
+#%%
+
+
+class PacketSpool:
+    """An on-disk, first in first out queue of APRS packets
+
+    Example
+    -------
+    spool = PacketSpool('CWOPSpool.sqlite3')
+    spool.append(pdu.pdu_data_packet)
+    for identifier, packet in spool.peek(10):
+        ...
+    spool.remove([identifier for identifier, packet in packets])
+    spool.close()
+    """
+
+    def __init__(self, path=DEFAULT_SPOOL_PATH, max_packets=MAX_PACKETS,
+                 max_age=MAX_AGE, compact_after=COMPACT_AFTER):
+        """
+        inputs
+        -------
+        path : (str) database file, or ':memory:'
+        max_packets : (int) packets kept at most. The oldest packets are
+            dropped when more are appended
+        max_age : (float) seconds. Older packets are dropped
+        compact_after : (int) packets removed between compactions
+        """
+        self.path = path
+        self.max_packets = max_packets
+        self.max_age = max_age
+        self.compact_after = compact_after
+        self.dropped = 0
+        self._removed = 0
+
+        self._connection = sqlite3.connect(path)
+        # auto_vacuum only applies to a new database, before any table
+        self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS packets ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'created REAL NOT NULL, '
+            'packet BLOB NOT NULL)')
+        self._connection.commit()
+        self.expire()
+
+        return
+
+    def __len__(self):
+        cursor = self._connection.execute('SELECT COUNT(*) FROM packets')
+        return cursor.fetchone()[0]
+
+    def append(self, packet):
+        """Add a packet to the end of the queue
+        inputs
+        -------
+        packet : (bytes) like CWOPPDU.pdu_data_packet"""
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO packets (created, packet) VALUES (?, ?)',
+                (time.time(), bytes(packet)))
+            cursor = self._connection.execute(
+                'DELETE FROM packets WHERE id <= '
+                '(SELECT id FROM packets ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (self.max_packets,))
+        self._dropped(cursor.rowcount)
+
+        return
+
+    def peek(self, count):
+        """The oldest packets, without removing them
+        outputs
+        -------
+        packets : (list) of (id, packet bytes)"""
+        cursor = self._connection.execute(
+            'SELECT id, packet FROM packets ORDER BY id LIMIT ?', (count,))
+        return [(identifier, bytes(packet)) for identifier, packet in cursor]
+
+    def remove(self, identifiers):
+        """Remove sent packets
+        inputs
+        -------
+        identifiers : (list) of id from peek"""
+        with self._connection:
+            self._connection.executemany(
+                'DELETE FROM packets WHERE id = ?',
+                [(identifier,) for identifier in identifiers])
+        self._removed += len(identifiers)
+        if self._removed >= self.compact_after:
+            self.compact()
+
+        return
+
+    def expire(self):
+        """Drop packets older than max_age"""
+        with self._connection:
+            cursor = self._connection.execute(
+                'DELETE FROM packets WHERE created < ?',
+                (time.time() - self.max_age,))
+        self._dropped(cursor.rowcount)
+
+        return
+
+    def compact(self):
+        """Return free database pages to the file system"""
+        # execute only steps the pragma once, which frees one page
+        self._connection.executescript('PRAGMA incremental_vacuum;')
+        self._removed = 0
+
+        return
+
+    def _dropped(self, count):
+        if count > 0:
+            self.dropped += count
+            self._removed += count
+            if _debug:
+                print('Spool dropped {} packets'.format(count))
+        return
+
+    def close(self):
+        self._connection.close()
+        return
+
+
+async def forward_spool(spool, session, rate=1.0, batch_size=10,
+                        retry_interval=30, sleep=asyncio.sleep):
+    """Send spooled packets until cancelled. Packets are removed from the
+    spool after they are written to the APRS-IS connection
+    inputs
+    -------
+    spool : (PacketSpool)
+    session : (CWOPClient.APRSISSession)
+    rate : (float) packets sent per second at most, so a large backlog does
+        not flood the server or the link. 0 or less sends without a limit
+    batch_size : (int) packets written at once
+    retry_interval : (float) seconds to wait after a failed send, and
+        between checks of an empty spool
+    sleep : (coroutine function) waits the given seconds, like
+        asyncio.sleep"""
+    while True:
+        spool.expire()
+        packets = spool.peek(batch_size)
+        if not packets:
+            await sleep(retry_interval)
+            continue
+
+        try:
+            await session.send_many([packet for _, packet in packets])
+        except OSError:
+            await sleep(retry_interval)
+            continue
+
+        spool.remove([identifier for identifier, _ in packets])
+        if rate > 0:
+            await sleep(len(packets) / rate)
+        else:
+            # Let other tasks run between batches
+            await sleep(0)
+
+    return
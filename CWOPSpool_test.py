@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec  5 11:02:18 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import os
+import tempfile
+import unittest
+
+# Third party imports
+
+# Local imports
+from CWOPSpool import PacketSpool, forward_spool
+
+# Declarations
+
+#%%
+
+
+class FakeSession:
+    """Records packets, and fails while fail is True"""
+
+    def __init__(self):
+        self.sent = []
+        self.fail = False
+
+    async def send_many(self, packets):
+        if self.fail:
+            raise ConnectionError('Not connected')
+        self.sent.extend(packets)
+
+
+class PacketSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'spool.sqlite3')
+        return
+
+    def tearDown(self):
+        self.directory.cleanup()
+        return
+
+    def test_fifo(self):
+        spool = PacketSpool(self.path)
+        for i in range(5):
+            spool.append(b'packet%d' % i)
+        self.assertEqual(len(spool), 5)
+
+        packets = spool.peek(3)
+        self.assertEqual([packet for _, packet in packets],
+                         [b'packet0', b'packet1', b'packet2'])
+        spool.remove([identifier for identifier, _ in packets])
+        self.assertEqual([packet for _, packet in spool.peek(10)],
+                         [b'packet3', b'packet4'])
+        spool.close()
+        return
+
+    def test_durable(self):
+        """Packets are kept when the spool is opened again"""
+        spool = PacketSpool(self.path)
+        spool.append(b'packet0')
+        spool.append(b'packet1')
+        spool.close()
+
+        spool = PacketSpool(self.path)
+        self.assertEqual([packet for _, packet in spool.peek(10)],
+                         [b'packet0', b'packet1'])
+        spool.close()
+        return
+
+    def test_max_packets(self):
+        """The oldest packets are dropped"""
+        spool = PacketSpool(self.path, max_packets=3)
+        for i in range(5):
+            spool.append(b'packet%d' % i)
+        self.assertEqual([packet for _, packet in spool.peek(10)],
+                         [b'packet2', b'packet3', b'packet4'])
+        self.assertEqual(spool.dropped, 2)
+        spool.close()
+        return
+
+    def test_max_age(self):
+        spool = PacketSpool(self.path, max_age=60)
+        spool.append(b'packet0')
+        spool._connection.execute('UPDATE packets SET created = created - 120')
+        spool.append(b'packet1')
+        spool.expire()
+        self.assertEqual([packet for _, packet in spool.peek(10)],
+                         [b'packet1'])
+        spool.close()
+        return
+
+    def test_compact(self):
+        """Removed packets are returned to the file system"""
+        spool = PacketSpool(self.path, compact_after=10**6)
+        for i in range(2000):
+            spool.append(b'x' * 200)
+        spool._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        full_pages = spool._connection.execute(
+            'PRAGMA page_count').fetchone()[0]
+
+        spool.remove([identifier for identifier, _ in spool.peek(2000)])
+        spool.compact()
+        pages = spool._connection.execute('PRAGMA page_count').fetchone()[0]
+        self.assertLess(pages, full_pages / 10)
+        spool.close()
+        return
+
+    def test_forward(self):
+        """Spooled packets are sent once the session recovers"""
+        spool = PacketSpool(self.path)
+        for i in range(5):
+            spool.append(b'packet%d' % i)
+        session = FakeSession()
+        session.fail = True
+
+        async def run():
+            task = asyncio.ensure_future(forward_spool(
+                spool, session, rate=1000, batch_size=2,
+                retry_interval=0.05))
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(spool), 5)
+            session.fail = False
+            await asyncio.sleep(0.2)
+            task.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(session.sent, [b'packet%d' % i for i in range(5)])
+        self.assertEqual(len(spool), 0)
+        spool.close()
+        return
+
+    def test_forward_unlimited(self):
+        """A rate of 0 or less is not a limit"""
+        for rate, waits in ((0, [0, 0, 0]), (-1, [0, 0, 0]),
+                            (2, [1, 1, 0.5])):
+            spool = PacketSpool(self.path)
+            for i in range(5):
+                spool.append(b'packet%d' % i)
+            session = FakeSession()
+            sleeps = []
+
+            async def sleep(seconds):
+                sleeps.append(seconds)
+                if seconds == 30:
+                    # The spool is empty
+                    raise asyncio.CancelledError()
+
+            async def run():
+                await forward_spool(spool, session, rate=rate, batch_size=2,
+                                    retry_interval=30, sleep=sleep)
+
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(run())
+            self.assertEqual(sleeps, waits + [30], rate)
+            self.assertEqual(session.sent, [b'packet%d' % i for i in range(5)])
+            self.assertEqual(len(spool), 0)
+            spool.close()
+        return
+
+
+if __name__ == '__main__':
+    unittest.main(PacketSpoolTest())
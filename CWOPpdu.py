@@ -7,6 +7,8 @@ Created on Fri Oct 30 06:53:49 2020
 
 # Python imports
 import asyncio
+from collections import namedtuple
+import functools
 import time
 import re
 import unittest
@@ -17,6 +19,45 @@ from coordinate import Latitude, Longitude
 
 #%% CWOP data packet
 
+# Distinct stations whose login line, header and packet template are cached
+TEMPLATE_CACHE_SIZE = 4096
+_FIELD_RE = re.compile(r'{(\w+)}')
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _login_line(login_base, provider_id, software_name, software_version):
+    login_line_str = login_base.format(ProviderID=provider_id,
+                                       software_name=software_name,
+                                       software_version=software_version)
+    return bytes(login_line_str, 'utf-8')
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _header(header_base, provider_id):
+    return header_base.format(ProviderID=provider_id)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _packet_template(base_data, header, latitude, longitude):
+    """base_data with the header and position of a station filled in. The
+    other fields become printf style mapping keys, which are faster to fill
+    than str.format
+    Example
+    -------
+    'FW8400>APRS,TCPIP*:@%(time)sz2945.13N/09527.50W_%(wind_direction)s...'
+    """
+    constants = {'header':header, 'latitude':latitude, 'longitude':longitude}
+
+    def replace(match):
+        name = match.group(1)
+        if name in constants:
+            return constants[name].replace('%', '%%')
+        return '%(' + name + ')s'
+
+    template = _FIELD_RE.sub(replace, base_data.replace('%', '%%'))
+    return template.replace('{{', '{').replace('}}', '}')
+
+
 """
 http://wxqa.com/faq.html
 
@@ -152,10 +193,8 @@ class LoginLine(ProviderID):
         """Example
         user EW9876 pass -1 vers YourSoftwareName 1.0
         """
-        login_line_str = self.login_base.format(ProviderID=self.provider_id,
-                                      software_name=self.software_name,
-                                      software_version=self.software_version)
-        return bytes(login_line_str, 'utf-8')
+        return _login_line(self.login_base, self.provider_id,
+                           self.software_name, self.software_version)
 
     def __str__(self):
         return self.login_line
@@ -175,7 +214,7 @@ class CWOPHeader(ProviderID):
     @property
     def header(self):
         # String
-        return self.header_base.format(ProviderID=self.provider_id)
+        return _header(self.header_base, self.provider_id)
 
 
 
@@ -235,7 +274,12 @@ class CWOPPDU(CWOPHeader, LoginLine):
 
     @property
     def pdu_data_packet(self):
-        return bytes(self.base_data.format(header=self.header, **self.data), 'utf-8')
+        # Only the weather fields are filled in. The header and position of
+        # the station are part of the cached template
+        template = _packet_template(self.base_data, self.header,
+                                    self.data['latitude'],
+                                    self.data['longitude'])
+        return bytes(template % self.data, 'utf-8')
 
     def __init__(self, provider_id, *args, **kwargs):
         """Inputs
@@ -363,19 +407,16 @@ class CWOPPDU(CWOPHeader, LoginLine):
     def _check_longitude(self, arg):
 
         if isinstance(arg, Longitude):
-            # Degree can be 0<180 (No negatives)
-            degree = '{:03.0f}'.format(abs(arg.degree)) # 0<180 format w/ E or W
-            decimal_minute = '{:05.2f}'.format(arg.decimal_minute)
-            hemisphere = arg.get_hemisphere()
-            return '{}{}{}'.format(degree, decimal_minute, hemisphere)
+            # Degree can be 0<180 (No negatives) format w/ E or W
+            return arg.aprs
 
         elif not isinstance(arg, str):
             msg='longitude must be str or Longitude type. Got {}'.format(type(arg))
 
-        # Match ####.##H
-        # Length 8 characters
-        # 4 numbers . 2 numbers [E or W]
-        if not re.search('^[0-9]{4}.[0-9]{2}[EW]$', arg):
+        # Match #####.##H
+        # Length 9 characters, or 8 from earlier versions
+        # 5 numbers . 2 numbers [E or W]
+        if not re.search('^[0-9]{4,5}.[0-9]{2}[EW]$', arg):
             msg='Longitude must follow format "dddmm.hhW"'
             raise ValueError(msg)
 
@@ -384,11 +425,8 @@ class CWOPPDU(CWOPHeader, LoginLine):
     def _check_latitude(self, arg):
 
         if isinstance(arg, Latitude):
-            # Degree is only 0<90
-            degree = '{:02.0f}'.format(arg.degree)
-            decimal_minute = '{:05.2f}'.format(arg.decimal_minute)
-            hemisphere = arg.get_hemisphere()
-            return '{}{}{}'.format(degree, decimal_minute, hemisphere)
+            # Degree is only 0<90 (No negatives)
+            return arg.aprs
 
         elif not isinstance(arg, str):
             msg='Latitude must be str or Latitude type. Got {}'.format(type(arg))
@@ -523,3 +561,358 @@ class CWOPPDU(CWOPHeader, LoginLine):
     def __repr__(self):
         return 'CWOPPDU({})'.format(self.pdu_data_packet.decode())
 
+
+
+
+#%% Bulk encoding
+
+# Field name, packet prefix, width, lowest value, highest value
+# in the order of CWOPPDU.base_data
+_NUMERIC_FIELDS = (
+    ('wind_direction', '_', 3, 0, 360),
+    ('wind_speed', '/', 3, None, None),
+    ('peak_instantaneous_wind_velocity', 'g', 3, None, None),
+    ('temperature', 't', 3, None, None),
+    ('rainfall_rate_hour', 'r', 3, None, None),
+    ('rainfall_rate_day', 'p', 3, None, None),
+    ('rainfall_rate_midnight', 'P', 3, None, None),
+    ('barometric_pressure', 'b', 5, None, None),
+    ('humidity', 'h', 2, 0, 100),
+    )
+_TIME_RE = re.compile('[0-9]{6}')
+_LATITUDE_RE = re.compile('^[0-9]{4}.[0-9]{2}[NS]$')
+_LONGITUDE_RE = re.compile('^[0-9]{4,5}.[0-9]{2}[EW]$')
+
+
+def _broadcast(name, values, count):
+    """A list of count values from a column or one value for every row"""
+    if isinstance(values, (list, tuple)):
+        if not len(values) == count:
+            msg="{} has {} values. Expected {}".format(name, len(values), count)
+            raise ValueError(msg)
+        return values
+    return [values] * count
+
+
+def _format_unique(values, format_value):
+    """Format each distinct value once. Rows of one station repeat its
+    provider ID and coordinates"""
+    formatted = {}
+    out = []
+    for value in values:
+        try:
+            out.append(formatted[value])
+        except KeyError:
+            formatted[value] = format_value(value)
+            out.append(formatted[value])
+    return out
+
+
+def _format_time(arg):
+    if isinstance(arg, datetime):
+        return arg.strftime('%d%H%M')
+    if not isinstance(arg, str) or not _TIME_RE.fullmatch(arg):
+        msg=("time should be passed as string or datetime in the format "+
+             "%d%H%M where %d is day of the month, %H is the current hour "+
+             "out of 24, and minute is the minute. Use leading zeros. Got {}")
+        raise ValueError(msg.format(arg))
+    return arg
+
+
+def _format_latitude(arg):
+    if isinstance(arg, Latitude):
+        return arg.aprs
+    if not isinstance(arg, str) or not _LATITUDE_RE.search(arg):
+        msg='Latitude must be Latitude or follow format "ddmm.hhN". Got {}'
+        raise ValueError(msg.format(arg))
+    return arg
+
+
+def _format_longitude(arg):
+    if isinstance(arg, Longitude):
+        return arg.aprs
+    if not isinstance(arg, str) or not _LONGITUDE_RE.search(arg):
+        msg='Longitude must be Longitude or follow format "dddmm.hhW". Got {}'
+        raise ValueError(msg.format(arg))
+    return arg
+
+
+def _format_numbers(name, values, width, low, high):
+    """Format a column of numbers like the CWOPPDU._check_* methods. None is
+    a missing value"""
+    numbers = []
+    for index, value in enumerate(values):
+        if value is None:
+            continue
+        try:
+            numbers.append(int(value))
+        except (TypeError, ValueError):
+            msg="{} must be float, integer, or compatable. Got {} in row {}"
+            raise ValueError(msg.format(name, type(value), index))
+
+    # Check the range of the column at once
+    if numbers and low is not None and min(numbers) < low:
+        msg="{} must be at least {}. Got {}"
+        raise ValueError(msg.format(name, low, min(numbers)))
+    if numbers and high is not None and max(numbers) > high:
+        msg="{} must be at most {}. Got {}"
+        raise ValueError(msg.format(name, high, max(numbers)))
+
+    format_number = ('{:0%d.0f}' % width).format
+    formatted = [format_number(number) for number in numbers]
+    if name == 'humidity':
+        # 100% is 'h00', and 0% is reported as 1%
+        formatted = ['00' if number == 100 else '01' if number == 0 else text
+                     for number, text in zip(numbers, formatted)]
+
+    if len(numbers) == len(values):
+        return formatted
+    formatted = iter(formatted)
+    return ['...' if value is None else next(formatted) for value in values]
+
+
+def encode_packets(provider_id, **columns):
+    """Encode the APRS weather packets of many observations at once. Each
+    column is checked as a whole instead of once per CWOPPDU. The packets are
+    the same as CWOPPDU(...).pdu_data_packet for each row
+
+    Inputs
+    -------
+    provider_id : (str or list of str) CWOP provider ID of each row, or one
+        provider ID for every row
+    columns : The keyword arguments of CWOPPDU. Each is a list or tuple with
+        one value per row, or one value for every row. None or a missing
+        column is reported as no data ('...'), except for latitude and
+        longitude which are required. Other columns are ignored like the
+        keyword arguments CWOPPDU does not use
+
+    Outputs
+    -------
+    packets : (list) of bytes
+
+    Example
+    -------
+    encode_packets('FW8400', time=['010900', '010905'],
+                   latitude=Latitude(29.75232), longitude=Longitude(-95.45831),
+                   temperature=[74, 75], humidity=[73, None])
+    """
+    for name in ('latitude', 'longitude'):
+        if name not in columns:
+            raise ValueError("'{}' is a required keyword argument".format(name))
+
+    # The number of rows is the length of the list columns
+    lengths = {len(values) for values in
+               [provider_id, *columns.values()]
+               if isinstance(values, (list, tuple))}
+    if len(lengths) > 1:
+        msg="Columns must have the same length. Got lengths {}"
+        raise ValueError(msg.format(sorted(lengths)))
+    count = lengths.pop() if lengths else 1
+
+    def format_header(provider_id):
+        ProviderID._check_provider_id(provider_id)
+        return _header(CWOPHeader.header_base, provider_id)
+
+    parts = [_format_unique(_broadcast('provider_id', provider_id, count),
+                            format_header)]
+    times = _broadcast('time', columns.get('time',
+                       datetime.now().strftime('%d%H%M')), count)
+    parts.append(['@' + text for text in _format_unique(times, _format_time)])
+    parts.append(['z' + text for text in _format_unique(
+        _broadcast('latitude', columns['latitude'], count),
+        _format_latitude)])
+    parts.append(['/' + text for text in _format_unique(
+        _broadcast('longitude', columns['longitude'], count),
+        _format_longitude)])
+    for name, prefix, width, low, high in _NUMERIC_FIELDS:
+        if name in columns:
+            values = _broadcast(name, columns[name], count)
+            parts.append([prefix + text for text in
+                          _format_numbers(name, values, width, low, high)])
+        else:
+            parts.append([prefix + '...'] * count)
+
+    return [''.join(row).encode('utf-8') for row in zip(*parts)]
+
+
+def encode_records(records):
+    """Encode the APRS weather packets of a list of observations
+    Inputs
+    -------
+    records : (list) of dict with the keyword arguments of CWOPPDU and
+        'provider_id'. Keys missing from a record are reported as no data
+    Outputs
+    -------
+    packets : (list) of bytes"""
+    if not records:
+        return []
+    names = {name for record in records for name in record}
+    names.discard('provider_id')
+    columns = {name:[record.get(name) for record in records]
+               for name in names}
+    if 'time' in columns and None in columns['time']:
+        now = datetime.now().strftime('%d%H%M')
+        columns['time'] = [now if value is None else value
+                           for value in columns['time']]
+    provider_id = [record.get('provider_id') for record in records]
+
+    return encode_packets(provider_id, **columns)
+
+
+
+#%% Decoding
+
+class WeatherRecord(namedtuple('WeatherRecord', (
+        'provider_id', 'path', 'time', 'latitude', 'longitude',
+        'wind_direction', 'wind_speed', 'peak_instantaneous_wind_velocity',
+        'temperature', 'rainfall_rate_hour', 'rainfall_rate_day',
+        'rainfall_rate_midnight', 'barometric_pressure', 'humidity',
+        'luminosity', 'comment'))):
+    """The fields of an APRS weather packet. Fields have the names of the
+    CWOPPDU keyword arguments. Measurements are int, or None when the packet
+    has no data ('...'). time, latitude and longitude are str as in
+    CWOPPDU.data, and time is None for packets without a timestamp"""
+    __slots__ = ()
+
+    def pdu_kwargs(self):
+        """Keyword arguments of CWOPPDU for this record"""
+        kwargs = {'latitude':self.latitude, 'longitude':self.longitude}
+        if self.time is not None:
+            kwargs['time'] = self.time
+        for name in _WEATHER_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                kwargs[name] = value
+        return kwargs
+
+    def to_pdu(self):
+        return CWOPPDU(self.provider_id, **self.pdu_kwargs())
+
+
+_WEATHER_FIELDS = WeatherRecord._fields[5:14]
+# Byte of the weather field letter : (position in the record, digits,
+# most characters without data). CWOPPDU writes three dots for every field
+# without data, like 'b...' and 'h...'
+_FIELD_WIDTHS = {
+    ord('g'):(7, 3, 3),
+    ord('t'):(8, 3, 3),
+    ord('r'):(9, 3, 3),
+    ord('p'):(10, 3, 3),
+    ord('P'):(11, 3, 3),
+    ord('b'):(12, 5, 5),
+    ord('h'):(13, 2, 3),
+    ord('L'):(14, 3, 3),
+    }
+_DIGITS = frozenset(b'0123456789')
+_NO_DATA = frozenset(b'. ')
+
+
+def parse_packet(line):
+    """Decode an APRS position weather packet. The data type is @ or /
+    (with timestamp), or ! or = (without timestamp). Packets with a
+    compressed position, other data types and server comments ('#')
+    are not weather packets
+
+    Inputs
+    -------
+    line : (bytes) one packet, with or without the line end
+    Outputs
+    -------
+    record : (WeatherRecord) or None if line is not a weather packet
+
+    Example
+    -------
+    parse_packet(b'CW0101>APRS,TCPXX*,qAX,CWOP-6:@262058z4447.27N/09130.98W'
+                 b'_263/003g012t032r000p002P002h52b10264L228AmbientCWOP.com')
+    WeatherRecord(provider_id='CW0101', path='APRS,TCPXX*,qAX,CWOP-6',
+                  time='262058', latitude='4447.27N',
+                  longitude='09130.98W', wind_direction=263, wind_speed=3,
+                  ...)
+    """
+    source_end = line.find(b'>')
+    info = line.find(b':', source_end)
+    if source_end < 1 or info < 0:
+        return None
+    info += 1
+
+    data_type = line[info:info + 1]
+    if data_type == b'@' or data_type == b'/':
+        # DDHHMM and the time zone or HHMMSS and h
+        if line[info + 7:info + 8] == b'h':
+            return None
+        timestamp = True
+        position = info + 8
+    elif data_type == b'!' or data_type == b'=':
+        timestamp = False
+        position = info + 1
+    else:
+        return None
+
+    # ddmm.hhN/dddmm.hhW_ddd/sss
+    # Latitude, symbol table, longitude, symbol code, wind direction, speed
+    weather = position + 26
+    if line[position + 18:position + 19] != b'_' or \
+            line[weather - 4:weather - 3] != b'/' or \
+            line[position] not in _DIGITS:
+        return None
+
+    # Decode the text fields at once
+    head = line[:position + 18].decode('ascii', 'replace')
+    values = [head[:source_end],
+              head[source_end + 1:info - 1],
+              head[info + 1:info + 7] if timestamp else None,
+              head[position:position + 8],
+              head[position + 9:],
+              None, None, None, None, None, None, None, None, None, None,
+              None]
+    try:
+        # A field without data is dots or spaces
+        if line[position + 19] not in _NO_DATA:
+            values[5] = int(line[position + 19:position + 22])
+        if line[position + 23] not in _NO_DATA:
+            values[6] = int(line[position + 23:weather])
+
+        # Weather fields are a letter and a fixed number of digits. The
+        # first unknown letter begins the comment
+        end = len(line)
+        get_width = _FIELD_WIDTHS.get
+        while weather < end:
+            field = get_width(line[weather])
+            if field is None:
+                break
+            index, width, no_data_width = field
+            start = weather + 1
+            if line[start] in _NO_DATA:
+                weather = start + 1
+                stop = min(start + no_data_width, end)
+                while weather < stop and line[weather] in _NO_DATA:
+                    weather += 1
+            else:
+                weather = start + width
+                values[index] = int(line[start:weather])
+    except (ValueError, IndexError):
+        return None
+
+    if values[13] == 0:
+        # h00 is 100%
+        values[13] = 100
+    values[15] = line[weather:].rstrip(b'\r\n').decode('ascii', 'replace')
+
+    return WeatherRecord._make(values)
+
+
+def parse_packets(lines):
+    """Decode the weather packets of a stream of lines, like an APRS-IS
+    connection or a file opened in binary mode. Lines that are not weather
+    packets are skipped
+    Inputs
+    -------
+    lines : (iterable) of bytes
+    Outputs
+    -------
+    records : (generator) of WeatherRecord"""
+    for line in lines:
+        record = parse_packet(line)
+        if record is not None:
+            yield record
+    return
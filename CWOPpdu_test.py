@@ -11,7 +11,10 @@ import re
 from datetime import datetime
 
 # Local imports
-from CWOPpdu import LoginLine, CWOPPDU, CWOPHeader, ProviderID
+from CWOPpdu import (LoginLine, CWOPPDU, CWOPHeader, ProviderID,
+                     encode_packets, encode_records, _packet_template,
+                     parse_packet, parse_packets)
+from coordinate import Latitude, Longitude
 
 
 
@@ -238,9 +241,181 @@ class CWOPHeaderTest(unittest.TestCase):
 
         return
 
+class PacketTemplateTest(unittest.TestCase):
+
+    def test_packet(self):
+        """Packets are the same as formatting base_data"""
+        pdu = CWOPPDU('FW8400', time='010900', latitude='2945.13N',
+                      longitude='9527.50W', wind_direction=90, temperature=-5,
+                      barometric_pressure=10150, humidity=100)
+        test = bytes(pdu.base_data.format(header=pdu.header, **pdu.data),
+                     'utf-8')
+        self.assertEqual(test, pdu.pdu_data_packet)
+        return
+
+    def test_cached(self):
+        """One template for each station"""
+        kwargs = {'latitude':'2945.13N', 'longitude':'9527.50W'}
+        CWOPPDU('FW8401', time='010900', temperature=70, **kwargs)\
+            .pdu_data_packet
+        hits = _packet_template.cache_info().hits
+        pdu = CWOPPDU('FW8401', time='010905', temperature=71, **kwargs)
+        self.assertIn(b'@010905z2945.13N/9527.50W', pdu.pdu_data_packet)
+        self.assertEqual(_packet_template.cache_info().hits, hits + 1)
+        self.assertIs(pdu.login_line, LoginLine('FW8401').login_line)
+        return
+
+    def test_base_data(self):
+        """A changed base_data is used"""
+        class PercentPDU(CWOPPDU):
+            base_data = CWOPPDU.base_data + "100%{{"
+        pdu = PercentPDU('FW8400', time='010900', latitude='2945.13N',
+                         longitude='9527.50W')
+        self.assertTrue(pdu.pdu_data_packet.endswith(b'h...100%{'))
+        return
+
+
+class EncodePacketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.latitude = Latitude(29.752320)
+        self.longitude = Longitude(-95.458310)
+        self.records = [
+            {'provider_id':'FW8400', 'time':'010900',
+             'latitude':self.latitude, 'longitude':self.longitude,
+             'temperature':-31, 'humidity':100, 'barometric_pressure':10150.4},
+            {'provider_id':'EW9876', 'time':datetime(2020, 11, 2, 7, 5),
+             'latitude':'1234.00N', 'longitude':'1234.00E',
+             'wind_direction':270, 'wind_speed':3.6,
+             'peak_instantaneous_wind_velocity':12, 'rainfall_rate_hour':1,
+             'rainfall_rate_day':2, 'rainfall_rate_midnight':3, 'humidity':0},
+            {'provider_id':'FW8400', 'time':'010905',
+             'latitude':self.latitude, 'longitude':self.longitude,
+             'temperature':74.9, 'humidity':26},
+            ]
+        return
+
+    def _pdu_packets(self, records):
+        return [CWOPPDU(record['provider_id'],
+                        **{key:value for key, value in record.items()
+                           if not key == 'provider_id'}).pdu_data_packet
+                for record in records]
+
+    def test_encode_records(self):
+        """Packets are the same as CWOPPDU packets"""
+        self.assertEqual(encode_records(self.records),
+                         self._pdu_packets(self.records))
+        self.assertEqual(encode_records([]), [])
+        return
+
+    def test_encode_packets(self):
+        """One value is used for every row"""
+        packets = encode_packets('FW8400', time=['010900', '010905'],
+                                 latitude=self.latitude,
+                                 longitude=self.longitude,
+                                 temperature=[70, 71], humidity=[50, None],
+                                 dewpoint=[60, 61])
+        records = [{'provider_id':'FW8400', 'time':'010900',
+                    'latitude':self.latitude, 'longitude':self.longitude,
+                    'temperature':70, 'humidity':50},
+                   {'provider_id':'FW8400', 'time':'010905',
+                    'latitude':self.latitude, 'longitude':self.longitude,
+                    'temperature':71}]
+        self.assertEqual(packets, self._pdu_packets(records))
+        return
+
+    def test_errors(self):
+        kwargs = {'time':'010900', 'latitude':'1234.00N',
+                  'longitude':'1234.00E'}
+        with self.assertRaises(ValueError):
+            encode_packets('FW8400', latitude='1234.00N')
+        with self.assertRaises(ValueError):
+            encode_packets('XX8400', **kwargs)
+        with self.assertRaises(ValueError):
+            encode_packets('FW8400', **kwargs, humidity=[50, -26])
+        with self.assertRaises(ValueError):
+            encode_packets('FW8400', **kwargs, wind_direction=[361])
+        with self.assertRaises(ValueError):
+            encode_packets('FW8400', **kwargs, temperature=['hot'])
+        with self.assertRaises(ValueError):
+            encode_packets('FW8400', **kwargs, temperature=[1, 2],
+                           humidity=[1, 2, 3])
+        with self.assertRaises(ValueError):
+            encode_packets(['FW8400'], time='0109', latitude='1234.00N',
+                           longitude='1234.00E')
+        return
+
+
+class ParsePacketTest(unittest.TestCase):
+
+    def test_parse(self):
+        line = (b'CW0101>APRS,TCPXX*,qAX,CWOP-6:@262058z4447.27N/09130.98W'
+                b'_263/003g012t032r000p002P002h52b10264L228AmbientCWOP.com'
+                b'\r\n')
+        record = parse_packet(line)
+        self.assertEqual(record.provider_id, 'CW0101')
+        self.assertEqual(record.path, 'APRS,TCPXX*,qAX,CWOP-6')
+        self.assertEqual(record.time, '262058')
+        self.assertEqual(record.latitude, '4447.27N')
+        self.assertEqual(record.longitude, '09130.98W')
+        self.assertEqual(record[5:16], (263, 3, 12, 32, 0, 2, 2, 10264, 52,
+                                        228, 'AmbientCWOP.com'))
+        return
+
+    def test_no_data(self):
+        line = (b'EW0006>APRS,TCPXX*,qAX,CWOP-5:!3729.10N/00245.99W'
+                b'_.../...g...t-05r   p008P...h00b09507L....DsIP')
+        record = parse_packet(line)
+        self.assertIsNone(record.time)
+        self.assertEqual(record[5:16], (None, None, None, -5, None, 8, None,
+                                        9507, 100, None, '.DsIP'))
+        return
+
+    def test_not_weather(self):
+        lines = [b'# aprsc 2.1.10-gd72a17c',
+                 b'FW8400>APRS,TCPIP*:>status text',
+                 b'FW8400>APRS,TCPIP*:@262058z4447.27N/09130.98W>comment',
+                 b'FW8400>APRS,TCPIP*:@262058h4447.27N/09130.98W_263/003',
+                 b'FW8400>APRS,TCPIP*:@262058z4447.27N/09130.98W_2x3/003',
+                 b'FW8400>APRS,TCPIP*:@262058z/5L!!<*e7_7P[g005t077',
+                 b'no packet']
+        for line in lines:
+            self.assertIsNone(parse_packet(line), line)
+        return
+
+    def test_round_trip(self):
+        """Records of CWOPPDU packets encode to the same packet"""
+        kwargs = [{'wind_direction':90, 'wind_speed':5, 'temperature':-5,
+                   'rainfall_rate_midnight':12, 'humidity':100,
+                   'barometric_pressure':10150},
+                  {'temperature':74, 'humidity':1},
+                  {}]
+        for kwarg in kwargs:
+            pdu = CWOPPDU('FW8400', time='010900',
+                          latitude=Latitude(29.752320),
+                          longitude=Longitude(-95.458310), **kwarg)
+            record = parse_packet(pdu.pdu_data_packet)
+            self.assertEqual(record.to_pdu().pdu_data_packet,
+                             pdu.pdu_data_packet)
+        return
+
+    def test_parse_packets(self):
+        lines = [b'# aprsc 2.1.10-gd72a17c\r\n',
+                 b'CW0101>APRS:@262058z4447.27N/09130.98W_263/003t032\r\n',
+                 b'DW0000>APRS:=3707.72S/17436.52E_272/002t067\r\n']
+        records = list(parse_packets(lines))
+        self.assertEqual([record.provider_id for record in records],
+                         ['CW0101', 'DW0000'])
+        self.assertEqual([record.temperature for record in records], [32, 67])
+        return
+
+
 
 if __name__ == '__main__':
     unittest.main(PDUTest())
     unittest.main(ProviderIDTest())
     unittest.main(LoginLineTest())
-    unittest.main(CWOPHeaderTest())
\ No newline at end of file
+    unittest.main(CWOPHeaderTest())
+    unittest.main(PacketTemplateTest())
+    unittest.main(EncodePacketsTest())
+    unittest.main(ParsePacketTest())
\ No newline at end of file
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec 19 08:52:16 2020
+
+Rolling aggregates of polled samples for the derived fields of a CWOP
+packet. Rain in the last hour, the last 24 hours and since local midnight,
+and the peak wind speed (gust) of the last minutes are updated with each
+sample instead of summing a history every cycle
+
+@author: z003vrzk
+"""
+
+# Python imports
+from collections import deque
+from datetime import datetime
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# APRS reports the peak wind speed of the last 5 minutes
+GUST_WINDOW = 5 * 60
+
+#%%
+
+
+class RollingSum:
+    """Sum of the amounts added in the last window seconds
+
+    Amounts added within resolution seconds of each other are kept as one
+    entry, so at most window / resolution entries are kept"""
+
+    def __init__(self, window, resolution=60):
+        """
+        inputs
+        -------
+        window : (float) seconds
+        resolution : (float) seconds of one entry
+        """
+        self.window = window
+        self.resolution = resolution
+        self._amounts = deque() # (bucket start, amount)
+        self._total = 0.0
+
+    def add(self, timestamp, amount):
+        if not amount:
+            return
+        bucket = timestamp - timestamp % self.resolution
+        if self._amounts and self._amounts[-1][0] == bucket:
+            self._amounts[-1][1] += amount
+        else:
+            self._amounts.append([bucket, amount])
+        self._total += amount
+        self._expire(timestamp)
+        return
+
+    def _expire(self, now):
+        start = now - self.window
+        while self._amounts and self._amounts[0][0] + self.resolution <= start:
+            _, amount = self._amounts.popleft()
+            self._total -= amount
+        if not self._amounts:
+            # No rounding error left behind
+            self._total = 0.0
+        return
+
+    def total(self, now):
+        """Sum of the amounts added after now - window"""
+        self._expire(now)
+        return self._total
+
+    def __len__(self):
+        return len(self._amounts)
+
+
+class RollingMax:
+    """Largest value added in the last window seconds
+
+    The values are kept in a deque of decreasing values. A value is dropped
+    when a larger value is added after it, because it can not be the
+    largest again"""
+
+    def __init__(self, window):
+        self.window = window
+        self._values = deque() # (timestamp, value), values decreasing
+
+    def add(self, timestamp, value):
+        while self._values and self._values[-1][1] <= value:
+            self._values.pop()
+        self._values.append((timestamp, value))
+        return
+
+    def maximum(self, now):
+        """Largest value added after now - window, or None"""
+        start = now - self.window
+        while self._values and self._values[0][0] < start:
+            self._values.popleft()
+        if not self._values:
+            return None
+        return self._values[0][1]
+
+    def __len__(self):
+        return len(self._values)
+
+
+class StationAggregates:
+    """Derived CWOP fields of one station
+
+    Example
+    -------
+    aggregates = StationAggregates()
+    # Each cycle
+    aggregates.add_rain_total(time.time(), rain_gauge_inches)
+    aggregates.add_wind(time.time(), wind_speed_mph)
+    pdu_kwargs.update(aggregates.fields(time.time()))
+    """
+
+    def __init__(self, gust_window=GUST_WINDOW, rain_scale=100):
+        """
+        inputs
+        -------
+        gust_window : (float) seconds of the peak wind speed
+        rain_scale : (float) CWOP rain units (hundredths of inches) in one
+            unit of the rain gauge. 100 for a gauge in inches
+        """
+        self.rain_scale = rain_scale
+        self._rain_hour = RollingSum(HOUR)
+        self._rain_day = RollingSum(DAY)
+        self._rain_midnight = 0.0
+        self._rain_date = None
+        self._last_rain_total = None
+        self._gust = RollingMax(gust_window)
+        self._wind = False
+
+    def add_rain(self, timestamp, amount):
+        """Add rain that fell since the last sample"""
+        date = datetime.fromtimestamp(timestamp).date()
+        if date != self._rain_date:
+            # Local midnight passed
+            self._rain_date = date
+            self._rain_midnight = 0.0
+        self._rain_hour.add(timestamp, amount)
+        self._rain_day.add(timestamp, amount)
+        self._rain_midnight += amount
+        return
+
+    def add_rain_total(self, timestamp, total):
+        """Add a reading of an accumulating rain gauge. The gauge may be
+        reset to 0"""
+        last, self._last_rain_total = self._last_rain_total, total
+        if last is None:
+            amount = 0.0
+        elif total < last:
+            # The gauge was reset. Rain since the reset
+            amount = total
+        else:
+            amount = total - last
+        self.add_rain(timestamp, amount)
+        return
+
+    def add_wind(self, timestamp, speed):
+        """Add a wind speed or gust reading"""
+        self._wind = True
+        self._gust.add(timestamp, speed)
+        return
+
+    def fields(self, now):
+        """CWOPPDU keyword arguments of the aggregates. Fields without
+        samples are left out"""
+        fields = {}
+        if self._rain_date is not None:
+            if datetime.fromtimestamp(now).date() != self._rain_date:
+                self._rain_date = datetime.fromtimestamp(now).date()
+                self._rain_midnight = 0.0
+            scale = self.rain_scale
+            fields['rainfall_rate_hour'] = \
+                round(self._rain_hour.total(now) * scale)
+            fields['rainfall_rate_day'] = \
+                round(self._rain_day.total(now) * scale)
+            fields['rainfall_rate_midnight'] = \
+                round(self._rain_midnight * scale)
+        if self._wind:
+            gust = self._gust.maximum(now)
+            if gust is not None:
+                fields['peak_instantaneous_wind_velocity'] = round(gust)
+        return fields
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec 19 10:05:33 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import unittest
+from datetime import datetime
+
+# Third party imports
+
+# Local imports
+from aggregates import RollingSum, RollingMax, StationAggregates, HOUR, DAY
+
+# Declarations
+# Local 06:00, so the first day of samples does not pass midnight
+START = datetime(2020, 12, 1, 6, 0).timestamp()
+
+#%%
+
+
+class RollingSumTest(unittest.TestCase):
+
+    def test_total(self):
+        rolling = RollingSum(HOUR, resolution=60)
+        rolling.add(START, 1)
+        rolling.add(START + 30 * 60, 2)
+        self.assertEqual(rolling.total(START + 30 * 60), 3)
+        self.assertEqual(rolling.total(START + HOUR + 60), 2)
+        self.assertEqual(rolling.total(START + 2 * HOUR), 0)
+        return
+
+    def test_bounded(self):
+        """Amounts within resolution are one entry"""
+        rolling = RollingSum(DAY, resolution=60)
+        for second in range(0, 2 * DAY, 5):
+            rolling.add(START + second, 0.01)
+        self.assertLessEqual(len(rolling), DAY / 60 + 1)
+        self.assertAlmostEqual(rolling.total(START + 2 * DAY), DAY / 5 * 0.01,
+                               delta=0.2)
+        return
+
+
+class RollingMaxTest(unittest.TestCase):
+
+    def test_maximum(self):
+        rolling = RollingMax(300)
+        self.assertIsNone(rolling.maximum(START))
+        for second, value in [(0, 5), (60, 12), (120, 7), (180, 3)]:
+            rolling.add(START + second, value)
+        # 5 is dropped by the larger 12
+        self.assertEqual(len(rolling), 3)
+        self.assertEqual(rolling.maximum(START + 180), 12)
+        self.assertEqual(rolling.maximum(START + 361), 7)
+        self.assertEqual(rolling.maximum(START + 421), 3)
+        self.assertIsNone(rolling.maximum(START + 481))
+        return
+
+
+class StationAggregatesTest(unittest.TestCase):
+
+    def test_rain(self):
+        aggregates = StationAggregates()
+        self.assertEqual(aggregates.fields(START), {})
+
+        # Gauge in inches read every 5 minutes
+        for minute, total in [(0, 1.00), (5, 1.05), (10, 1.10), (75, 1.12)]:
+            aggregates.add_rain_total(START + minute * 60, total)
+        fields = aggregates.fields(START + 75 * 60)
+        self.assertEqual(fields['rainfall_rate_hour'], 2)
+        self.assertEqual(fields['rainfall_rate_day'], 12)
+        self.assertEqual(fields['rainfall_rate_midnight'], 12)
+
+        # Gauge reset
+        aggregates.add_rain_total(START + 80 * 60, 0.03)
+        self.assertEqual(aggregates.fields(START + 80 * 60)
+                         ['rainfall_rate_day'], 15)
+
+        # Next day
+        fields = aggregates.fields(START + 20 * HOUR)
+        self.assertEqual(fields['rainfall_rate_midnight'], 0)
+        self.assertEqual(fields['rainfall_rate_day'], 15)
+        return
+
+    def test_gust(self):
+        aggregates = StationAggregates(gust_window=300)
+        aggregates.add_wind(START, 8.4)
+        aggregates.add_wind(START + 60, 4)
+        self.assertEqual(aggregates.fields(START + 60),
+                         {'peak_instantaneous_wind_velocity': 8})
+        self.assertEqual(aggregates.fields(START + 400),
+                         {})
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(RollingSumTest())
+    unittest.main(RollingMaxTest())
+    unittest.main(StationAggregatesTest())
@@ -0,0 +1,1002 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:02:11 2026
+
+Helpers shared by the BACnet HTTP server front-ends
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+# Third party imports
+from bacpypes.task import FunctionTask
+from bacpypes.iocb import IOCB
+from bacpypes.apdu import (ReadPropertyRequest, ReadPropertyACK,
+                           ReadPropertyMultipleRequest,
+                           ReadPropertyMultipleACK, PropertyReference,
+                           ReadAccessSpecification, RejectPDU, AbortPDU,
+                           AbortReason, SubscribeCOVRequest)
+from bacpypes.pdu import PDUData
+from bacpypes.primitivedata import (TagList, Atomic, CharacterString,
+                                    OctetString, Unsigned, ObjectIdentifier)
+from bacpypes.constructeddata import Array
+from bacpypes.basetypes import PropertyIdentifier
+from bacpypes.object import get_datatype, get_object_class
+
+# Local imports
+
+# Declarations
+# Maximum APDU accepted by a device that has not sent an I-Am. This is the
+# smallest maximum of any data link (MS/TP)
+DEFAULT_MAX_APDU = 480
+# Rough encoded size of one property in a ReadPropertyMultipleACK. An object
+# identifier, property identifier, opening and closing tags and a primitive
+# value
+READ_RESULT_SIZE = 24
+# Size of the confirmed request / complex ack header
+APDU_HEADER_SIZE = 5
+# Encoded size of an object identifier and the opening and closing tags
+# around its properties in a ReadPropertyMultiple request or response
+OBJECT_SIZE = 7
+# Encoded size of a property identifier and the opening and closing tags
+# around its value in a ReadPropertyMultipleACK
+PROPERTY_RESULT_SIZE = 5
+# Guesses of the encoded size of values whose length is not known until they
+# are read
+STRING_VALUE_SIZE = 64
+CONSTRUCTED_VALUE_SIZE = 256
+# Property 'all' and unknown properties
+ALL_PROPERTIES_SIZE = 1024
+# Seconds before trying again after a failed COV subscription
+COV_RETRY_INTERVAL = 30
+# Abort reasons of a batch whose request or response was too large. The
+# reads of the batch are sent one at a time instead. Other aborts, like
+# noResponse from a device that did not answer, fail the reads
+BATCH_TOO_LARGE_ABORTS = frozenset(
+    AbortReason.enumerations[reason] for reason in
+    ('bufferOverflow', 'segmentationNotSupported', 'apduTooLong'))
+# Validated readpropertymultiple bodies kept by compile_read_plan
+READ_PLAN_CACHE_SIZE = 256
+
+
+def iocb_future(iocb, loop=None):
+    """Return an asyncio future that resolves when an IOCB completes
+    IOCBs are completed in the BACnet application thread, so the result is
+    handed to the event loop with call_soon_threadsafe. Add the future before
+    the IOCB is given to the application so the completion is not missed
+
+    inputs
+    -------
+    iocb : (bacpypes.iocb.IOCB) control block that has not completed
+    loop : (asyncio.AbstractEventLoop) loop that awaits the result. Defaults
+        to the current event loop
+    outputs
+    -------
+    future : (asyncio.Future) resolves to the completed IOCB. Check
+        iocb.ioError and iocb.ioResponse the same way as after iocb.wait()
+
+    Example
+    -------
+    iocb = IOCB(request)
+    future = iocb_future(iocb)
+    deferred(this_application.request_io, iocb)
+    iocb = await future
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def _resolve(iocb):
+        if not future.done():
+            future.set_result(iocb)
+        return
+
+    def _callback(iocb):
+        # Called from the BACnet thread
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(_resolve, iocb)
+        return
+
+    iocb.add_callback(_callback)
+
+    return future
+
+
+class PresentValueCache:
+    """Process-wide cache of decoded property values read over the BACnet
+    network. Entries are keyed by
+    (address, objectIdentifier, propertyIdentifier, propertyArrayIndex)
+    and are fresh for ttl seconds. When the cache holds more than max_size
+    entries the least recently used entry is dropped. Safe to use from many
+    request threads
+
+    Example
+    -------
+    cache = PresentValueCache(ttl=1.0, max_size=1024)
+    key = ('101:2', ('analogInput', 1), 'presentValue', None)
+    hit, value = cache.get(key)
+    if not hit:
+        value = read_from_device()
+        cache.put(key, value)
+    """
+
+    def __init__(self, ttl=1.0, max_size=1024):
+        """
+        inputs
+        -------
+        ttl : (float) seconds a value is served from the cache. A ttl of 0
+            disables the cache
+        max_size : (int) maximum number of cached values
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        return
+
+    def get(self, key, max_age=None):
+        """Look up a cached value
+        inputs
+        -------
+        key : (tuple) (address, objectIdentifier, propertyIdentifier,
+            propertyArrayIndex)
+        max_age : (float) oldest value in seconds the caller accepts.
+            Defaults to the cache ttl. 0 always misses
+        outputs
+        -------
+        (hit, value) : (tuple) hit is True when a fresh value was found
+        """
+        if max_age is None:
+            max_age = self.ttl
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (time.monotonic() - entry[0]) <= max_age \
+                    and max_age > 0:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+
+        return False, None
+
+    def put(self, key, value):
+        """Store a freshly read value"""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return
+
+    def stats(self):
+        """Hit and miss counters for reporting
+        outputs
+        -------
+        stats : (dict) of hits, misses, size, ttl, max_size"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'ttl': self.ttl,
+                    'max_size': self.max_size}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight:
+    """Share one pending IOCB between identical BACnet requests. The first
+    request for a key is sent on the network. Requests for the same key that
+    arrive before it completes attach to the pending IOCB instead of sending
+    their own. Safe to use from many request threads
+
+    Example
+    -------
+    inflight = SingleFlight()
+    iocb, leader = inflight.join(key, lambda: IOCB(request))
+    if leader:
+        deferred(this_application.request_io, iocb)
+    iocb.wait()
+    value = inflight.decode(iocb, decode_function)
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def join(self, key, make_iocb):
+        """Find the pending IOCB for key or make a new one
+        inputs
+        -------
+        key : (hashable) identifies identical requests
+        make_iocb : (callable) returns a new IOCB for the request. Only called
+            when no identical request is pending
+        outputs
+        -------
+        (iocb, leader) : (tuple) leader is True when the caller made the IOCB
+            and must give it to the application
+        """
+        with self._lock:
+            iocb = self._pending.get(key)
+            if iocb is not None:
+                self.shared += 1
+                return iocb, False
+            iocb = make_iocb()
+            self._pending[key] = iocb
+
+        iocb.add_callback(self._complete, key)
+
+        return iocb, True
+
+    def _complete(self, iocb, key):
+        # Later requests must send their own request
+        with self._lock:
+            if self._pending.get(key) is iocb:
+                del self._pending[key]
+        return
+
+    @staticmethod
+    def decode(iocb, decode):
+        """Decode iocb.ioResponse once and share the result with every
+        request attached to the IOCB. The result must not be modified"""
+        try:
+            return iocb.decodedResponse
+        except AttributeError:
+            pass
+        iocb.decodedResponse = decode(iocb.ioResponse)
+        return iocb.decodedResponse
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending),
+                    'shared': self.shared}
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def decode_property_value(object_type, property_identifier, array_index,
+                          value):
+    """Convert an Any property value to a python value
+    inputs
+    -------
+    object_type : (str) like 'analogInput'
+    property_identifier : (str) like 'presentValue'
+    array_index : (int) or None
+    value : (bacpypes.constructeddata.Any)
+    """
+    datatype = get_datatype(object_type, property_identifier)
+    if datatype is None:
+        raise TypeError("unknown datatype")
+
+    # special case for array parts, others are managed by cast_out
+    if issubclass(datatype, Array) and (array_index is not None):
+        if array_index == 0:
+            datatype = Unsigned
+        else:
+            datatype = datatype.subtype
+
+    return value.cast_out(datatype)
+
+
+def encoded_size(sequence):
+    """Number of octets in the encoding of a bacpypes Sequence like a
+    ReadAccessSpecification"""
+    tag_list = TagList()
+    sequence.encode(tag_list)
+    data = PDUData()
+    tag_list.encode(data)
+    return len(data.pduData)
+
+
+def estimate_value_size(object_type, property_identifier, array_index=None):
+    """Estimate the encoded size of a property value before it is read.
+    Fixed size primitive values are exact. Strings, lists, arrays and the
+    property 'all' are guesses"""
+    datatype = get_datatype(object_type, property_identifier)
+    if datatype is None:
+        return ALL_PROPERTIES_SIZE
+
+    if issubclass(datatype, Array) and array_index is not None:
+        if array_index == 0:
+            # Length of the array
+            return 5
+        datatype = datatype.subtype
+
+    if issubclass(datatype, (CharacterString, OctetString)):
+        return STRING_VALUE_SIZE
+    elif issubclass(datatype, Atomic):
+        # Tag and at most 4 octets (Real, Unsigned, Enumerated, Date...)
+        return 5
+    return CONSTRUCTED_VALUE_SIZE
+
+
+@functools.lru_cache(maxsize=READ_PLAN_CACHE_SIZE)
+def compile_read_plan(plan):
+    """Validate the objects and properties of a readpropertymultiple
+    request. The result is cached, so a body sent every poll is only
+    validated the first time. Raises ValueError with a message for the
+    client if an object or property is not valid. Errors are not cached
+
+    inputs
+    -------
+    plan : (tuple) of (object, property) string pairs like
+        (('analogValue:1', 'presentValue'), ('analogValue:2', 'all'))
+    outputs
+    -------
+    read_plan : (tuple) of (object identifier, property identifier) pairs
+        like ((('analogValue', 1), 'presentValue'), (('analogValue', 2), 'all'))
+    """
+    read_plan = []
+
+    for obj, prop_id in plan:
+        try:
+            # What is the object identifier?
+            obj_id = ObjectIdentifier(obj).value
+            # Get the object type
+            if not get_object_class(obj_id[0]):
+                raise ValueError()
+        except ValueError:
+            # The passed value is not a valid BACnet object type
+            raise ValueError(_invalid_object_msg(obj))
+
+        if prop_id not in PropertyIdentifier.enumerations:
+            # Invalid property identifier - usually 'presentValue' or 'all'
+            raise ValueError(_invalid_property_msg())
+
+        # Object datatype
+        datatype = get_datatype(obj_id[0], prop_id)
+        if (datatype is None) and (prop_id != 'all'):
+            # For converting between BACnet data types and pyton types
+            msg = ('Invalid combination of BACnet object type and property ID '+
+                   'Got {}, {}'.format(str(obj_id), str(prop_id))
+                   )
+            raise ValueError(msg)
+
+        read_plan.append((tuple(obj_id), prop_id))
+
+    return tuple(read_plan)
+
+
+def compile_read_access_specs(plan):
+    """Build the read access specifications of a readpropertymultiple
+    request. Objects and properties must be strings. They are validated by
+    compile_read_plan, and new specifications are built for every request
+    so the caller may change them. Raises ValueError with a message for the
+    client if an object or property is not valid
+
+    inputs
+    -------
+    plan : (iterable) of (object, property) pairs like
+        (('analogValue:1', 'presentValue'), ('analogValue:2', 'all'))
+    outputs
+    -------
+    read_access_spec_list : (list) of bacpypes.apdu.ReadAccessSpecification
+    """
+    plan = tuple((obj, prop_id) for obj, prop_id in plan)
+    for obj, prop_id in plan:
+        if not isinstance(obj, str):
+            raise ValueError(_invalid_object_msg(obj))
+        if not isinstance(prop_id, str):
+            raise ValueError(_invalid_property_msg())
+
+    # Array index not supported for this API - just get the whole array
+    read_access_spec_list = [
+        ReadAccessSpecification(
+            objectIdentifier=obj_id,
+            listOfPropertyReferences=[PropertyReference(
+                propertyIdentifier=prop_id)])
+        for obj_id, prop_id in compile_read_plan(plan)]
+
+    return read_access_spec_list
+
+
+def _invalid_object_msg(obj):
+    return ('The requested Object Identifier is not a valid BACnet '+
+            'object type. Got {}'.format(str(obj)))
+
+
+def _invalid_property_msg():
+    return ('Invalid BACnet property. Valid propery must be one of '+
+            '{}'.format(str(PropertyIdentifier.enumerations.keys())))
+
+
+def split_read_access_specs(read_access_spec_list, max_apdu=DEFAULT_MAX_APDU,
+                            segmentation='noSegmentation', max_segments=1):
+    """Split the read access specifications of a ReadPropertyMultipleRequest
+    into groups that each fit in one request to a device. Requests are never
+    segmented and must fit in max_apdu. The estimated acknowledgement must
+    fit in max_apdu, or in max_segments segments if the device can transmit
+    segmented responses. Properties of one object may be split across groups
+
+    inputs
+    -------
+    read_access_spec_list : (list) of bacpypes.apdu.ReadAccessSpecification
+    max_apdu : (int) maxApduLengthAccepted of the device
+    segmentation : (str) segmentationSupported of the device
+    max_segments : (int) segments of a response the client accepts
+    outputs
+    -------
+    groups : (list) of lists of ReadAccessSpecification. A property that does
+        not fit by itself is put in a group alone
+    """
+    request_limit = max_apdu - APDU_HEADER_SIZE
+    if segmentation in ('segmentedBoth', 'segmentedTransmit'):
+        response_limit = request_limit * max(max_segments, 1)
+    else:
+        response_limit = request_limit
+
+    groups = []
+    group = []
+    request_size = response_size = 0
+
+    for read_access_spec in read_access_spec_list:
+        obj_id = read_access_spec.objectIdentifier
+        prop_reference_list = None
+
+        for prop_reference in read_access_spec.listOfPropertyReferences:
+            # Exact size of the request and estimated size of the response
+            # of this property
+            property_request_size = encoded_size(ReadAccessSpecification(
+                objectIdentifier=obj_id,
+                listOfPropertyReferences=[prop_reference])) - OBJECT_SIZE
+            property_response_size = PROPERTY_RESULT_SIZE + \
+                estimate_value_size(obj_id[0],
+                                    prop_reference.propertyIdentifier,
+                                    prop_reference.propertyArrayIndex)
+            if prop_reference_list is None:
+                # The object identifier is repeated in each group
+                property_request_size += OBJECT_SIZE
+                property_response_size += OBJECT_SIZE
+
+            if group and (
+                    request_size + property_request_size > request_limit or
+                    response_size + property_response_size > response_limit):
+                # Start a new group
+                groups.append(group)
+                group = []
+                request_size = response_size = 0
+                if prop_reference_list is not None:
+                    property_request_size += OBJECT_SIZE
+                    property_response_size += OBJECT_SIZE
+                prop_reference_list = None
+
+            if prop_reference_list is None:
+                prop_reference_list = []
+                group.append(ReadAccessSpecification(
+                    objectIdentifier=obj_id,
+                    listOfPropertyReferences=prop_reference_list))
+            prop_reference_list.append(prop_reference)
+            request_size += property_request_size
+            response_size += property_response_size
+
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def request_io_bounded(request_io, iocbs, limit):
+    """Give IOCBs to the application with at most limit of them pending at a
+    time. The next IOCB is given when one completes. IOCBs that complete
+    before they are given (timed out) are skipped. Call from the BACnet
+    application thread
+
+    inputs
+    -------
+    request_io : (callable) like this_application.request_io
+    iocbs : (list) of bacpypes.iocb.IOCB
+    limit : (int) maximum number of pending IOCBs
+    """
+    waiting = list(reversed(iocbs))
+
+    def _next(_iocb=None):
+        while waiting:
+            iocb = waiting.pop()
+            if iocb.ioComplete.is_set():
+                continue
+            iocb.add_callback(_next)
+            request_io(iocb)
+            return
+        return
+
+    for _ in range(max(limit, 1)):
+        _next()
+
+    return
+
+
+class ReadBatcher:
+    """Merge single property reads to the same device into one
+    ReadPropertyMultipleRequest. The first read to a device opens a batch and
+    every read to that device within window seconds joins it. When the window
+    closes the batch is sent and the ReadPropertyMultipleACK is split back
+    into one ReadPropertyACK per read, so callers decode the result of a
+    batched read the same way as a single read
+
+    Batches are sized so the acknowledgement fits in the maxApduLengthAccepted
+    of the device. A batch aborted because it was too large is read one at a
+    time. A device that rejects ReadPropertyMultiple is remembered and later
+    reads to it are sent one at a time. All methods run in the BACnet
+    application thread
+
+    Example
+    -------
+    batcher = ReadBatcher(this_application.request_io, window=0.01,
+                          device_info=device_info)
+    iocb = IOCB(read_property_request)
+    deferred(batcher.request_io, iocb)  # Instead of this_application.request_io
+    iocb.wait()
+    """
+
+    def __init__(self, request_io, window=0.0, device_info=None):
+        """
+        inputs
+        -------
+        request_io : (callable) gives an IOCB to the BACnet application like
+            this_application.request_io
+        window : (float) seconds to collect reads to the same device. A window
+            of 0 disables batching
+        device_info : (callable) called with the device address and returns
+            (maxApduLengthAccepted, segmentationSupported). Defaults to
+            DEFAULT_MAX_APDU without segmentation
+        """
+        self.window = window
+        self.batches = 0
+        self.batched = 0
+        self._request_io = request_io
+        self._device_info = device_info
+        self._pending = {}
+        self._single_read_devices = set()
+
+        return
+
+    def request_io(self, iocb):
+        """Send the ReadPropertyRequest of iocb with the next batch to its
+        device. Other requests are given directly to the application.
+        Call from the BACnet application thread (see bacpypes.core.deferred)
+        """
+        request = iocb.args[0]
+        address = request.pduDestination
+        if self.window <= 0 or not isinstance(request, ReadPropertyRequest) \
+                or address in self._single_read_devices:
+            self._request_io(iocb)
+            return
+
+        batch = self._pending.get(address)
+        if batch is None:
+            batch = self._pending[address] = []
+            self._schedule(address)
+        batch.append(iocb)
+
+        return
+
+    def _schedule(self, address):
+        FunctionTask(self.flush, address).install_task(delta=self.window)
+        return
+
+    def max_batch_size(self, address):
+        """Number of single reads that fit in one request to a device"""
+        if self._device_info is None:
+            max_apdu = DEFAULT_MAX_APDU
+        else:
+            max_apdu, _segmentation = self._device_info(address)
+        return max(1, (max_apdu - APDU_HEADER_SIZE) // READ_RESULT_SIZE)
+
+    def flush(self, address):
+        """Send the pending batch of a device"""
+        batch = self._pending.pop(address, [])
+
+        # Reads that timed out while waiting are not sent
+        batch = [iocb for iocb in batch if not iocb.ioComplete.is_set()]
+
+        if len(batch) == 1:
+            self._request_io(batch[0])
+            return
+
+        size = self.max_batch_size(address)
+        for i in range(0, len(batch), size):
+            self._send_batch(address, batch[i:i+size])
+
+        return
+
+    def _send_batch(self, address, batch):
+        if len(batch) == 1:
+            self._request_io(batch[0])
+            return
+
+        read_access_spec_list = []
+        for iocb in batch:
+            request = iocb.args[0]
+            read_access_spec_list.append(ReadAccessSpecification(
+                objectIdentifier=request.objectIdentifier,
+                listOfPropertyReferences=[PropertyReference(
+                    propertyIdentifier=request.propertyIdentifier,
+                    propertyArrayIndex=request.propertyArrayIndex,
+                    )]
+                ))
+
+        request = ReadPropertyMultipleRequest(
+            listOfReadAccessSpecs=read_access_spec_list)
+        request.pduDestination = address
+
+        self.batches += 1
+        self.batched += len(batch)
+
+        batch_iocb = IOCB(request)
+        batch_iocb.add_callback(self._complete, address, batch)
+        self._request_io(batch_iocb)
+
+        return
+
+    def _complete(self, batch_iocb, address, batch):
+        """Answer every read of a batch from the ReadPropertyMultipleACK"""
+        error = batch_iocb.ioError
+        if isinstance(error, RejectPDU) or (
+                isinstance(error, AbortPDU) and
+                error.apduAbortRejectReason in BATCH_TOO_LARGE_ABORTS):
+            # Unrecognized service, or the response did not fit. Read one
+            # at a time instead
+            if isinstance(error, RejectPDU):
+                self._single_read_devices.add(address)
+            for iocb in batch:
+                if not iocb.ioComplete.is_set():
+                    self._request_io(iocb)
+            return
+
+        response = batch_iocb.ioResponse
+        if error is None and not isinstance(response, ReadPropertyMultipleACK):
+            error = TypeError("Expected a ReadPropertyMultipleACK, got {}"\
+                              .format(type(response)))
+
+        results = {}
+        if error is None:
+            for result in response.listOfReadAccessResults:
+                for element in result.listOfResults:
+                    key = (tuple(result.objectIdentifier),
+                           element.propertyIdentifier,
+                           element.propertyArrayIndex)
+                    results[key] = element.readResult
+
+        for iocb in batch:
+            if iocb.ioComplete.is_set():
+                # Timed out
+                continue
+            if error is not None:
+                iocb.abort(error)
+                continue
+
+            request = iocb.args[0]
+            read_result = results.get((tuple(request.objectIdentifier),
+                                       request.propertyIdentifier,
+                                       request.propertyArrayIndex))
+            if read_result is None:
+                iocb.abort(RuntimeError("Property missing from response"))
+            elif read_result.propertyAccessError:
+                iocb.abort(read_result.propertyAccessError)
+            else:
+                apdu = ReadPropertyACK(
+                    objectIdentifier=request.objectIdentifier,
+                    propertyIdentifier=request.propertyIdentifier,
+                    propertyArrayIndex=request.propertyArrayIndex,
+                    propertyValue=read_result.propertyValue,
+                    )
+                apdu.pduSource = address
+                iocb.complete(apdu)
+
+        return
+
+    def stats(self):
+        return {'batches': self.batches,
+                'batched': self.batched}
+
+
+class COVSubscription:
+    """One object subscribed with SubscribeCOV"""
+
+    def __init__(self, address, object_identifier, process_identifier):
+        self.address = address
+        self.objectIdentifier = tuple(object_identifier)
+        self.processIdentifier = process_identifier
+        # time.monotonic() when the subscription lapses. 0 until the device
+        # accepts the subscription
+        self.expires = 0
+        self.notifications = 0
+
+        return
+
+    def __repr__(self):
+        return "<COVSubscription {} {} expires={:.0f}>".format(
+            self.address, self.objectIdentifier, self.expires)
+
+
+class COVValueStore:
+    """Subscribe to change of value notifications of objects and keep the
+    notified property values. Values are served while the subscription is
+    alive, so reads of subscribed objects need no network traffic.
+    Subscriptions are renewed before their lifetime runs out and retried
+    after COV_RETRY_INTERVAL seconds when the device refuses them
+
+    subscribe, notification and the renewals run in the BACnet application
+    thread. get is safe to use from many request threads
+
+    Example
+    -------
+    cov = COVValueStore(this_application.request_io, lifetime=300)
+    deferred(cov.subscribe, Address('192.168.1.100'), ('analogInput', 1))
+    ...
+    # In do_UnconfirmedCOVNotificationRequest of the application
+    cov.notification(apdu)
+    ...
+    hit, value = cov.get(('192.168.1.100', ('analogInput', 1),
+                          'presentValue', None))
+    """
+
+    def __init__(self, request_io, lifetime=300, confirmed=False,
+                 on_change=None):
+        """
+        inputs
+        -------
+        request_io : (callable) gives an IOCB to the BACnet application like
+            this_application.request_io
+        lifetime : (int) seconds each subscription lasts. Subscriptions are
+            renewed when 80% of the lifetime has passed
+        confirmed : (bool) ask for confirmed notifications
+        on_change : (callable) called with a dict of {key: value} of each
+            notification, like ChangeFeed.publish
+        """
+        self.lifetime = lifetime
+        self.confirmed = confirmed
+        self.on_change = on_change
+        self._request_io = request_io
+        self._subscriptions = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def subscribe(self, address, object_identifier):
+        """Subscribe to an object and keep the subscription alive
+        inputs
+        -------
+        address : (bacpypes.pdu.Address) of the device
+        object_identifier : (tuple) like ('analogInput', 1)
+        outputs
+        -------
+        subscription : (COVSubscription)
+        """
+        with self._lock:
+            process_identifier = len(self._subscriptions) + 1
+            subscription = COVSubscription(address, object_identifier,
+                                           process_identifier)
+            self._subscriptions[process_identifier] = subscription
+        self._send(subscription)
+
+        return subscription
+
+    def _send(self, subscription):
+        request = SubscribeCOVRequest(
+            subscriberProcessIdentifier=subscription.processIdentifier,
+            monitoredObjectIdentifier=subscription.objectIdentifier,
+            issueConfirmedNotifications=self.confirmed,
+            lifetime=self.lifetime,
+            )
+        request.pduDestination = subscription.address
+
+        iocb = IOCB(request)
+        iocb.add_callback(self._subscribed, subscription)
+        self._request_io(iocb)
+
+        return
+
+    def _subscribed(self, iocb, subscription):
+        if iocb.ioError:
+            # Values are stale without a subscription
+            with self._lock:
+                subscription.expires = 0
+            self._schedule(COV_RETRY_INTERVAL, subscription)
+            return
+
+        with self._lock:
+            subscription.expires = time.monotonic() + self.lifetime
+        self._schedule(self.lifetime * 0.8, subscription)
+
+        return
+
+    def _schedule(self, delay, subscription):
+        FunctionTask(self._send, subscription).install_task(delta=delay)
+        return
+
+    def notification(self, apdu):
+        """Store the values of a Confirmed or
+        UnconfirmedCOVNotificationRequest
+        outputs
+        -------
+        stored : (bool) False if the notification is not for one of the
+            subscriptions"""
+        subscription = self._subscriptions.get(
+            apdu.subscriberProcessIdentifier)
+        obj_id = tuple(apdu.monitoredObjectIdentifier)
+        if subscription is None or subscription.objectIdentifier != obj_id:
+            return False
+
+        values = {}
+        for property_value in apdu.listOfValues:
+            prop_id = property_value.propertyIdentifier
+            array_index = property_value.propertyArrayIndex
+            try:
+                value = decode_property_value(obj_id[0], prop_id, array_index,
+                                              property_value.value)
+            except TypeError:
+                # Proprietary property
+                continue
+            if hasattr(value, "dict_contents"):
+                value = value.dict_contents(as_class=OrderedDict)
+            values[(str(subscription.address), obj_id, prop_id,
+                    array_index)] = (subscription, value)
+
+        with self._lock:
+            self._values.update(values)
+            subscription.notifications += 1
+
+        if self.on_change is not None:
+            self.on_change({key: value for key, (_subscription, value)
+                            in values.items()})
+
+        return True
+
+    def get(self, key):
+        """Look up a notified value
+        inputs
+        -------
+        key : (tuple) (address, objectIdentifier, propertyIdentifier,
+            propertyArrayIndex) like the PresentValueCache key
+        outputs
+        -------
+        (hit, value) : (tuple) hit is True when the object has a live
+            subscription and the property was notified
+        """
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0].expires < time.monotonic():
+                return False, None
+            return True, entry[1]
+
+    def stats(self):
+        """Subscriptions for reporting"""
+        now = time.monotonic()
+        with self._lock:
+            return {'subscriptions': len(self._subscriptions),
+                    'active': sum(1 for subscription in
+                                  self._subscriptions.values()
+                                  if subscription.expires >= now),
+                    'notifications': sum(subscription.notifications
+                                         for subscription in
+                                         self._subscriptions.values())}
+
+
+class ChangeFeed:
+    """Fan out changed property values to streaming clients. A poller or
+    COV notifications publish values, and each subscriber is called only
+    with the values that changed since the last publish. A subscriber first
+    receives the known values of its keys. Safe to use from many threads
+
+    Example
+    -------
+    feed = ChangeFeed()
+    events = queue.Queue()
+    token = feed.subscribe([key], events.put)
+    feed.publish({key: 72.5})  # events.get() -> {key: 72.5}
+    feed.publish({key: 72.5})  # No event, the value did not change
+    feed.unsubscribe(token)
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._last = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+
+        return
+
+    def subscribe(self, keys, callback):
+        """Call callback with changed values of keys
+        inputs
+        -------
+        keys : (iterable) of (address, objectIdentifier, propertyIdentifier,
+            propertyArrayIndex) like the PresentValueCache key
+        callback : (callable) called with a dict of {key: value}. Called from
+            the publishing thread, so it must not block
+        outputs
+        -------
+        token : (int) to unsubscribe
+        """
+        keys = frozenset(keys)
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._subscribers[token] = (keys, callback)
+            known = {key: self._last[key] for key in keys if key in self._last}
+
+        if known:
+            callback(known)
+
+        return token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+            # Values nobody watches are stale when someone watches again
+            watched = self._watched()
+            for key in list(self._last):
+                if key not in watched:
+                    del self._last[key]
+        return
+
+    def _watched(self):
+        watched = set()
+        for keys, _callback in self._subscribers.values():
+            watched.update(keys)
+        return watched
+
+    def watched(self):
+        """Keys with at least one subscriber"""
+        with self._lock:
+            return self._watched()
+
+    def publish(self, values):
+        """Give freshly read values to the subscribers of the values that
+        changed. Each subscriber is called once with its changed values
+        inputs
+        -------
+        values : (dict) of {key: value}
+        outputs
+        -------
+        changed : (dict) of the values that changed"""
+        with self._lock:
+            changed = {key: value for key, value in values.items()
+                       if key not in self._last or self._last[key] != value}
+            events = []
+            for keys, callback in self._subscribers.values():
+                event = {key: value for key, value in changed.items()
+                         if key in keys}
+                if event:
+                    events.append((callback, event))
+            watched = self._watched()
+            self._last.update((key, value) for key, value in changed.items()
+                              if key in watched)
+
+        for callback, event in events:
+            callback(event)
+
+        return changed
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers),
+                    'watched': len(self._watched())}
+
+    def __len__(self):
+        return len(self._subscribers)
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:14:36 2026
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import threading
+import time
+import unittest
+
+# Third party imports
+from bacpypes.iocb import IOCB
+from bacpypes.pdu import Address
+from bacpypes.apdu import (ReadPropertyRequest, ReadPropertyMultipleRequest,
+                           ReadPropertyMultipleACK, ReadAccessResult,
+                           ReadAccessResultElement,
+                           ReadAccessResultElementChoice, RejectPDU,
+                           AbortPDU,
+                           ReadAccessSpecification, PropertyReference,
+                           UnconfirmedCOVNotificationRequest)
+from bacpypes.basetypes import ErrorType, PropertyValue, StatusFlags
+from bacpypes.constructeddata import Any
+from bacpypes.primitivedata import Real
+
+# Local imports
+from bacnet_utils import (iocb_future, PresentValueCache, SingleFlight,
+                          ReadBatcher, compile_read_access_specs,
+                          compile_read_plan, split_read_access_specs,
+                          request_io_bounded,
+                          encoded_size, COVValueStore, ChangeFeed)
+
+
+#%%
+
+
+class IOCBFutureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        return
+
+    def tearDown(self):
+        self.loop.close()
+        return
+
+    def test_complete_from_thread(self):
+        iocb = IOCB()
+        future = iocb_future(iocb, self.loop)
+
+        # IOCBs are completed by the BACnet thread
+        thread = threading.Thread(target=iocb.complete, args=('response',))
+        self.loop.call_soon(thread.start)
+        result = self.loop.run_until_complete(
+            asyncio.wait_for(future, timeout=2))
+
+        self.assertIs(result, iocb)
+        self.assertEqual(result.ioResponse, 'response')
+        self.assertIsNone(result.ioError)
+        thread.join()
+
+        return
+
+    def test_abort(self):
+        iocb = IOCB()
+        future = iocb_future(iocb, self.loop)
+        iocb.abort(RuntimeError('timeout'))
+        result = self.loop.run_until_complete(
+            asyncio.wait_for(future, timeout=2))
+
+        self.assertIsNone(result.ioResponse)
+        self.assertEqual(str(result.ioError), 'timeout')
+
+        return
+
+    def test_already_complete(self):
+        iocb = IOCB()
+        iocb.complete('response')
+        future = iocb_future(iocb, self.loop)
+        result = self.loop.run_until_complete(
+            asyncio.wait_for(future, timeout=2))
+
+        self.assertEqual(result.ioResponse, 'response')
+
+        return
+
+
+class PresentValueCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        global key
+        key = ('101:2', ('analogInput', 1), 'presentValue', None)
+        return
+
+    def test_hit_miss(self):
+        cache = PresentValueCache(ttl=10, max_size=10)
+        self.assertEqual(cache.get(key), (False, None))
+        cache.put(key, 72.5)
+        self.assertEqual(cache.get(key), (True, 72.5))
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+        return
+
+    def test_max_age(self):
+        cache = PresentValueCache(ttl=10, max_size=10)
+        cache.put(key, 72.5)
+
+        # X-bacnet-max-age: 0 bypasses the cache
+        self.assertEqual(cache.get(key, max_age=0), (False, None))
+        self.assertEqual(cache.get(key, max_age=5), (True, 72.5))
+
+        return
+
+    def test_expire(self):
+        cache = PresentValueCache(ttl=0.01, max_size=10)
+        cache.put(key, 72.5)
+        time.sleep(0.02)
+        self.assertEqual(cache.get(key), (False, None))
+
+        # Disabled cache
+        cache = PresentValueCache(ttl=0, max_size=10)
+        cache.put(key, 72.5)
+        self.assertEqual(len(cache), 0)
+
+        return
+
+    def test_lru(self):
+        cache = PresentValueCache(ttl=10, max_size=2)
+        key2 = ('101:2', ('analogInput', 2), 'presentValue', None)
+        key3 = ('101:2', ('analogInput', 3), 'presentValue', None)
+        cache.put(key, 1)
+        cache.put(key2, 2)
+        # Use key so key2 is the least recently used
+        cache.get(key)
+        cache.put(key3, 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(key), (True, 1))
+        self.assertEqual(cache.get(key2), (False, None))
+        self.assertEqual(cache.get(key3), (True, 3))
+
+        return
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_join(self):
+        inflight = SingleFlight()
+        iocb1, leader1 = inflight.join('key', IOCB)
+        iocb2, leader2 = inflight.join('key', IOCB)
+        iocb3, leader3 = inflight.join('other', IOCB)
+
+        # The second identical request shares the pending IOCB
+        self.assertTrue(leader1)
+        self.assertFalse(leader2)
+        self.assertIs(iocb1, iocb2)
+        self.assertTrue(leader3)
+        self.assertIsNot(iocb1, iocb3)
+        self.assertEqual(inflight.stats(), {'pending': 2, 'shared': 1})
+
+        # Completed requests are not shared
+        iocb1.complete('response')
+        iocb4, leader4 = inflight.join('key', IOCB)
+        self.assertTrue(leader4)
+        self.assertIsNot(iocb1, iocb4)
+
+        return
+
+    def test_abort(self):
+        inflight = SingleFlight()
+        iocb, leader = inflight.join('key', IOCB)
+        iocb.abort(RuntimeError('timeout'))
+        self.assertEqual(len(inflight), 0)
+        return
+
+    def test_decode(self):
+        calls = []
+        def decode(response):
+            calls.append(response)
+            return response.upper()
+
+        iocb = IOCB()
+        iocb.complete('response')
+        self.assertEqual(SingleFlight.decode(iocb, decode), 'RESPONSE')
+        self.assertEqual(SingleFlight.decode(iocb, decode), 'RESPONSE')
+        self.assertEqual(len(calls), 1)
+
+        return
+
+
+class FakeDevice:
+    """Answers requests like BIPSimpleApplication.request_io. The device has
+    analogInput 1 to 10 with presentValue equal to the instance number"""
+
+    def __init__(self, reject_rpm=False, abort_rpm=None):
+        """
+        inputs
+        -------
+        reject_rpm : (bool) reject ReadPropertyMultiple requests
+        abort_rpm : (str) abort ReadPropertyMultiple requests with this
+            reason
+        """
+        self.requests = []
+        self.reject_rpm = reject_rpm
+        self.abort_rpm = abort_rpm
+        return
+
+    def request_io(self, iocb):
+        request = iocb.args[0]
+        self.requests.append(request)
+
+        if isinstance(request, ReadPropertyRequest):
+            iocb.complete(request.objectIdentifier[1])
+            return
+
+        if self.reject_rpm:
+            iocb.abort(RejectPDU(reason='unrecognizedService'))
+            return
+        if self.abort_rpm:
+            iocb.abort(AbortPDU(False, 1, self.abort_rpm))
+            return
+
+        results = []
+        for read_access_spec in request.listOfReadAccessSpecs:
+            obj_id = read_access_spec.objectIdentifier
+            prop_reference = read_access_spec.listOfPropertyReferences[0]
+            if obj_id[1] > 10:
+                read_result = ReadAccessResultElementChoice(
+                    propertyAccessError=ErrorType(
+                        errorClass='object', errorCode='unknownObject'))
+            else:
+                read_result = ReadAccessResultElementChoice(
+                    propertyValue=Any(Real(obj_id[1])))
+            results.append(ReadAccessResult(
+                objectIdentifier=obj_id,
+                listOfResults=[ReadAccessResultElement(
+                    propertyIdentifier=prop_reference.propertyIdentifier,
+                    readResult=read_result)]))
+        iocb.complete(ReadPropertyMultipleACK(listOfReadAccessResults=results))
+
+        return
+
+
+class ManualReadBatcher(ReadBatcher):
+    """Batches are flushed by the test instead of the task manager"""
+
+    def _schedule(self, address):
+        return
+
+
+class ReadBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.address = Address('127.0.0.2:47809')
+        return
+
+    def _read(self, batcher, instance):
+        request = ReadPropertyRequest(
+            objectIdentifier=('analogInput', instance),
+            propertyIdentifier='presentValue')
+        request.pduDestination = self.address
+        iocb = IOCB(request)
+        batcher.request_io(iocb)
+        return iocb
+
+    def test_batch(self):
+        device = FakeDevice()
+        batcher = ManualReadBatcher(device.request_io, window=0.01)
+        iocbs = [self._read(batcher, i) for i in (1, 2, 11)]
+        # Nothing is sent until the window closes
+        self.assertEqual(device.requests, [])
+        batcher.flush(self.address)
+
+        self.assertEqual(len(device.requests), 1)
+        self.assertIsInstance(device.requests[0], ReadPropertyMultipleRequest)
+        self.assertEqual(iocbs[0].ioResponse.propertyValue.cast_out(Real), 1)
+        self.assertEqual(iocbs[1].ioResponse.propertyValue.cast_out(Real), 2)
+        self.assertEqual(iocbs[1].ioResponse.objectIdentifier,
+                         ('analogInput', 2))
+        # Property access errors abort only their own read
+        self.assertEqual(iocbs[2].ioError.errorCode, 'unknownObject')
+        self.assertEqual(batcher.stats(), {'batches': 1, 'batched': 3})
+
+        return
+
+    def test_split(self):
+        device = FakeDevice()
+        batcher = ManualReadBatcher(
+            device.request_io, window=0.01,
+            device_info=lambda address: (50, 'noSegmentation'))
+        iocbs = [self._read(batcher, i) for i in range(1, 6)]
+        batcher.flush(self.address)
+
+        # One read fits in a 50 octet APDU
+        self.assertEqual(batcher.max_batch_size(self.address), 1)
+        self.assertEqual(len(device.requests), 5)
+
+        batcher = ManualReadBatcher(
+            device.request_io, window=0.01,
+            device_info=lambda address: (100, 'noSegmentation'))
+        device.requests = []
+        iocbs = [self._read(batcher, i) for i in range(1, 6)]
+        batcher.flush(self.address)
+        self.assertEqual(batcher.max_batch_size(self.address), 3)
+        self.assertEqual(len(device.requests), 2)
+        self.assertTrue(all(iocb.ioResponse for iocb in iocbs))
+
+        return
+
+    def test_reject(self):
+        device = FakeDevice(reject_rpm=True)
+        batcher = ManualReadBatcher(device.request_io, window=0.01)
+        iocbs = [self._read(batcher, i) for i in (1, 2)]
+        batcher.flush(self.address)
+
+        # Read one at a time after the reject
+        self.assertEqual([iocb.ioResponse for iocb in iocbs], [1, 2])
+        self.assertEqual(len(device.requests), 3)
+        iocb = self._read(batcher, 3)
+        self.assertEqual(iocb.ioResponse, 3)
+
+        return
+
+    def test_abort(self):
+        # The response did not fit. Read one at a time
+        device = FakeDevice(abort_rpm='segmentationNotSupported')
+        batcher = ManualReadBatcher(device.request_io, window=0.01)
+        iocbs = [self._read(batcher, i) for i in (1, 2)]
+        batcher.flush(self.address)
+        self.assertEqual([iocb.ioResponse for iocb in iocbs], [1, 2])
+        self.assertEqual(len(device.requests), 3)
+
+        # The device did not answer. The reads fail without being sent again
+        device = FakeDevice(abort_rpm='noResponse')
+        batcher = ManualReadBatcher(device.request_io, window=0.01)
+        iocbs = [self._read(batcher, i) for i in (1, 2)]
+        batcher.flush(self.address)
+        self.assertEqual(len(device.requests), 1)
+        for iocb in iocbs:
+            self.assertIsInstance(iocb.ioError, AbortPDU)
+            self.assertEqual(str(iocb.ioError), 'noResponse')
+
+        return
+
+    def test_disabled(self):
+        device = FakeDevice()
+        batcher = ManualReadBatcher(device.request_io, window=0)
+        iocb = self._read(batcher, 1)
+        self.assertEqual(iocb.ioResponse, 1)
+        return
+
+
+class SplitReadAccessSpecsTest(unittest.TestCase):
+
+    def _specs(self, count, properties=('presentValue', 'objectName')):
+        return [ReadAccessSpecification(
+            objectIdentifier=('analogInput', i),
+            listOfPropertyReferences=[
+                PropertyReference(propertyIdentifier=prop_id)
+                for prop_id in properties])
+            for i in range(1, count + 1)]
+
+    def _properties(self, groups):
+        return [(tuple(spec.objectIdentifier), prop_reference.propertyIdentifier)
+                for group in groups
+                for spec in group
+                for prop_reference in spec.listOfPropertyReferences]
+
+    def test_fits(self):
+        specs = self._specs(3)
+        groups = split_read_access_specs(specs, max_apdu=1476)
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(self._properties(groups), self._properties([specs]))
+        return
+
+    def test_split(self):
+        specs = self._specs(40)
+        groups = split_read_access_specs(specs, max_apdu=480)
+
+        self.assertGreater(len(groups), 1)
+        # Every property is read once and in order
+        self.assertEqual(self._properties(groups), self._properties([specs]))
+        for group in groups:
+            request_size = sum(encoded_size(spec) for spec in group)
+            self.assertLessEqual(request_size, 480)
+
+        # Segmented responses fit more in each request
+        segmented = split_read_access_specs(
+            specs, max_apdu=480, segmentation='segmentedBoth',
+            max_segments=16)
+        self.assertLess(len(segmented), len(groups))
+
+        return
+
+    def test_all(self):
+        # A property too large for the device is read by itself
+        specs = self._specs(2, properties=('all',))
+        groups = split_read_access_specs(specs, max_apdu=480)
+        self.assertEqual(len(groups), 2)
+        return
+
+
+class CompileReadAccessSpecsTest(unittest.TestCase):
+
+    def test_compile(self):
+        plan = (('analogValue:1', 'presentValue'), ('analogInput:2', 'all'))
+        specs = compile_read_access_specs(plan)
+        self.assertEqual(
+            [(tuple(spec.objectIdentifier),
+              spec.listOfPropertyReferences[0].propertyIdentifier)
+             for spec in specs],
+            [(('analogValue', 1), 'presentValue'),
+             (('analogInput', 2), 'all')])
+        return
+
+    def test_cached(self):
+        """The same plan is validated once. Each request gets specifications
+        of its own"""
+        plan = (('analogValue:3', 'presentValue'),)
+        specs = compile_read_access_specs(plan)
+        hits = compile_read_plan.cache_info().hits
+        again = compile_read_access_specs(list(plan))
+        self.assertEqual(compile_read_plan.cache_info().hits, hits + 1)
+
+        self.assertIsNot(again[0], specs[0])
+        specs[0].listOfPropertyReferences[0].propertyIdentifier = 'all'
+        specs.append(specs[0])
+        self.assertEqual(len(compile_read_access_specs(plan)), 1)
+        self.assertEqual(again[0].listOfPropertyReferences[0]
+                         .propertyIdentifier, 'presentValue')
+        return
+
+    def test_invalid(self):
+        invalid = [(('notAnObject:1', 'presentValue'),),
+                   (('analogValue:1', 'notAProperty'),),
+                   # Not a property of the object type
+                   (('analogValue:1', 'listOfGroupMembers'),),
+                   # Not strings
+                   ((['analogValue', 1], 'presentValue'),),
+                   ((1, 'presentValue'),),
+                   (('analogValue:1', ['presentValue']),)]
+        for plan in invalid:
+            with self.subTest(plan=plan):
+                with self.assertRaises(ValueError):
+                    compile_read_access_specs(plan)
+                # Errors are not cached
+                with self.assertRaises(ValueError):
+                    compile_read_access_specs(plan)
+        return
+
+
+class RequestIOBoundedTest(unittest.TestCase):
+
+    def test_limit(self):
+        given = []
+        iocbs = [IOCB() for _ in range(5)]
+        request_io_bounded(given.append, iocbs, limit=2)
+        self.assertEqual(given, iocbs[:2])
+
+        # The next IOCB is given when one completes
+        iocbs[0].complete('response')
+        self.assertEqual(given, iocbs[:3])
+
+        # Timed out IOCBs are skipped
+        iocbs[3].abort(TimeoutError())
+        iocbs[1].complete('response')
+        self.assertEqual(given, iocbs[:3] + iocbs[4:])
+
+        return
+
+
+class ManualCOVValueStore(COVValueStore):
+    """Renewals are recorded instead of scheduled"""
+
+    def _schedule(self, delay, subscription):
+        self.scheduled.append((delay, subscription))
+        return
+
+
+class COVValueStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.address = Address('127.0.0.2:47809')
+        self.requests = []
+        self.refuse = False
+        return
+
+    def request_io(self, iocb):
+        self.requests.append(iocb.args[0])
+        if self.refuse:
+            iocb.abort(RuntimeError('refused'))
+        else:
+            iocb.complete(True)
+        return
+
+    def _store(self, lifetime=300):
+        cov = ManualCOVValueStore(self.request_io, lifetime=lifetime)
+        cov.scheduled = []
+        return cov
+
+    def _notification(self, subscription, value):
+        apdu = UnconfirmedCOVNotificationRequest(
+            subscriberProcessIdentifier=subscription.processIdentifier,
+            initiatingDeviceIdentifier=('device', 20),
+            monitoredObjectIdentifier=subscription.objectIdentifier,
+            timeRemaining=300,
+            listOfValues=[
+                PropertyValue(propertyIdentifier='presentValue',
+                              value=Any(Real(value))),
+                PropertyValue(propertyIdentifier='statusFlags',
+                              value=Any(StatusFlags([0, 0, 0, 0]))),
+                ])
+        apdu.pduSource = self.address
+        return apdu
+
+    def test_notification(self):
+        cov = self._store()
+        subscription = cov.subscribe(self.address, ('analogInput', 1))
+        key = (str(self.address), ('analogInput', 1), 'presentValue', None)
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0].lifetime, 300)
+        # Renewed before the lifetime runs out
+        self.assertEqual(cov.scheduled, [(240, subscription)])
+        self.assertEqual(cov.get(key), (False, None))
+
+        self.assertTrue(cov.notification(self._notification(subscription, 5)))
+        self.assertEqual(cov.get(key), (True, 5))
+        self.assertTrue(cov.get((str(self.address), ('analogInput', 1),
+                                 'statusFlags', None))[0])
+
+        # Notifications for other subscribers are ignored
+        other = self._notification(subscription, 6)
+        other.subscriberProcessIdentifier = 99
+        self.assertFalse(cov.notification(other))
+        self.assertEqual(cov.get(key), (True, 5))
+
+        self.assertEqual(cov.stats(), {'subscriptions': 1, 'active': 1,
+                                       'notifications': 1})
+
+        return
+
+    def test_expired(self):
+        cov = self._store(lifetime=0.01)
+        subscription = cov.subscribe(self.address, ('analogInput', 1))
+        cov.notification(self._notification(subscription, 5))
+        time.sleep(0.02)
+
+        # Values of lapsed subscriptions are stale
+        key = (str(self.address), ('analogInput', 1), 'presentValue', None)
+        self.assertEqual(cov.get(key), (False, None))
+
+        return
+
+    def test_refused(self):
+        self.refuse = True
+        cov = self._store()
+        subscription = cov.subscribe(self.address, ('analogInput', 1))
+        cov.notification(self._notification(subscription, 5))
+
+        key = (str(self.address), ('analogInput', 1), 'presentValue', None)
+        self.assertEqual(cov.get(key), (False, None))
+        # Tried again later
+        self.assertEqual(len(cov.scheduled), 1)
+        self.assertEqual(cov.stats()['active'], 0)
+
+        return
+
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key1 = ('101:2', ('analogInput', 1), 'presentValue', None)
+        self.key2 = ('101:2', ('analogInput', 2), 'presentValue', None)
+        return
+
+    def test_publish(self):
+        feed = ChangeFeed()
+        events1, events2 = [], []
+        token1 = feed.subscribe([self.key1, self.key2], events1.append)
+        feed.subscribe([self.key2], events2.append)
+        self.assertEqual(feed.watched(), {self.key1, self.key2})
+
+        feed.publish({self.key1: 1, self.key2: 2})
+        self.assertEqual(events1, [{self.key1: 1, self.key2: 2}])
+        self.assertEqual(events2, [{self.key2: 2}])
+
+        # Only changed values are sent
+        changed = feed.publish({self.key1: 1, self.key2: 3})
+        self.assertEqual(changed, {self.key2: 3})
+        self.assertEqual(events1[-1], {self.key2: 3})
+        self.assertEqual(len(events2), 2)
+        feed.publish({self.key1: 1, self.key2: 3})
+        self.assertEqual(len(events1), 2)
+
+        feed.unsubscribe(token1)
+        self.assertEqual(feed.watched(), {self.key2})
+        self.assertEqual(feed.stats(), {'subscribers': 1, 'watched': 1})
+
+        return
+
+    def test_known_values(self):
+        feed = ChangeFeed()
+        feed.subscribe([self.key1], lambda values: None)
+        feed.publish({self.key1: 1})
+
+        # New subscribers start with the known values
+        events = []
+        token = feed.subscribe([self.key1, self.key2], events.append)
+        self.assertEqual(events, [{self.key1: 1}])
+        feed.unsubscribe(token)
+
+        return
+
+    def test_cov(self):
+        feed = ChangeFeed()
+        events = []
+        cov = ManualCOVValueStore(lambda iocb: iocb.complete(True),
+                                  on_change=feed.publish)
+        cov.scheduled = []
+        subscription = cov.subscribe(Address('101:2'), ('analogInput', 1))
+        feed.subscribe([self.key1], events.append)
+
+        apdu = UnconfirmedCOVNotificationRequest(
+            subscriberProcessIdentifier=subscription.processIdentifier,
+            initiatingDeviceIdentifier=('device', 20),
+            monitoredObjectIdentifier=('analogInput', 1),
+            timeRemaining=300,
+            listOfValues=[PropertyValue(propertyIdentifier='presentValue',
+                                        value=Any(Real(5)))])
+        cov.notification(apdu)
+        self.assertEqual(events, [{self.key1: 5}])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main(IOCBFutureTest())
+    unittest.main(PresentValueCacheTest())
+    unittest.main(SingleFlightTest())
+    unittest.main(ReadBatcherTest())
+    unittest.main(SplitReadAccessSpecsTest())
+    unittest.main(RequestIOBoundedTest())
+    unittest.main(COVValueStoreTest())
+    unittest.main(ChangeFeedTest())
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Dec 23 19:48:06 2020
+
+Benchmarks of the encode and decode hot paths. Each benchmark is timed
+with timeit, the best of several repeats is kept, and the results are
+compared with a saved baseline so regressions show up as numbers
+
+Example
+-------
+# Save a baseline on this machine
+python benchmarks.py --save
+# After a change, compare with the baseline. The exit status is 1 if a
+# benchmark is slower than the baseline by more than the tolerance
+python benchmarks.py
+python benchmarks.py --filter cwop --tolerance 0.1
+
+@author: z003vrzk
+"""
+
+# Python imports
+import sys
+import json
+import timeit
+import platform
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+DEFAULT_BASELINE_PATH = 'benchmarks_baseline.json'
+# Slower than the baseline by more than this fraction is a regression
+DEFAULT_TOLERANCE = 0.2
+# Repeats of each benchmark. The fastest is kept
+DEFAULT_REPEAT = 5
+# Seconds each repeat runs at least
+MIN_TIME = 0.2
+
+# {name: setup function}. The setup function returns the timed function
+BENCHMARKS = OrderedDict()
+
+#%%
+
+
+def benchmark(name):
+    """Register a setup function as the benchmark name. Imports and test
+    data made by the setup function are not timed"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def _rpm_body(count=20):
+    """A readpropertymultiple request body of count objects"""
+    return {'address':'192.168.1.100',
+            'bacnet_objects':[{'object':'analogInput:{}'.format(i),
+                               'property':'presentValue'}
+                              for i in range(1, count + 1)]}
+
+
+def _rpm_ack(count=20):
+    """A ReadPropertyMultipleACK of count objects with a real present value
+    and a character string name"""
+    from bacpypes.apdu import (ReadPropertyMultipleACK, ReadAccessResult,
+                               ReadAccessResultElement,
+                               ReadAccessResultElementChoice)
+    from bacpypes.constructeddata import Any
+    from bacpypes.primitivedata import Real, CharacterString
+
+    results = []
+    for i in range(1, count + 1):
+        elements = [
+            ReadAccessResultElement(
+                propertyIdentifier='presentValue',
+                readResult=ReadAccessResultElementChoice(
+                    propertyValue=Any(Real(i * 1.5)))),
+            ReadAccessResultElement(
+                propertyIdentifier='objectName',
+                readResult=ReadAccessResultElementChoice(
+                    propertyValue=Any(CharacterString('AI {}'.format(i))))),
+            ]
+        results.append(ReadAccessResult(objectIdentifier=('analogInput', i),
+                                        listOfResults=elements))
+    return ReadPropertyMultipleACK(listOfReadAccessResults=results)
+
+
+@benchmark('cwoppdu_construct')
+def _cwoppdu_construct():
+    from CWOPpdu import CWOPPDU
+    from coordinate import Latitude, Longitude
+    latitude, longitude = Latitude(32.7767), Longitude(-96.7970)
+
+    def run():
+        CWOPPDU(provider_id='FW9999', time='221530', latitude=latitude,
+                longitude=longitude, wind_direction=220, wind_speed=4,
+                peak_instantaneous_wind_velocity=8, temperature=77.3,
+                rainfall_rate_hour=0, rainfall_rate_day=12,
+                rainfall_rate_midnight=10, humidity=52,
+                barometric_pressure=10142)
+    return run
+
+
+@benchmark('cwoppdu_data_packet')
+def _cwoppdu_data_packet():
+    from CWOPpdu import CWOPPDU
+    from coordinate import Latitude, Longitude
+    pdu = CWOPPDU(provider_id='FW9999', time='221530',
+                  latitude=Latitude(32.7767), longitude=Longitude(-96.7970),
+                  temperature=77.3, humidity=52)
+
+    def run():
+        pdu.pdu_data_packet
+    return run
+
+
+@benchmark('cwop_encode_packets_100')
+def _cwop_encode_packets():
+    from CWOPpdu import encode_packets
+    from coordinate import Latitude, Longitude
+    latitude, longitude = Latitude(32.7767), Longitude(-96.7970)
+    times = ['22{:04d}'.format(i) for i in range(100)]
+    temperatures = [70 + i / 10 for i in range(100)]
+
+    def run():
+        encode_packets('FW9999', time=times, latitude=latitude,
+                       longitude=longitude, temperature=temperatures,
+                       humidity=52)
+    return run
+
+
+@benchmark('latitude_construct_1000')
+def _latitude_construct():
+    from coordinate import Latitude
+    # Construction of a new value, not an interned one
+    values = [30 + i / 997 for i in range(1000)]
+    create = Latitude._create
+
+    def run():
+        for value in values:
+            create(value)
+    return run
+
+
+@benchmark('longitude_construct_interned')
+def _longitude_construct_interned():
+    from coordinate import Longitude
+
+    def run():
+        Longitude(-96.7970)
+    return run
+
+
+@benchmark('latitude_to_string')
+def _latitude_to_string():
+    from coordinate import Latitude
+    latitude = Latitude(32.7767)
+
+    def run():
+        latitude.to_string('%d%M%H')
+    return run
+
+
+@benchmark('to_aprs_latitude_1000')
+def _to_aprs_latitude():
+    from coordinate import to_aprs_latitude
+    values = [30 + i / 997 for i in range(1000)]
+
+    def run():
+        to_aprs_latitude(values)
+    return run
+
+
+@benchmark('form_ReadPropertyMultiple_request_20')
+def _form_ReadPropertyMultiple_request():
+    from bacpypes.pdu import Address
+    from bacpypes.apdu import ReadPropertyMultipleRequest
+    from BACnetHTTPServer import _form_read_access_spec_list
+    body_json = _rpm_body()
+
+    def run():
+        # Same steps as HTTPRequestHandler._form_ReadPropertyMultiple_request
+        read_access_spec_list = _form_read_access_spec_list(body_json)
+        request = ReadPropertyMultipleRequest(
+            listOfReadAccessSpecs=read_access_spec_list)
+        request.pduDestination = Address(body_json['address'])
+    return run
+
+
+@benchmark('compile_read_access_specs_20')
+def _compile_read_access_specs():
+    from bacnet_utils import compile_read_access_specs, compile_read_plan
+    body_json = _rpm_body()
+    plan = tuple((bacnet_object['object'], bacnet_object['property'])
+                 for bacnet_object in body_json['bacnet_objects'])
+
+    def run():
+        # Validation of a body that is not cached yet
+        compile_read_plan.cache_clear()
+        compile_read_access_specs(plan)
+    return run
+
+
+@benchmark('ReadPropertyMultipleACK_decode_20')
+def _rpm_ack_decode():
+    from bacpypes.apdu import APDU, ReadPropertyMultipleACK
+    encoded = APDU()
+    _rpm_ack().encode(encoded)
+
+    def run():
+        # As the ACK arrives from the network
+        apdu = APDU()
+        apdu.update(encoded)
+        apdu.pduData = bytearray(encoded.pduData)
+        ReadPropertyMultipleACK().decode(apdu)
+    return run
+
+
+@benchmark('ReadPropertyMultipleACK_cast_out_20')
+def _rpm_ack_cast_out():
+    from BACnetHTTPServer import _decode_ReadPropertyMultiple_response
+    ack = _rpm_ack()
+
+    def run():
+        _decode_ReadPropertyMultiple_response(ack)
+    return run
+
+
+@benchmark('encode_results_json_20')
+def _encode_results_json():
+    from BACnetHTTPServer import (_decode_ReadPropertyMultiple_response,
+                                  _encode_results)
+    results = _decode_ReadPropertyMultiple_response(_rpm_ack())
+
+    def run():
+        _encode_results(results)
+    return run
+
+
+def measure(function, repeat=DEFAULT_REPEAT, min_time=MIN_TIME):
+    """Seconds per call of function. The fastest of repeat runs of at least
+    min_time seconds"""
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        # Grow quickly, with room for timer resolution
+        number = max(number * 2, int(number * min_time * 1.2 /
+                                     max(elapsed, 1e-9)))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+
+def run(names=None, repeat=DEFAULT_REPEAT, min_time=MIN_TIME):
+    """Time the benchmarks
+    inputs
+    -------
+    names : (list) of benchmark names. Defaults to all
+    outputs
+    -------
+    results : (OrderedDict) of {name: seconds per call}"""
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        results[name] = measure(setup(), repeat, min_time)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare results with a baseline
+    outputs
+    -------
+    rows : (list) of (name, seconds, baseline seconds or None, ratio or
+        None, regressed)"""
+    rows = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is None:
+            rows.append((name, seconds, None, None, False))
+            continue
+        ratio = seconds / base
+        rows.append((name, seconds, base, ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def load_baseline(path):
+    """{name: seconds per call} of a saved baseline, or {} if there is
+    none"""
+    try:
+        with open(path) as file:
+            return json.load(file)['results']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    """Save results with the interpreter and machine they were timed on"""
+    baseline = {'python':platform.python_version(),
+                'implementation':platform.python_implementation(),
+                'machine':platform.machine(),
+                'platform':platform.platform(),
+                'results':results}
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=2)
+    return
+
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:8.2f} {}'.format(seconds / scale, unit)
+    return '{:8.0f} ns'.format(seconds / 1e-9)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark the encode and decode '
+                            'hot paths')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH,
+                        help='baseline file')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline. With '
+                        '--filter, only the filtered benchmarks are replaced')
+    parser.add_argument('--filter', default=None,
+                        help='run benchmarks whose name contains this')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown as a fraction of the baseline')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args(argv)
+
+    names = None
+    if args.filter:
+        names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names, repeat=args.repeat)
+
+    if args.save:
+        baseline = results
+        if names is not None:
+            # Keep the baselines of the benchmarks that were not run
+            baseline = load_baseline(args.baseline)
+            baseline.update(results)
+        save_baseline(args.baseline, baseline)
+        for name, seconds in results.items():
+            print('{:40} {}'.format(name, _format_time(seconds)))
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    rows = compare(results, load_baseline(args.baseline), args.tolerance)
+    regressions = 0
+    for name, seconds, base, ratio, regressed in rows:
+        if base is None:
+            change = '  no baseline'
+        else:
+            change = '{:+7.1%}{}'.format(ratio - 1,
+                                         '  REGRESSION' if regressed else '')
+        regressions += regressed
+        print('{:40} {} {}'.format(name, _format_time(seconds), change))
+
+    return 1 if regressions else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Dec 23 21:10:44 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import os
+import tempfile
+import unittest
+
+# Third party imports
+
+# Local imports
+from benchmarks import (BENCHMARKS, measure, run, compare, load_baseline,
+                        save_baseline, main)
+
+# Declarations
+
+#%%
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_benchmarks(self):
+        """Every benchmark runs"""
+        for name, setup in BENCHMARKS.items():
+            with self.subTest(name=name):
+                setup()()
+        return
+
+    def test_measure(self):
+        seconds = measure(lambda: sum(range(100)), repeat=2, min_time=0.01)
+        self.assertGreater(seconds, 0)
+        self.assertLess(seconds, 0.01)
+        return
+
+    def test_baseline(self):
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'baseline.json')
+        self.assertEqual(load_baseline(path), {})
+
+        results = run(['cwoppdu_data_packet'], repeat=1, min_time=0.01)
+        save_baseline(path, results)
+        self.assertEqual(load_baseline(path), results)
+        directory.cleanup()
+        return
+
+    def test_save_filter(self):
+        """Saving filtered results keeps the other baselines"""
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'baseline.json')
+        save_baseline(path, {'cwoppdu_construct':1.0, 'other':2.0})
+        main(['--save', '--baseline', path, '--filter',
+              'cwoppdu_data_packet', '--repeat', '1'])
+        baseline = load_baseline(path)
+        self.assertEqual(set(baseline), {'cwoppdu_construct', 'other',
+                                         'cwoppdu_data_packet'})
+        self.assertEqual(baseline['other'], 2.0)
+        directory.cleanup()
+        return
+
+    def test_compare(self):
+        rows = compare({'fast':1.0, 'slow':1.5, 'new':1.0},
+                       {'fast':1.1, 'slow':1.0}, tolerance=0.2)
+        self.assertEqual([row[4] for row in rows], [False, True, False])
+        self.assertIsNone(rows[2][2])
+        self.assertAlmostEqual(rows[1][3], 1.5)
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(BenchmarksTest())
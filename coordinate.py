@@ -9,6 +9,7 @@ Created on Mon Oct 26 16:31:17 2020
 import math
 import re
 import abc
+import functools
 
 
 
@@ -74,27 +75,66 @@ that fell the past hour. The letter "p" followed by 3 numbers represents the
 
 
 """"3. What is the APRS latitude/longitude position format? """
+# Coordinates created from decimal degrees that are kept for reuse
+INTERN_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=INTERN_CACHE_SIZE)
+def _intern(cls, decimal_degree):
+    return cls._create(decimal_degree)
+
+
+def _unpickle(cls, decimal_degree, degree, minute, second):
+    """Recreate a pickled coordinate. A coordinate created from decimal
+    degrees is interned again. One created from degree, minute and second is
+    created from them, because decimal degrees round the second"""
+    coordinate = cls(decimal_degree)
+    if (coordinate.degree, coordinate.minute, coordinate.second) == \
+            (degree, minute, second):
+        return coordinate
+    return cls._create(degree, minute, second)
+
+
 class APRSCoordinate(object):
     """APRS Latitude and Longitude position format
     LORAN position format
     about 60 feet resolution on the findu.com maps
     The format is "ddmm.hhN/dddmm.hhW
+
+    Coordinates are immutable. A coordinate created from decimal degrees is
+    interned, so a station's Latitude(29.75232) is the same object with the
+    same cached APRS string each time it is created
     """
+    __slots__ = ('degree', 'minute', 'second', 'decimal_degree',
+                 'decimal_minute', '_aprs')
 
-    def __init__(self, *args, **kwargs):
+    def __new__(cls, *args, **kwargs):
         """
         inputs
         -------
         Either *args must be an iterable of (degree, minute, second), or
         **kwargs must contain the keys {'degree','minute','second'}"""
+        if len(args) == 1 and not kwargs:
+            try:
+                hash(args[0])
+            except TypeError:
+                # Not hashable, like a list of (degree, minute, second)
+                pass
+            else:
+                return _intern(cls, args[0])
+        return cls._create(*args, **kwargs)
+
+    @classmethod
+    def _create(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        decimal_degree = None
 
         if kwargs:
             try:
                 if 'decimal_degree' in kwargs.keys():
                     decimal_degree = kwargs['decimal_degree']
-                    self.decimal_degree = decimal_degree
                     degree, minute, second = \
-                        self._calc_degree_minute_second(self.decimal_degree)
+                        self._calc_degree_minute_second(decimal_degree)
 
                 elif 'degree' in kwargs.keys():
                     degree = kwargs['degree']
@@ -108,9 +148,9 @@ class APRSCoordinate(object):
 
         elif args:
             if len(args) == 1:
-                self.decimal_degree = args[0]
+                decimal_degree = args[0]
                 degree, minute, second = \
-                    self._calc_degree_minute_second(self.decimal_degree)
+                    self._calc_degree_minute_second(decimal_degree)
 
             else:
                 try:
@@ -135,17 +175,45 @@ class APRSCoordinate(object):
                    "negative number")
             raise ValueError(msg)
 
-        self.degree = float(degree)
-        self.minute = abs(float(minute))
-        self.second = abs(float(second))
-        if not 'decimal_degree' in self.__dict__:
-            self.decimal_degree = self._calc_decimaldegree(float(degree),
-                                                           float(minute),
-                                                           float(second))
-        _, self.decimal_minute = self._calc_decimal_minute(float(degree),
-                                                           float(minute),
-                                                           float(second))
-        return
+        if decimal_degree is None:
+            decimal_degree = self._calc_decimaldegree(float(degree),
+                                                      float(minute),
+                                                      float(second))
+        _, decimal_minute = self._calc_decimal_minute(float(degree),
+                                                      float(minute),
+                                                      float(second))
+        set_attribute = object.__setattr__
+        set_attribute(self, 'degree', float(degree))
+        set_attribute(self, 'minute', abs(float(minute)))
+        set_attribute(self, 'second', abs(float(second)))
+        set_attribute(self, 'decimal_degree', decimal_degree)
+        set_attribute(self, 'decimal_minute', decimal_minute)
+        set_attribute(self, '_aprs', None)
+
+        return self
+
+    def __setattr__(self, name, value):
+        msg="{} is immutable".format(type(self).__name__)
+        raise AttributeError(msg)
+
+    def __delattr__(self, name):
+        msg="{} is immutable".format(type(self).__name__)
+        raise AttributeError(msg)
+
+    def __reduce__(self):
+        return (_unpickle, (type(self), self.decimal_degree, self.degree,
+                            self.minute, self.second))
+
+    @property
+    def aprs(self):
+        """Coordinate in the APRS format of a packet, like 'ddmm.hhN' or
+        'dddmm.hhW'"""
+        if self._aprs is None:
+            aprs = self._aprs_format.format(abs(self.degree),
+                                            self.decimal_minute,
+                                            self.get_hemisphere())
+            object.__setattr__(self, '_aprs', aprs)
+        return self._aprs
 
 
     @staticmethod
@@ -209,7 +277,8 @@ class APRSCoordinate(object):
             degree = math.ceil(decimal_degree)
         else:
             degree = math.floor(decimal_degree)
-        minute = decimal_degree % 1 * 60
+        # The fraction of a negative coordinate counts away from zero
+        minute = abs(decimal_degree) % 1 * 60
         second = minute % 1 * 60
         return (degree, math.floor(minute), round(second))
 
@@ -263,13 +332,6 @@ class APRSCoordinate(object):
             coord_str = coord_str.replace('-', '')
         return coord_str
 
-    def _update(self, degree, minute, second):
-        self.decimal_minute = self.\
-            _calc_decimal_minute(degree, minute, second)
-        self.decimal_degree = self.\
-            _calc_decimaldegree(degree, minute, second)
-        return
-
     def __neg__(self):
         return APRSCoordinate(-self.decimal_degree)
 
@@ -326,6 +388,8 @@ class APRSCoordinate(object):
 
 class Latitude(APRSCoordinate):
     """Latidude Coordinates"""
+    __slots__ = ()
+    _aprs_format = '{:02.0f}{:05.2f}{}'
 
     def get_hemisphere(self):
         '''
@@ -335,21 +399,14 @@ class Latitude(APRSCoordinate):
         else: return 'N'
 
     def set_hemisphere(self, hemi_str):
-        """Given a hemisphere identifier, set the sign of the coordinate to
-        match that hemisphere"""
+        """Given a hemisphere identifier, return the coordinate with the sign
+        of that hemisphere"""
         if hemi_str == 'S':
-            self.degree = abs(self.degree)*-1
-            self.minute = abs(self.minute)
-            self.second = abs(self.second)
-            self._update(self.degree, self.minute, self.second)
+            return self._create(-abs(self.degree), self.minute, self.second)
         elif hemi_str == 'N':
-            self.degree = abs(self.degree)
-            self.minute = abs(self.minute)
-            self.second = abs(self.second)
-            self._update(self.degree, self.minute, self.second)
+            return self._create(abs(self.degree), self.minute, self.second)
         else:
             raise ValueError("Hemisphere must be one of ('N','S')")
-        return
 
     def __repr__(self):
         return "Latitude({})".format(self.decimal_degree)
@@ -361,9 +418,8 @@ class Longitude(APRSCoordinate):
     Coordinate object specific for longitude coordinates
     Langitudes outside the range -180 to 180
     """
-
-    def __init__(self, *args, **kwargs):
-        super(Longitude, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    _aprs_format = '{:03.0f}{:05.2f}{}'
 
     def get_hemisphere(self):
         '''
@@ -374,33 +430,122 @@ class Longitude(APRSCoordinate):
 
     def set_hemisphere(self, hemi_str):
         '''
-        Given a hemisphere identifier, set the sign of the coordinate to match that hemisphere
+        Given a hemisphere identifier, return the coordinate with the sign of that hemisphere
         '''
         if hemi_str == 'W':
-            self.degree = abs(self.degree)*-1
-            self.minute = abs(self.minute)
-            self.second = abs(self.second)
-            self._update(self.degree, self.minute, self.second)
+            return self._create(-abs(self.degree), self.minute, self.second)
         elif hemi_str == 'E':
-            self.degree = abs(self.degree)
-            self.minute = abs(self.minute)
-            self.second = abs(self.second)
-            self._update(self.degree, self.minute, self.second)
+            return self._create(abs(self.degree), self.minute, self.second)
         else:
-            raise(ValueError, "Hemisphere must be one of ('E','W')")
-        return
+            raise ValueError("Hemisphere must be one of ('E','W')")
 
     def __repr__(self):
         return "Longitude({})".format(self.decimal_degree)
 
 
 
+#%% Conversion of many coordinates at once
 
+"""The functions below convert lists of coordinates without creating a
+Latitude or Longitude for each coordinate. Their results are the same as
+the Latitude and Longitude attributes, and the APRS strings are the same as
+CWOPPDU._check_latitude and CWOPPDU._check_longitude"""
 
+def _degree_decimal_minute(decimal_degree):
+    """(degree, decimal_minute) of a coordinate like Latitude(decimal_degree)
+    """
+    if decimal_degree < 0:
+        degree = math.ceil(decimal_degree)
+    else:
+        degree = math.floor(decimal_degree)
+    minute = abs(decimal_degree) % 1 * 60
+    second = round(minute % 1 * 60)
+    return float(degree), float(math.floor(minute)) + abs(second / 60)
 
 
+def to_degree_minute_second(decimal_degrees):
+    """
+    inputs
+    -------
+    decimal_degrees : (iterable) of float
+    outputs
+    -------
+    coordinates : (list) of (degree, minute, second) like
+        APRSCoordinate._calc_degree_minute_second"""
+    calc = APRSCoordinate._calc_degree_minute_second
+    return [calc(decimal_degree) for decimal_degree in decimal_degrees]
+
+
+def to_decimal_degree(coordinates):
+    """
+    inputs
+    -------
+    coordinates : (iterable) of (degree, minute, second)
+    outputs
+    -------
+    decimal_degrees : (list) of float like
+        APRSCoordinate._calc_decimaldegree"""
+    calc = APRSCoordinate._calc_decimaldegree
+    return [calc(degree, minute, second)
+            for degree, minute, second in coordinates]
+
+
+def to_aprs_latitude(decimal_degrees):
+    """
+    inputs
+    -------
+    decimal_degrees : (iterable) of float
+    outputs
+    -------
+    latitudes : (list) of str in the APRS format 'ddmm.hhN'
+    """
+    format_latitude = '{:02.0f}{:05.2f}{}'.format
+    latitudes = []
+    for decimal_degree in decimal_degrees:
+        degree, decimal_minute = _degree_decimal_minute(decimal_degree)
+        latitudes.append(format_latitude(abs(degree), decimal_minute,
+                                         'S' if decimal_degree < 0 else 'N'))
+    return latitudes
 
 
-
-
-
+def to_aprs_longitude(decimal_degrees):
+    """
+    inputs
+    -------
+    decimal_degrees : (iterable) of float
+    outputs
+    -------
+    longitudes : (list) of str in the APRS format 'dddmm.hhW'
+    """
+    format_longitude = '{:03.0f}{:05.2f}{}'.format
+    longitudes = []
+    for decimal_degree in decimal_degrees:
+        degree, decimal_minute = _degree_decimal_minute(decimal_degree)
+        longitudes.append(format_longitude(abs(degree), decimal_minute,
+                                           'W' if decimal_degree < 0 else 'E'))
+    return longitudes
+
+
+def from_aprs(coordinates):
+    """Decimal degrees of APRS latitudes 'ddmm.hhN' or longitudes
+    'dddmm.hhW'
+    inputs
+    -------
+    coordinates : (iterable) of str
+    outputs
+    -------
+    decimal_degrees : (list) of float. Southern and western coordinates are
+        negative"""
+    decimal_degrees = []
+    for coordinate in coordinates:
+        hemisphere = coordinate[-1]
+        if hemisphere not in 'NSEW' or not coordinate[-4] == '.':
+            msg='Coordinate must follow format "ddmm.hhN" or "dddmm.hhW". '+\
+                'Got {}'.format(coordinate)
+            raise ValueError(msg)
+        # Minutes are the 5 characters before the hemisphere
+        decimal_degree = int(coordinate[:-6]) + float(coordinate[-6:-1]) / 60
+        if hemisphere in 'SW':
+            decimal_degree = -decimal_degree
+        decimal_degrees.append(decimal_degree)
+    return decimal_degrees
@@ -2,10 +2,15 @@
 
 
 # Python imports
+import copy
+import pickle
 import unittest
 
 # Local imports
-from coordinate import APRSCoordinate, Latitude, Longitude
+from coordinate import (APRSCoordinate, Latitude, Longitude,
+                        to_degree_minute_second, to_decimal_degree,
+                        to_aprs_latitude, to_aprs_longitude, from_aprs)
+from CWOPpdu import CWOPPDU
 
 
 
@@ -171,14 +176,14 @@ class LatitudeTest(unittest.TestCase):
 
         # North latitudes run 0,90 degrees
         lat = Latitude(latitude[0], latitude[1], latitude[2])
-        lat.set_hemisphere('S')
+        lat = lat.set_hemisphere('S')
         self.assertEqual(lat.degree, -latitude[0])
         self.assertEqual(lat.decimal_degree, -lat_dd)
 
 
         # South latitudes run 0,-90 degrees
         lat = Latitude(-latitude[0], latitude[1], latitude[2])
-        lat.set_hemisphere('N')
+        lat = lat.set_hemisphere('N')
         self.assertEqual(lat.degree, latitude[0])
         self.assertEqual(lat.decimal_degree, lat_dd)
 
@@ -254,3 +259,126 @@ class Test(object):
         # Self._a is independent of b
         self._b = value
         self._c = self._a + value / 2
+
+
+
+class ImmutableCoordinateTest(unittest.TestCase):
+
+    def test_interned(self):
+        self.assertIs(Latitude(29.752320), Latitude(29.752320))
+        self.assertIsNot(Latitude(29.752320), Longitude(29.752320))
+        self.assertIsNot(Latitude(12, 34, 56), Latitude(12, 34, 56))
+        return
+
+    def test_create_once(self):
+        """A TypeError while creating the coordinate is raised after one
+        attempt"""
+        class CountedLatitude(Latitude):
+            __slots__ = ()
+            created = []
+
+            @classmethod
+            def _create(cls, *args, **kwargs):
+                cls.created.append(args)
+                return super()._create(*args, **kwargs)
+
+        with self.assertRaises(TypeError):
+            CountedLatitude('29.752320')
+        self.assertEqual(CountedLatitude.created, [('29.752320',)])
+        return
+
+    def test_immutable(self):
+        lat = Latitude(29.752320)
+        with self.assertRaises(AttributeError):
+            lat.degree = 12
+        with self.assertRaises(AttributeError):
+            lat.other = 12
+        self.assertFalse(hasattr(lat, '__dict__'))
+        self.assertAlmostEqual(lat.set_hemisphere('S').decimal_degree,
+                               -lat.decimal_degree, places=3)
+        self.assertEqual(lat.decimal_degree, 29.752320)
+        return
+
+    def test_aprs(self):
+        self.assertEqual(Latitude(29.752320).aprs, '2945.13N')
+        self.assertEqual(Latitude(-12.582222222).aprs, '1234.93S')
+        self.assertEqual(Longitude(-95.458310).aprs, '09527.50W')
+        lon = Longitude(16, 25, 34)
+        self.assertIs(lon.aprs, lon.aprs)
+        return
+
+    def test_pickle(self):
+        lon = Longitude(-95.458310)
+        copied = pickle.loads(pickle.dumps(lon))
+        self.assertIsInstance(copied, Longitude)
+        self.assertEqual(copied.aprs, lon.aprs)
+        # Interned again
+        self.assertIs(copied, lon)
+
+        coordinates = [Latitude(32.7767), Longitude(-96.797),
+                       Latitude(29.123456789), Latitude(-12, 34, 56.7),
+                       Longitude(16, 25, 34)]
+        for coordinate in coordinates:
+            for copied in (pickle.loads(pickle.dumps(coordinate)),
+                           copy.copy(coordinate), copy.deepcopy(coordinate)):
+                with self.subTest(coordinate=coordinate):
+                    self.assertEqual(copied.decimal_degree,
+                                     coordinate.decimal_degree)
+                    self.assertEqual((copied.degree, copied.minute,
+                                      copied.second),
+                                     (coordinate.degree, coordinate.minute,
+                                      coordinate.second))
+        return
+
+
+class ConversionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decimal_degrees = [12.582222222222223, -12.582222222222223,
+                                29.752320, -95.458310, 0.0, -0.5, 179.99]
+        return
+
+    def test_degree_minute_second(self):
+        coordinates = to_degree_minute_second(self.decimal_degrees)
+        self.assertEqual(coordinates[0], (12, 34, 56))
+        self.assertEqual(coordinates[3], (-95, 27, 30))
+        for coordinate, decimal_degree in zip(coordinates,
+                                              self.decimal_degrees):
+            aprs = APRSCoordinate(decimal_degree)
+            self.assertEqual(coordinate,
+                             (aprs.degree, aprs.minute, aprs.second))
+
+        decimal_degrees = to_decimal_degree([(12, 34, 56), (-12, 34, 56)])
+        self.assertAlmostEqual(decimal_degrees[0], 12.582222, places=6)
+        self.assertAlmostEqual(decimal_degrees[1], -12.582222, places=6)
+        return
+
+    def test_aprs(self):
+        """The same strings as CWOPPDU formats Latitude and Longitude"""
+        latitudes = to_aprs_latitude(self.decimal_degrees[:-1])
+        longitudes = to_aprs_longitude(self.decimal_degrees)
+        pdu = CWOPPDU('FW8400', latitude='2945.13N', longitude='09527.50W')
+        self.assertEqual(latitudes, [pdu._check_latitude(Latitude(value))
+                                     for value in self.decimal_degrees[:-1]])
+        self.assertEqual(longitudes, [pdu._check_longitude(Longitude(value))
+                                      for value in self.decimal_degrees])
+        self.assertEqual(latitudes[:4], ['1234.93N', '1234.93S',
+                                         '2945.13N', '9527.50S'])
+        self.assertEqual(longitudes[3], '09527.50W')
+        return
+
+    def test_from_aprs(self):
+        decimal_degrees = from_aprs(['1234.93N', '1234.93S', '09527.50W',
+                                     '17959.40E'])
+        for result, test in zip(decimal_degrees, [12.582167, -12.582167,
+                                                  -95.458333, 179.99]):
+            self.assertAlmostEqual(result, test, places=5)
+        with self.assertRaises(ValueError):
+            from_aprs(['1234.93X'])
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(ImmutableCoordinateTest())
+    unittest.main(ConversionTest())
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Dec 24 10:17:33 2020
+
+Load test of BACnetHTTPServer without a controller. A simulated BACnet/IP
+device with analog input objects runs in this process on the loopback
+interface, next to the BACnet application and HTTP server of
+BACnetHTTPServer. Client threads send a mix of requests to the HTTP server
+for a while, and the requests per second, latency percentiles and error
+rate of each kind of request are reported
+
+Example
+-------
+python loadtest.py --clients 8 --duration 10 --mix read=3,rpm=1
+python loadtest.py --latency 0.05 --loss 0.01 --asyncio
+
+@author: z003vrzk
+"""
+
+# Python imports
+import sys
+import json
+import math
+import time
+import random
+import threading
+from argparse import ArgumentParser
+
+# Third party imports
+import requests
+from bacpypes.core import run as run_bacnet, stop as stop_bacnet
+from bacpypes.app import BIPSimpleApplication
+from bacpypes.local.device import LocalDeviceObject
+from bacpypes.object import AnalogInputObject
+from bacpypes.service.object import ReadWritePropertyMultipleServices
+from bacpypes.task import FunctionTask
+
+# Local imports
+import BACnetHTTPServer
+from weather_utils import make_http_session
+
+# Declarations
+# BACnet/IP addresses on the loopback interface. Separate hosts, so each
+# application has its own broadcast socket
+CLIENT_ADDRESS = '127.0.0.1/8:47808'
+DEVICE_ADDRESS = '127.0.0.2/8:47809'
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 18080
+# Kinds of request and how often each is sent
+DEFAULT_MIX = {'read':3, 'rpm':1}
+REQUEST_KINDS = ('read', 'rpm', 'cache')
+
+#%%
+
+
+class SimulatedDevice(BIPSimpleApplication, ReadWritePropertyMultipleServices):
+    """A BACnet/IP device with analog input objects 1 to objects. Answers
+    ReadProperty and ReadPropertyMultiple requests after latency seconds,
+    and does not answer a fraction loss of them
+
+    Example
+    -------
+    device = SimulatedDevice('127.0.0.2/8:47809', objects=20, latency=0.02)
+    # Requests are answered while bacpypes.core.run() runs
+    """
+
+    def __init__(self, address, device_id=599, objects=20, latency=0,
+                 loss=0, seed=None):
+        """
+        inputs
+        -------
+        address : (str) BACnet/IP address like '127.0.0.2/8:47809'
+        device_id : (int) device object instance
+        objects : (int) analog input objects
+        latency : (float) seconds before each response, or (minimum,
+            maximum) seconds of a random latency
+        loss : (float) fraction of requests that are not answered
+        seed : random seed of the latency and loss
+        """
+        device = LocalDeviceObject(
+            objectName='Simulated device {}'.format(device_id),
+            objectIdentifier=('device', device_id),
+            maxApduLengthAccepted=1024,
+            segmentationSupported='segmentedBoth',
+            vendorIdentifier=15)
+        super().__init__(device, address)
+        for instance in range(1, objects + 1):
+            self.add_object(AnalogInputObject(
+                objectIdentifier=('analogInput', instance),
+                objectName='Analog input {}'.format(instance),
+                presentValue=float(instance),
+                units='degreesFahrenheit'))
+
+        self.latency = latency
+        self.loss = loss
+        self.received = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+
+        return
+
+    def _respond(self, handler, apdu):
+        """Answer apdu with handler after the latency, unless it is lost"""
+        self.received += 1
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        if isinstance(self.latency, (list, tuple)):
+            delay = self._random.uniform(*self.latency)
+        else:
+            delay = self.latency
+        if delay > 0:
+            FunctionTask(handler, apdu).install_task(delta=delay)
+        else:
+            handler(apdu)
+        return
+
+    def do_ReadPropertyRequest(self, apdu):
+        self._respond(super().do_ReadPropertyRequest, apdu)
+        return
+
+    def do_ReadPropertyMultipleRequest(self, apdu):
+        self._respond(super().do_ReadPropertyMultipleRequest, apdu)
+        return
+
+
+def close_application(application):
+    """Close the sockets of a bacpypes application"""
+    application.mux.directPort.handle_close()
+    if application.mux.broadcastPort:
+        application.mux.broadcastPort.handle_close()
+    return
+
+
+class QuietHandler(BACnetHTTPServer.HTTPRequestHandler):
+    """HTTPRequestHandler without a log line for each request"""
+
+    def log_message(self, format, *args):
+        return
+
+
+class LoadTest:
+    """The simulated device, the BACnet application and HTTP server of
+    BACnetHTTPServer, and the client threads
+
+    Example
+    -------
+    load_test = LoadTest(latency=0.02)
+    load_test.start()
+    samples, elapsed = load_test.run(clients=8, duration=10)
+    print(format_report(summarize(samples, elapsed)))
+    load_test.stop()
+    """
+
+    def __init__(self, objects=20, latency=0, loss=0, use_asyncio=False,
+                 http_port=HTTP_PORT, client_address=CLIENT_ADDRESS,
+                 device_address=DEVICE_ADDRESS, cache_ttl=0, seed=None):
+        """
+        inputs
+        -------
+        objects, latency, loss, seed : see SimulatedDevice
+        use_asyncio : (bool) serve HTTP with AsyncHTTPServer instead of a
+            thread per request
+        cache_ttl : (float) seconds of the present value cache. 0 sends
+            every read to the device
+        """
+        self.objects = objects
+        self.latency = latency
+        self.loss = loss
+        self.use_asyncio = use_asyncio
+        self.http_port = http_port
+        self.client_address = client_address
+        self.device_address = device_address
+        self.cache_ttl = cache_ttl
+        self.seed = seed
+        # The address of the device in requests, without the mask
+        host, port = device_address.split(':')
+        self.device = '{}:{}'.format(host.split('/')[0], port)
+        self.url = 'http://{}:{}'.format(HTTP_HOST, http_port)
+
+        self.simulated_device = None
+        self.application = None
+        self.server = None
+        self._threads = []
+
+        return
+
+    def start(self):
+        """Start the device, the BACnet application and the HTTP server"""
+        self.simulated_device = SimulatedDevice(
+            self.device_address, objects=self.objects, latency=self.latency,
+            loss=self.loss, seed=self.seed)
+
+        this_device = LocalDeviceObject(
+            objectName='BACnetHTTPServer', objectIdentifier=('device', 598),
+            maxApduLengthAccepted=1024, segmentationSupported='segmentedBoth',
+            vendorIdentifier=15)
+        self.application = BACnetHTTPServer.COVApplication(
+            this_device, self.client_address)
+        BACnetHTTPServer.this_application = self.application
+        BACnetHTTPServer.cache.ttl = self.cache_ttl
+
+        bacnet_thread = threading.Thread(target=run_bacnet, daemon=True,
+                                         name='bacnet')
+        bacnet_thread.start()
+
+        if self.use_asyncio:
+            self.server = BACnetHTTPServer.AsyncHTTPServer(
+                (HTTP_HOST, self.http_port))
+        else:
+            self.server = BACnetHTTPServer.ThreadedTCPServer(
+                (HTTP_HOST, self.http_port), QuietHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever,
+                                         daemon=True, name='http_server')
+        server_thread.start()
+        self._threads = [bacnet_thread, server_thread]
+
+        # Wait for the HTTP server
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                requests.head(self.url, timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        return
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        stop_bacnet()
+        for application in (self.application, self.simulated_device):
+            if application is not None:
+                close_application(application)
+        for thread in self._threads:
+            thread.join(5)
+        return
+
+    def request(self, session, kind, bacnet_timeout=2, rpm_objects=4):
+        """Send one request of a kind and wait for the response
+        outputs
+        -------
+        ok : (bool) False if the server or the device reported an error, or
+            the response is not the value of the requested object"""
+        headers = {'X-bacnet-timeout':str(bacnet_timeout)}
+        if kind == 'read':
+            instance = random.randint(1, self.objects)
+            res = session.get('{}/read/{}/analogInput:{}/presentValue'.format(
+                self.url, self.device, instance), headers=headers,
+                timeout=bacnet_timeout + 5)
+            # The present value of each simulated object is its instance
+            return res.status_code == 202 and \
+                res.json().get('value') == instance
+
+        elif kind == 'rpm':
+            first = random.randint(1, max(self.objects - rpm_objects, 0) + 1)
+            instances = range(first, min(first + rpm_objects,
+                                         self.objects + 1))
+            body = {'address':self.device,
+                    'bacnet_objects':[
+                        {'object':'analogInput:{}'.format(instance),
+                         'property':'presentValue'}
+                        for instance in instances]}
+            headers['Content-Type'] = 'application/json'
+            res = session.post('{}/readpropertymultiple/'.format(self.url),
+                               headers=headers, data=json.dumps(body),
+                               timeout=bacnet_timeout + 5)
+            # Errors are reported as text/plain
+            if res.status_code != 202 or \
+                    res.headers.get('Content-Type') != 'application/json':
+                return False
+            values = res.json()
+            return all(values.get(str(('analogInput', instance)), {})
+                       .get('presentValue') == instance
+                       for instance in instances)
+
+        elif kind == 'cache':
+            res = session.get('{}/cache'.format(self.url),
+                              timeout=bacnet_timeout + 5)
+            return res.status_code == 200
+
+        raise ValueError('kind must be one of {}. Got {}'
+                         .format(REQUEST_KINDS, kind))
+
+    def run(self, clients=4, duration=10, mix=None, bacnet_timeout=2,
+            rpm_objects=4):
+        """Send requests from clients threads for duration seconds
+        inputs
+        -------
+        clients : (int) concurrent clients. Each sends its next request when
+            the last is answered
+        duration : (float) seconds
+        mix : (dict) of {kind: weight}. Defaults to DEFAULT_MIX
+        outputs
+        -------
+        samples : (list) of (kind, seconds, ok)
+        elapsed : (float) seconds"""
+        if mix is None:
+            mix = DEFAULT_MIX
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        samples = []
+        deadline = time.monotonic() + duration
+
+        def client():
+            session = make_http_session(pool_maxsize=1)
+            chooser = random.Random()
+            while time.monotonic() < deadline:
+                kind = chooser.choices(kinds, weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = self.request(session, kind, bacnet_timeout,
+                                      rpm_objects)
+                except (requests.RequestException, ValueError):
+                    ok = False
+                # list.append is thread safe
+                samples.append((kind, time.perf_counter() - start, ok))
+            session.close()
+            return
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=client, name='client_{}'.format(i))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        return samples, elapsed
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """Requests per second, latency percentiles and error rate of each kind
+    of request and of all requests
+    outputs
+    -------
+    summary : (dict) of {kind: {'requests', 'rate', 'p50', 'p99', 'max',
+        'errors', 'error_rate'}}. Latencies in seconds"""
+    by_kind = {}
+    for kind, seconds, ok in samples:
+        by_kind.setdefault(kind, []).append((seconds, ok))
+    by_kind['total'] = [(seconds, ok) for _, seconds, ok in samples]
+
+    summary = {}
+    for kind, results in by_kind.items():
+        latencies = sorted(seconds for seconds, _ in results)
+        errors = sum(1 for _, ok in results if not ok)
+        summary[kind] = {'requests':len(results),
+                         'rate':len(results) / elapsed if elapsed else 0,
+                         'p50':percentile(latencies, 0.5),
+                         'p99':percentile(latencies, 0.99),
+                         'max':latencies[-1] if latencies else None,
+                         'errors':errors,
+                         'error_rate':errors / len(results)
+                         if results else 0}
+    return summary
+
+
+def format_report(summary):
+    lines = ['{:8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        'request', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'max ms',
+        'errors')]
+    for kind, row in summary.items():
+        if not row['requests']:
+            continue
+        lines.append('{:8} {:9d} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:6.1%}'
+                     .format(kind, row['requests'], row['rate'],
+                             row['p50'] * 1000, row['p99'] * 1000,
+                             row['max'] * 1000, row['error_rate']))
+    return '\n'.join(lines)
+
+
+def _parse_mix(text):
+    """'read=3,rpm=1' to {'read':3, 'rpm':1}"""
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError('kind must be one of {}. Got {}'
+                             .format(REQUEST_KINDS, kind))
+        mix[kind] = float(weight) if weight else 1.0
+    return mix
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Load test BACnetHTTPServer with a '
+                            'simulated BACnet device')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds')
+    parser.add_argument('--mix', type=_parse_mix, default=DEFAULT_MIX,
+                        help='weights of the kinds of request, like '
+                        'read=3,rpm=1,cache=0.1')
+    parser.add_argument('--objects', type=int, default=20,
+                        help='analog inputs of the device')
+    parser.add_argument('--rpm-objects', type=int, default=4,
+                        help='objects read by each readpropertymultiple')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                        help='seconds before the device responds, or the '
+                        'minimum and maximum of a random latency')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='fraction of requests the device ignores')
+    parser.add_argument('--bacnet-timeout', type=int, default=2,
+                        help='X-bacnet-timeout seconds of each request')
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help='seconds of the present value cache')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='use the asyncio HTTP server')
+    parser.add_argument('--port', type=int, default=HTTP_PORT,
+                        help='HTTP server port')
+    args = parser.parse_args(argv)
+
+    latency = args.latency[0] if len(args.latency) == 1 \
+        else tuple(args.latency[:2])
+    load_test = LoadTest(objects=args.objects, latency=latency,
+                         loss=args.loss, use_asyncio=args.asyncio,
+                         http_port=args.port, cache_ttl=args.cache_ttl)
+    load_test.start()
+    try:
+        samples, elapsed = load_test.run(
+            clients=args.clients, duration=args.duration, mix=args.mix,
+            bacnet_timeout=args.bacnet_timeout,
+            rpm_objects=args.rpm_objects)
+    finally:
+        load_test.stop()
+
+    print(format_report(summarize(samples, elapsed)))
+    print('Device received {} requests and dropped {}'.format(
+        load_test.simulated_device.received,
+        load_test.simulated_device.dropped))
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
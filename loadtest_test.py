@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Dec 24 13:02:51 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import unittest
+
+# Third party imports
+
+# Local imports
+from loadtest import (LoadTest, percentile, summarize, format_report,
+                      _parse_mix)
+
+# Declarations
+HTTP_PORT = 18081
+
+#%%
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+        return
+
+    def test_summarize(self):
+        samples = [('read', 0.01, True), ('read', 0.03, False),
+                   ('rpm', 0.02, True), ('read', 0.02, True)]
+        summary = summarize(samples, elapsed=2)
+        self.assertEqual(summary['read']['requests'], 3)
+        self.assertEqual(summary['read']['rate'], 1.5)
+        self.assertEqual(summary['read']['p50'], 0.02)
+        self.assertEqual(summary['read']['p99'], 0.03)
+        self.assertAlmostEqual(summary['read']['error_rate'], 1 / 3)
+        self.assertEqual(summary['total']['requests'], 4)
+        self.assertEqual(summary['total']['errors'], 1)
+        self.assertIn('rpm', format_report(summary))
+        return
+
+    def test_parse_mix(self):
+        self.assertEqual(_parse_mix('read=3,rpm=1'), {'read':3, 'rpm':1})
+        self.assertEqual(_parse_mix('cache'), {'cache':1})
+        with self.assertRaises(ValueError):
+            _parse_mix('write=1')
+        return
+
+    def test_load(self):
+        """Requests to a device that ignores some of them. Only the lost
+        requests, and requests queued behind them, fail. No request gets the
+        response of another. The run is longer than the APDU timeout, so
+        lost requests are retried"""
+        load_test = LoadTest(objects=10, latency=(0, 0.01), loss=0.05,
+                             http_port=HTTP_PORT, seed=1)
+        load_test.start()
+        try:
+            samples, elapsed = load_test.run(
+                clients=4, duration=4, mix={'read':3, 'rpm':1, 'cache':0.2},
+                bacnet_timeout=1)
+        finally:
+            load_test.stop()
+
+        summary = summarize(samples, elapsed)
+        self.assertGreater(summary['total']['requests'], 20)
+        self.assertLess(summary['total']['error_rate'], 0.5)
+        # Failed requests waited for the BACnet timeout
+        for kind, seconds, ok in samples:
+            if not ok:
+                self.assertGreater(seconds, 0.9, kind)
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(LoadTestTest())
@@ -14,6 +14,7 @@ from argparse import ArgumentParser
 import json
 from datetime import datetime
 import logging
+import time
 
 # Third party imports
 import requests
@@ -21,10 +22,15 @@ from bacpypes.primitivedata import ObjectIdentifier
 
 # Local imports
 from CWOPpdu import CWOPPDU, Latitude, Longitude
-from CWOPClient import cwop_client
-from weather_utils import (check_network_interface, read_bacnet_server_ini,
-                           test_bacnet_server, AsyncRecurringTimer,
-                           BufferedSMTPHandler)
+from CWOPClient import APRSISSessions
+from CWOPSpool import PacketSpool, forward_spool, DEFAULT_SPOOL_PATH
+from timeseries import TimeSeriesStore
+from aggregates import StationAggregates
+from weather_utils import (check_network_interface, read_stations_ini,
+                           station_pdu_kwargs, test_bacnet_server,
+                           BufferedSMTPHandler, AsyncHTTPSession)
+from scheduler import Scheduler, OVERLAP_SKIP
+from tracing import tracer, JSONLFile, RingBuffer, RING_BUFFER_SIZE
 
 #### Declarations ####
 parser = ArgumentParser()
@@ -39,9 +45,10 @@ config_file = args.ini
 config = ConfigParser()
 config.read(config_file)
 sections = config.sections()
-assert 'bacnet_server' in sections, 'bacnet_server ini section is required'
 assert 'http_server' in sections, 'http_server ini section is required'
-assert 'cwop_client' in sections, 'cwop_client ini section is required'
+if not any(section.startswith('station:') for section in sections):
+    assert 'bacnet_server' in sections, 'bacnet_server ini section is required'
+    assert 'cwop_client' in sections, 'cwop_client ini section is required'
 # BACnet HTTP Server and client declarations
 BACHTTPServerHost = config['http_server']['BACHTTPServerHost']
 BACHTTPPort = config['http_server']['BACHTTPPort']
@@ -49,10 +56,29 @@ BACHTTPPort = config['http_server']['BACHTTPPort']
 # Weather CWOP Client & Server declarations
 CWOP_SERVER_HOST = 'cwop.aprs.net'
 CWOP_SERVER_PORT = 14580
-provider_id = config['cwop_client']['provider_id']
-latitude = float(config['cwop_client']['latitude'])
-longitude = float(config['cwop_client']['longitude'])
-call_period = int(config['cwop_client'].get('call_period', 5*60))
+# Each poll of a station starts at a random time within this many seconds of
+# its period boundary so the requests of stations are spread out
+START_JITTER = 10
+# Packets that could not be sent are kept here until they can be sent
+if 'spool' in sections:
+    SPOOL_PATH = config['spool'].get('path', DEFAULT_SPOOL_PATH)
+    SPOOL_RATE = config['spool'].getfloat('rate', 1.0)
+else:
+    SPOOL_PATH = DEFAULT_SPOOL_PATH
+    SPOOL_RATE = 1.0
+# Stages of each poll are traced when the section is given. Spans are
+# appended to path, or kept in memory when there is no path
+if 'tracing' in sections:
+    if config['tracing'].get('path'):
+        tracer.sink = JSONLFile(config['tracing']['path'])
+    else:
+        tracer.sink = RingBuffer(config['tracing'].getint(
+            'buffer', RING_BUFFER_SIZE))
+# Every polled observation is kept here when the section is given
+if 'history' in sections:
+    history = TimeSeriesStore(config['history']['path'])
+else:
+    history = None
 
 # Check if network interface is active
 INTERFACE_NAME = config['http_server']['adaptername']
@@ -116,23 +142,36 @@ logger.addHandler(fh) # File
 #%%
 
 
-async def main():
+async def main(station):
     """
     1. Read weather information from BACnet server through the HTTP API
     2. Error check HTTP Client/Server API response
     3. Form CWOP Protocol data unit
     4. Send data to FindU Server
+
+    Inputs
+    -------
+    station : (dict) see weather_utils.read_stations_ini
+    Outputs
+    --------
+    success : (bool) True if the PDU was sent
     """
+    body = station['body']
 
     # 1. Read weather information from BACnet server through the HTTP
     # API
     url = 'http://{}:{}/readpropertymultiple/'.format(BACHTTPServerHost, BACHTTPPort)
     headers = {'Content-Type':'application/json', 'X-bacnet-timeout':'3'}
     try:
-        res = requests.post(url, headers=headers, data=json.dumps(body), timeout=5)
+        with tracer.span('http.post'):
+            # Continue the trace in the BACnet HTTP server
+            headers.update(tracer.headers())
+            res = await session.post(url, headers=headers,
+                                     data=json.dumps(body), timeout=5)
     except Exception as e:
-        msg='HTTP POST unsuccessful\n' + str(res.status_code) + str(res.request)
+        msg='HTTP POST unsuccessful\n' + url
         logger.error(str(e) + '\n' + msg)
+        return False
 
     # 2. Error check HTTP Client/Server API response
     if res.headers['Content-Type'] != 'application/json':
@@ -140,16 +179,17 @@ async def main():
         # Errors are reported with Content-Type = text/plain
         msg=('Error at BACnet HTTP Server. Content dump: {}'.format(res.content))
         logger.error(msg)
-        return
+        return False
 
     if res.status_code != 202:
         msg=('Error at BACnet HTTP Server. Content dump: {}'.format(res.content))
         logger.warning(msg)
-        return
+        return False
 
     try:
         # Parse the resposne (Should be JSON)
-        res_json = res.json()
+        with tracer.span('parse_response'):
+            res_json = res.json()
         for bac_obj in body['bacnet_objects']:
             # Make sure the response includes all the requested bacnet objects
             identifier = ObjectIdentifier(bac_obj['object']).value
@@ -165,34 +205,92 @@ async def main():
              'the request.\nRequest : {}\nResponse : {}\n'\
                  .format(res.request, res.content))
         logger.error(e)
-        return
+        return False
+
+    # Keep the observation in the local time series store
+    if history is not None:
+        try:
+            results = {}
+            for bac_obj in body['bacnet_objects']:
+                identifier = ObjectIdentifier(bac_obj['object']).value
+                value = res_json[str(identifier)][bac_obj['property']]
+                results.setdefault(identifier, {})[bac_obj['property']] = value
+            with tracer.span('history'):
+                history.append_results(station['name'], results)
+        except Exception as e:
+            logger.exception(str(e))
 
     # 3. Form CWOP Protocol data unit
     # 4. Send data to FindU Server
     try:
-        pdu_kwargs = {'time':datetime.now().strftime('%d%H%M'),
-                      'latitude':Latitude(latitude),
-                      'longitude':Longitude(longitude),
-                      'temperature':res_json["('analogInput', 1)"]['presentValue'],
-                      'humidity':res_json["('analogInput', 4)"]['presentValue'],
-                      'dewpoint':res_json["('analogInput', 8)"]['presentValue'],
-                      'co2':res_json["('analogInput', 12)"]['presentValue'],
-                      }
-        pdu = CWOPPDU(provider_id=provider_id, **pdu_kwargs)
-        await cwop_client(pdu, CWOP_SERVER_HOST, CWOP_SERVER_PORT)
+        with tracer.span('form_pdu'):
+            pdu_kwargs = {'time':datetime.now().strftime('%d%H%M'),
+                          'latitude':Latitude(station['latitude']),
+                          'longitude':Longitude(station['longitude']),
+                          }
+            # Each read object fills the CWOPPDU argument of its field
+            pdu_kwargs.update(station_pdu_kwargs(station, res_json))
+
+            # Rain and gust fields of the last hours from the readings of
+            # each cycle. rain_total is the reading of an accumulating rain
+            # gauge
+            aggregates = station_aggregates[station['name']]
+            now = time.time()
+            if 'rain_total' in pdu_kwargs:
+                aggregates.add_rain_total(
+                    now, float(pdu_kwargs.pop('rain_total')))
+            for field in ('wind_speed', 'peak_instantaneous_wind_velocity'):
+                if field in pdu_kwargs:
+                    aggregates.add_wind(now, float(pdu_kwargs[field]))
+            pdu_kwargs.update(aggregates.fields(now))
+
+            pdu = CWOPPDU(provider_id=station['provider_id'], **pdu_kwargs)
+    except Exception as e:
+        logger.exception(str(e))
+        return False
+
+    try:
+        with tracer.span('aprs.send'):
+            await aprs_session.send(pdu.pdu_data_packet)
+    except OSError as e:
+        # Keep the observation and send it when the server is reachable
+        spool.append(pdu.pdu_data_packet)
+        logger.warning('PDU for station {} spooled. {} packets spooled. {}'\
+                       .format(station['name'], len(spool), e))
+        return False
+
+    logger.info('PDU Sent for station {}'.format(station['name']))
+
+    return True
+
+
+async def poll_station(station):
+    """Run main for one station and keep its success count and latency"""
+    stats = station_stats[station['name']]
+    start = time.monotonic()
+    try:
+        with tracer.span('main', station=station['name']):
+            success = await main(station)
     except Exception as e:
         logger.exception(str(e))
+        success = False
+    stats['latency'] = time.monotonic() - start
 
-    logger.info('PDU Sent')
+    if success:
+        stats['success'] += 1
+    else:
+        stats['failure'] += 1
+    logger.info('Station {} {} in {:.2f} s. {} sent, {} failed'.format(
+        station['name'], 'succeeded' if success else 'failed',
+        stats['latency'], stats['success'], stats['failure']))
 
-    return None
+    return
 
 
 
 if __name__ == '__main__':
-    global body
     # 1. Read configuration file for HTTP, BACnet client, BACnet Server
-    # Read the ini file and create the POST request body
+    # Read the ini file and create the POST request body of each station
     """Example Body
     {'bacnet_objects': [{'object': 'analogInput:1', 'property': 'presentValue'},
       {'object': 'analogInput:4', 'property': 'presentValue'},
@@ -202,14 +300,32 @@ if __name__ == '__main__':
     """
     logger.debug("Starting Main")
     logger.debug("Reading ini configuration file")
-    body = read_bacnet_server_ini(config)
-    logger.debug("Configuration Options : {}".format(body))
+    stations = read_stations_ini(config)
+    station_stats = {station['name']:{'success':0, 'failure':0,
+                                      'latency':None}
+                     for station in stations}
+    station_aggregates = {station['name']:StationAggregates()
+                          for station in stations}
+    for station in stations:
+        logger.debug("Station {} : {}".format(station['name'], station['body']))
+
+    # One connection to the BACnet HTTP server for each station polled at
+    # once. Requests run in the session's threads so they do not block the
+    # event loop
+    session = AsyncHTTPSession(max_workers=min(len(stations), 8))
+    # One APRS-IS connection for each provider ID, logged in with it. The
+    # packets of stations with the same provider ID share a connection
+    aprs_session = APRSISSessions(CWOP_SERVER_HOST, CWOP_SERVER_PORT)
+    spool = PacketSpool(SPOOL_PATH)
+    if len(spool):
+        logger.info('{} spooled packets will be sent'.format(len(spool)))
 
     # 2. Test the BACnet HTTP Server to see if it is up and connected
     try:
         logger.debug("Testing BACnet HTTP Server for connectivity")
         logger.debug("BACnet HTTP Server Testing at {}:{}".format(BACHTTPServerHost, BACHTTPPort))
-        res = test_bacnet_server(BACHTTPServerHost, BACHTTPPort)
+        res = test_bacnet_server(BACHTTPServerHost, BACHTTPPort,
+                                 session.session)
         if res: # Boolean
             logger.info("BACnet HTTP Server is responding")
         else:
@@ -222,29 +338,45 @@ if __name__ == '__main__':
         logger.warning(e)
         raise e
 
-    # 3. Begin the recurring task
-    logger.info("Starting main loop. The CWOP Client loop will run " +
-                "continuously every {} seconds.".format(call_period))
-    recurring_timer = AsyncRecurringTimer(call_period, main, recurring=True)
+    # 3. Begin the recurring task of each station
+    # Each station is polled at start, then on the wall clock boundaries of
+    # its call_period. A poll still running at the next tick of its station
+    # is not doubled
+    scheduler = Scheduler()
+    for station in stations:
+        logger.info("Starting station {}. The CWOP Client loop will run "\
+                    .format(station['name']) +
+                    "continuously every {} seconds."\
+                    .format(station['call_period']))
+        scheduler.every(station['call_period'], poll_station, station,
+                        jitter=min(START_JITTER, station['call_period']),
+                        overlap=OVERLAP_SKIP, name=station['name'],
+                        first_delay=0)
 
     try:
         # There is an existing event loop
         # AKA working in ipython
         loop = asyncio.get_running_loop()
-        client_coroutine = recurring_timer.start()
-        client_task = asyncio.create_task(client_coroutine)
+        client_tasks = [asyncio.create_task(scheduler.run())]
 
     except RuntimeError:
         # There is no running event loop
         logger.info("Starting new Async Event Loop")
         loop = asyncio.get_event_loop()
-        # Now.. I need to set the coroutine to be executed in the loop
+        # Now.. I need to set the coroutines to be executed in the loop
         # once started
-        client_coroutine = recurring_timer.start()
-        client_task = loop.create_task(client_coroutine)
+        client_tasks = [loop.create_task(scheduler.run())]
+    # Send the spooled packets in the background
+    client_tasks.append(loop.create_task(
+        forward_spool(spool, aprs_session, rate=SPOOL_RATE)))
 
     try:
         loop.run_forever()
     finally:
-        recurring_timer.cancel()
-        loop.close()
\ No newline at end of file
+        for client_task in client_tasks:
+            client_task.cancel()
+        scheduler.close()
+        session.close()
+        loop.run_until_complete(aprs_session.close())
+        spool.close()
+        loop.close()
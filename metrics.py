@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Dec 21 19:02:37 2020
+
+Counters, gauges and histograms rendered in the Prometheus text format
+
+Each thread records into a shard of its own, so recording takes no lock
+and request threads do not wait on each other. Shards are summed when the
+metrics are rendered. The shards of threads that have ended are folded
+into one retired shard, so a thread per request does not grow memory
+
+@author: z003vrzk
+"""
+
+# Python imports
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+# Upper bounds in seconds of latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+# Shards of ended threads are folded when this many shards exist
+MAX_SHARDS = 64
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#%%
+
+
+class Registry:
+    """Metrics and the per thread shards they are recorded in
+
+    Example
+    -------
+    registry = Registry()
+    requests = registry.counter('http_requests_total', 'Requests',
+                                ('route',))
+    latency = registry.histogram('http_request_duration_seconds',
+                                 'Request latency', ('route',))
+    requests.inc('read')
+    with latency.time('read'):
+        ...
+    payload = registry.render().encode('utf-8')
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._local = threading.local()
+        # (thread, shard) of every thread that recorded a value
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(self, name, documentation, labelnames,
+                                    function))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames,
+                                        buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def shard(self):
+        """The shard of the calling thread. A dict of {(name, labels):
+        value} only written by this thread"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+
+        shard = self._local.shard = {}
+        with self._lock:
+            if len(self._shards) >= MAX_SHARDS:
+                self._fold()
+            self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold(self):
+        """Add the shards of ended threads to the retired shard. Called
+        with the lock held"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _add_shard(self._retired, shard)
+        self._shards = live
+        return
+
+    def collect(self):
+        """Sum of the shards
+        outputs
+        -------
+        values : (dict) of {(name, labels): value}"""
+        with self._lock:
+            self._fold()
+            values = {}
+            _add_shard(values, self._retired)
+            for _thread, shard in self._shards:
+                # dict.copy and list copies do not release the GIL, so a
+                # shard is not changed while it is copied
+                _add_shard(values, shard.copy())
+        return values
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        values = self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(values))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _add_shard(total, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            value = list(value)
+            current = total.get(key)
+            if current is None:
+                total[key] = value
+            else:
+                for i, count in enumerate(value):
+                    current[i] += count
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        return
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{} expects labels {}. Got {}'.format(
+                self.name, self.labelnames, labels))
+        return (self.name, labels)
+
+    def _header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+    def _samples(self, values):
+        return sorted((key[1], value) for key, value in values.items()
+                      if key[0] == self.name)
+
+    def render(self, values):
+        lines = self._header()
+        for labels, value in self._samples(values):
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self.registry.shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+        return
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, like requests in flight. The
+    increments of all threads are summed. A gauge with a function reports
+    function() instead"""
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labelnames,
+                 function=None):
+        super().__init__(registry, name, documentation, labelnames)
+        self.function = function
+
+        return
+
+    def inc(self, *labels, amount=1):
+        shard = self.registry.shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+        return
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+        return
+
+    @contextmanager
+    def track(self, *labels):
+        """Count the body of a with statement while it runs"""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+    def render(self, values):
+        if self.function is None:
+            return super().render(values)
+        return self._header() + ['{} {}'.format(
+            self.name, _format_value(self.function()))]
+
+
+class Histogram(_Metric):
+    """Counts of observed values at or below each bucket bound, with their
+    sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames,
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        return
+
+    def observe(self, value, *labels):
+        shard = self.registry.shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # Count of each bucket and +Inf, sum
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-2] += 1
+        counts[-1] += value
+        return
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds taken by the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self, values):
+        lines = self._header()
+        for labels, counts in self._samples(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, labels,
+                                   [('le', _format_value(float(bound)))]),
+                    cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_text,
+                                             _format_value(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, label_text,
+                                               cumulative))
+        return lines
+
+
+def render_stats(prefix, stats, documentation):
+    """Render a dict of numbers, like PresentValueCache.stats(), as gauges.
+    Nested dicts add their key to the name. Other values are left out"""
+    lines = []
+    for key, value in stats.items():
+        name = '{}_{}'.format(prefix, key)
+        if isinstance(value, dict):
+            lines.extend(render_stats(name, value, documentation))
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            lines.append('# HELP {} {} {}'.format(name, documentation, key))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, _format_value(value)))
+    return lines
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Dec 21 20:41:15 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import threading
+import unittest
+
+# Third party imports
+
+# Local imports
+import metrics
+from metrics import Registry, render_stats
+
+# Declarations
+
+#%%
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_counter(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests',
+                                    ('route', 'status'))
+        requests.inc('read', '202')
+        requests.inc('read', '202')
+        requests.inc('cache', '200', amount=3)
+        text = registry.render()
+        self.assertIn('# TYPE requests_total counter', text)
+        self.assertIn('requests_total{route="read",status="202"} 2', text)
+        self.assertIn('requests_total{route="cache",status="200"} 3', text)
+        with self.assertRaises(ValueError):
+            requests.inc('read')
+        return
+
+    def test_histogram(self):
+        registry = Registry()
+        latency = registry.histogram('latency_seconds', 'Latency',
+                                     ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            latency.observe(value, 'read')
+        lines = registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{route="read",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="read",le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="read",le="+Inf"} 4',
+                      lines)
+        self.assertIn('latency_seconds_sum{route="read"} 4.05', lines)
+        self.assertIn('latency_seconds_count{route="read"} 4', lines)
+        return
+
+    def test_gauge(self):
+        registry = Registry()
+        in_flight = registry.gauge('in_flight', 'In flight')
+        registry.gauge('answer', 'Function', function=lambda: 42)
+        with in_flight.track():
+            self.assertIn('in_flight 1', registry.render())
+        text = registry.render()
+        self.assertIn('in_flight 0', text)
+        self.assertIn('answer 42', text)
+        return
+
+    def test_threads(self):
+        """Values recorded by many threads are summed. The shards of ended
+        threads are folded"""
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests')
+        in_flight = registry.gauge('in_flight', 'In flight')
+
+        def record():
+            for _ in range(1000):
+                requests.inc()
+            in_flight.inc()
+
+        for _ in range(3):
+            threads = [threading.Thread(target=record)
+                       for _ in range(metrics.MAX_SHARDS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Decremented by another thread than the one that incremented
+        in_flight.dec(amount=3 * metrics.MAX_SHARDS)
+
+        text = registry.render()
+        self.assertIn('requests_total {}'.format(
+            3000 * metrics.MAX_SHARDS), text)
+        self.assertIn('in_flight 0', text)
+        self.assertLessEqual(len(registry._shards), 1)
+        return
+
+    def test_render_stats(self):
+        lines = render_stats('cache', {'hits':3, 'ttl':1.5, 'name':'x',
+                                       'cov':{'active':2}}, 'Cache')
+        self.assertIn('cache_hits 3', lines)
+        self.assertIn('cache_ttl 1.5', lines)
+        self.assertIn('cache_cov_active 2', lines)
+        self.assertFalse(any('name' in line for line in lines))
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(RegistryTest())
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Dec 20 09:14:52 2020
+
+Run coroutines every period on one event loop. All jobs share one heap of
+due times and one task that sleeps until the earliest of them. Each run is
+its own task, so a slow callback does not delay other jobs or the later
+ticks of its own job
+
+Due times are kept on the monotonic clock. The first tick of a job is
+aligned to a wall clock boundary (a period of 300 runs at :00, :05, ...)
+and each next tick is the last tick plus the period, so the schedule does
+not drift with the time taken by callbacks and is not moved by steps of
+the wall clock. A job may also run once right away, before its first tick
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import math
+import random
+import time
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+# What a tick does when the runs of its job have not finished
+OVERLAP_SKIP = 'skip' # The tick is skipped
+OVERLAP_QUEUE = 'queue' # One run starts when the running one finishes
+OVERLAP_CONCURRENT = 'concurrent' # Run up to max_concurrent at once, skip
+OVERLAP_POLICIES = (OVERLAP_SKIP, OVERLAP_QUEUE, OVERLAP_CONCURRENT)
+
+logger = logging.getLogger(__name__)
+
+#%%
+
+
+class Job:
+    """A recurring callback of a Scheduler. Created by Scheduler.every
+
+    Counters
+    -------
+    runs : (int) runs started
+    skipped : (int) ticks not run because of the overlap policy
+    missed : (int) ticks that passed while the scheduler could not run, for
+        example while the event loop was blocked. They are not run late
+    errors : (int) runs that raised an exception
+    lateness : (float) seconds between the due time of the last run and its
+        start. Includes the wait of a queued run
+    max_lateness : (float)
+    duration : (float) seconds taken by the last finished run
+    """
+
+    def __init__(self, period, callback, args, kwargs, jitter, overlap,
+                 max_concurrent, name):
+        if not period > 0:
+            raise ValueError('period must be greater than 0. Got {}'
+                             .format(period))
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError('overlap must be one of {}. Got {}'
+                             .format(OVERLAP_POLICIES, overlap))
+        self.period = period
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.jitter = jitter
+        self.overlap = overlap
+        if overlap == OVERLAP_CONCURRENT:
+            self.max_concurrent = max_concurrent
+        else:
+            self.max_concurrent = 1
+        self.name = name or getattr(callback, '__name__', repr(callback))
+        self.cancelled = False
+
+        self.runs = 0
+        self.skipped = 0
+        self.missed = 0
+        self.errors = 0
+        self.lateness = None
+        self.max_lateness = 0.0
+        self._total_lateness = 0.0
+        self.duration = None
+
+        self._tick = None # Monotonic due time of the next tick
+        self._queued = None # Due time of a run waiting for a running one
+        self._running = set()
+
+        return
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def cancel(self):
+        """Stop scheduling the job. Runs already started are not
+        cancelled"""
+        self.cancelled = True
+        self._queued = None
+        return
+
+    def stats(self):
+        if self.runs:
+            mean_lateness = self._total_lateness / self.runs
+        else:
+            mean_lateness = None
+        return {'runs':self.runs, 'skipped':self.skipped,
+                'missed':self.missed, 'errors':self.errors,
+                'running':self.running, 'lateness':self.lateness,
+                'max_lateness':self.max_lateness,
+                'mean_lateness':mean_lateness, 'duration':self.duration}
+
+
+class Scheduler:
+    """Run many recurring jobs from one timer heap
+
+    Example
+    -------
+    scheduler = Scheduler()
+    job = scheduler.every(300, poll_station, station, jitter=10)
+    task = asyncio.ensure_future(scheduler.run())
+    ...
+    job.stats()
+    scheduler.close()
+    """
+
+    def __init__(self, clock=time.monotonic, wall_clock=time.time):
+        """
+        inputs
+        -------
+        clock : (callable) monotonic seconds. Due times are kept on it
+        wall_clock : (callable) seconds since the epoch. Only used to align
+            the first tick of a job
+        """
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._heap = [] # (run time, sequence, job)
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self.jobs = []
+
+        return
+
+    def every(self, period, callback, *args, offset=0, align=True, jitter=0,
+              overlap=OVERLAP_SKIP, max_concurrent=1, name=None,
+              first_delay=None, **kwargs):
+        """Call callback(*args, **kwargs) every period seconds
+        inputs
+        -------
+        period : (float) seconds
+        callback : (coroutine function or function)
+        offset : (float) seconds after the wall clock boundary, or after now
+            when align is False
+        align : (bool) start at the next multiple of period on the wall
+            clock. Otherwise the first run is offset seconds from now
+        jitter : (float) each run starts a random 0 to jitter seconds after
+            its tick. The ticks are not moved
+        overlap : (str) one of OVERLAP_POLICIES
+        max_concurrent : (int) runs at once of an OVERLAP_CONCURRENT job
+        name : (str) for logging. Defaults to the name of callback
+        first_delay : (float) run once first_delay seconds from now, before
+            the first tick. The ticks are not moved. By default the first
+            run is on the first tick, up to a period from now
+        outputs
+        -------
+        job : (Job)"""
+        job = Job(period, callback, args, kwargs, jitter, overlap,
+                  max_concurrent, name)
+        now = self._clock()
+        if align:
+            wall_now = self._wall_clock()
+            boundary = offset + period * (math.floor(
+                (wall_now - offset) / period) + 1)
+            job._tick = now + boundary - wall_now
+        else:
+            job._tick = now + offset
+        self.jobs.append(job)
+
+        first_time = None if first_delay is None else now + first_delay
+        if first_time is not None and first_time < job._tick:
+            # The extra run is given the tick before the first, so the run
+            # schedules the first tick
+            if job.jitter:
+                first_time += random.uniform(
+                    0, min(job.jitter, job._tick - first_time))
+            job._tick -= period
+            self._push(job, first_time)
+        else:
+            self._push(job)
+
+        return job
+
+    def _push(self, job, run_time=None):
+        """Add the next tick of a job to the heap. run_time defaults to the
+        tick with jitter"""
+        if run_time is None:
+            run_time = job._tick
+            if job.jitter:
+                run_time += random.uniform(0, job.jitter)
+        heapq.heappush(self._heap, (run_time, next(self._sequence), job))
+        if self._wakeup is not None:
+            # The new tick may be earlier than the one being waited on
+            self._wakeup.set()
+        return
+
+    async def run(self):
+        """Run the jobs until cancelled"""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                if self._heap:
+                    timeout = self._heap[0][0] - self._clock()
+                else:
+                    timeout = None
+                if timeout is None or timeout > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                run_time, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+                self._due(job, run_time)
+        finally:
+            self._wakeup = None
+
+        return
+
+    def _due(self, job, run_time):
+        """Run a job whose tick is due and schedule its next tick"""
+        now = self._clock()
+        tick = job._tick
+        # Ticks that passed while the loop could not run are not run late
+        missed = max(math.floor((now - tick) / job.period), 0)
+        job.missed += missed
+        job._tick = tick + job.period * (missed + 1)
+        self._push(job)
+
+        if job.running < job.max_concurrent:
+            self._start(job, run_time)
+        elif job.overlap == OVERLAP_QUEUE and job._queued is None:
+            job._queued = run_time
+        else:
+            job.skipped += 1
+            logger.warning('{} skipped a run. {} runs have not finished'
+                           .format(job.name, job.running))
+
+        return
+
+    def _start(self, job, run_time):
+        lateness = max(self._clock() - run_time, 0.0)
+        job.lateness = lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job._total_lateness += lateness
+        job.runs += 1
+
+        task = asyncio.ensure_future(self._call(job))
+        job._running.add(task)
+        task.add_done_callback(lambda task: self._finished(job, task))
+
+        return
+
+    async def _call(self, job):
+        start = self._clock()
+        try:
+            result = job.callback(*job.args, **job.kwargs)
+            if inspect.isawaitable(result):
+                await result
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            job.errors += 1
+            logger.exception('{} raised an exception'.format(job.name))
+        finally:
+            job.duration = self._clock() - start
+
+        return
+
+    def _finished(self, job, task):
+        job._running.discard(task)
+        if job._queued is not None and not job.cancelled:
+            run_time, job._queued = job._queued, None
+            self._start(job, run_time)
+        return
+
+    def close(self):
+        """Cancel the jobs and their running callbacks"""
+        for job in self.jobs:
+            job.cancel()
+            for task in list(job._running):
+                task.cancel()
+        self.jobs = []
+        self._heap = []
+        return
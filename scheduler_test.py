@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Dec 20 11:30:06 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import logging
+import time
+import unittest
+
+# Third party imports
+
+# Local imports
+from scheduler import (Scheduler, OVERLAP_SKIP, OVERLAP_QUEUE,
+                       OVERLAP_CONCURRENT)
+
+# Declarations
+PERIOD = 0.05
+logging.getLogger('scheduler').setLevel(logging.CRITICAL)
+
+#%%
+
+
+def run_for(scheduler, seconds):
+    """Run the scheduler for seconds"""
+    async def run():
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(seconds)
+        task.cancel()
+        scheduler.close()
+    asyncio.run(run())
+    return
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_align(self):
+        """The first tick is on the next wall clock boundary"""
+        scheduler = Scheduler(wall_clock=lambda: 1000.25)
+        job = scheduler.every(10, print)
+        self.assertAlmostEqual(job._tick - time.monotonic(), 9.75, places=2)
+        job = scheduler.every(10, print, offset=3)
+        self.assertAlmostEqual(job._tick - time.monotonic(), 2.75, places=2)
+        with self.assertRaises(ValueError):
+            scheduler.every(0, print)
+        with self.assertRaises(ValueError):
+            scheduler.every(10, print, overlap='wait')
+        return
+
+    def test_first_delay(self):
+        """One run right away, then the aligned ticks"""
+        period = PERIOD * 4
+        starts = []
+        scheduler = Scheduler(wall_clock=lambda: 1000.05)
+        begin = time.monotonic()
+        job = scheduler.every(period, lambda: starts.append(time.monotonic()),
+                              first_delay=0)
+        # The first tick is still at the wall clock boundary
+        self.assertAlmostEqual(job._tick + period - begin, 0.15, places=2)
+        run_for(scheduler, 0.15 + period * 1.5)
+
+        self.assertEqual(len(starts), 3)
+        self.assertLess(starts[0] - begin, 0.03)
+        self.assertAlmostEqual(starts[1] - begin, 0.15, delta=0.03)
+        self.assertAlmostEqual(starts[2] - starts[1], period, delta=0.03)
+        self.assertEqual(job.missed, 0)
+
+        # A delay past the first tick adds no run
+        scheduler = Scheduler()
+        job = scheduler.every(10, print, offset=1, align=False, first_delay=2)
+        self.assertAlmostEqual(job._tick - time.monotonic(), 1, places=2)
+        self.assertEqual([run_time for run_time, _, _ in scheduler._heap],
+                         [job._tick])
+        return
+
+    def test_drift(self):
+        """The time taken by callbacks does not move the later ticks"""
+        starts = []
+
+        async def callback():
+            starts.append(time.monotonic())
+            await asyncio.sleep(PERIOD * 0.6)
+
+        scheduler = Scheduler()
+        job = scheduler.every(PERIOD, callback, align=False)
+        run_for(scheduler, PERIOD * 10.5)
+        # The last tick may not start before the run ends on a busy machine
+        self.assertIn(len(starts), (10, 11))
+        # A callback time added to each period would be 0.3 s by the end. A
+        # busy machine may still delay one start
+        late = [i for i, start in enumerate(starts)
+                if abs(start - starts[0] - i * PERIOD) > 0.02]
+        self.assertLessEqual(len(late), 1)
+        self.assertEqual(job.skipped, 0)
+        self.assertLess(job.stats()['mean_lateness'], 0.02)
+        return
+
+    def test_jobs(self):
+        """Jobs share the scheduler and do not delay each other"""
+        calls = {'slow':0, 'fast':0}
+
+        async def callback(name, duration):
+            calls[name] += 1
+            await asyncio.sleep(duration)
+
+        scheduler = Scheduler()
+        scheduler.every(PERIOD, callback, 'slow', PERIOD * 8, align=False)
+        scheduler.every(PERIOD, callback, 'fast', 0, align=False)
+        run_for(scheduler, PERIOD * 5.5)
+        self.assertEqual(calls['fast'], 6)
+        self.assertEqual(calls['slow'], 1)
+        return
+
+    def test_overlap(self):
+        """Runs longer than the period"""
+        running = {OVERLAP_SKIP:0, OVERLAP_QUEUE:0, OVERLAP_CONCURRENT:0}
+        most = dict(running)
+
+        async def callback(overlap):
+            running[overlap] += 1
+            most[overlap] = max(most[overlap], running[overlap])
+            await asyncio.sleep(PERIOD * 2.5)
+            running[overlap] -= 1
+
+        scheduler = Scheduler()
+        skip = scheduler.every(PERIOD, callback, OVERLAP_SKIP, align=False,
+                               overlap=OVERLAP_SKIP)
+        queue = scheduler.every(PERIOD, callback, OVERLAP_QUEUE, align=False,
+                                overlap=OVERLAP_QUEUE)
+        concurrent = scheduler.every(PERIOD, callback, OVERLAP_CONCURRENT,
+                                     align=False, overlap=OVERLAP_CONCURRENT,
+                                     max_concurrent=2)
+        run_for(scheduler, PERIOD * 9.5)
+
+        self.assertEqual(most, {OVERLAP_SKIP:1, OVERLAP_QUEUE:1,
+                                OVERLAP_CONCURRENT:2})
+        # Ticks at 0, 3, 6, 9 periods
+        self.assertEqual(skip.runs, 4)
+        self.assertEqual(skip.skipped, 6)
+        # Runs back to back at 0, 2.5, 5, 7.5 periods
+        self.assertEqual(queue.runs, 4)
+        self.assertGreater(queue.max_lateness, PERIOD)
+        self.assertGreater(concurrent.runs, skip.runs)
+        self.assertEqual(concurrent.runs + concurrent.skipped, 10)
+        return
+
+    def test_missed(self):
+        """Ticks that passed while the loop was blocked are not run late"""
+        calls = []
+        scheduler = Scheduler()
+        job = scheduler.every(PERIOD, calls.append, 1, align=False)
+        time.sleep(PERIOD * 4.5)
+        run_for(scheduler, PERIOD * 0.2)
+        self.assertEqual(calls, [1])
+        self.assertEqual(job.missed, 4)
+        self.assertGreater(job.lateness, PERIOD * 4)
+        return
+
+    def test_errors(self):
+        async def callback():
+            raise ValueError('Failed')
+
+        scheduler = Scheduler()
+        job = scheduler.every(PERIOD, callback, align=False)
+        run_for(scheduler, PERIOD * 2.5)
+        self.assertEqual(job.stats()['runs'], 3)
+        self.assertEqual(job.stats()['errors'], 3)
+        return
+
+    def test_cancel(self):
+        calls = []
+        scheduler = Scheduler()
+        job = scheduler.every(PERIOD, calls.append, 1, align=False)
+
+        async def run():
+            task = asyncio.ensure_future(scheduler.run())
+            await asyncio.sleep(PERIOD * 1.5)
+            job.cancel()
+            await asyncio.sleep(PERIOD * 2)
+            task.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(calls, [1, 1])
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(SchedulerTest())
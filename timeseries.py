@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Dec 13 09:21:04 2020
+
+Embedded time series store of polled observations. Each station and point
+(object and property) has its own pair of files
+
+<root>/<station>/<object type>_<instance>.<property>.ts
+    Append only compressed chunks. Each chunk is a header and the zlib
+    compressed time column (milliseconds, the first time followed by the
+    differences) followed by the value column (float)
+<root>/<station>/<object type>_<instance>.<property>.tail
+    Uncompressed samples not yet in a chunk. When the tail holds CHUNK_SIZE
+    samples it is compressed into a chunk and emptied
+
+Samples are kept in the order they were appended. That is time order unless
+the clock was set back, and a sample with an earlier time than the ones
+before it is kept where it was appended
+
+Reads memory map the files and only decompress chunks that overlap the
+queried range, so a query does not load the whole history
+
+@author: z003vrzk
+"""
+
+# Python imports
+import os
+import re
+import sys
+import mmap
+import math
+import time
+import struct
+import zlib
+from array import array
+from itertools import accumulate
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+# Samples in each compressed chunk
+CHUNK_SIZE = 256
+# magic, sample count, earliest time [ms], latest time [ms], compressed bytes
+CHUNK_HEADER = struct.Struct('<4sIqqI')
+CHUNK_MAGIC = b'TSC1'
+# time [ms], value
+TAIL_RECORD = struct.Struct('<qd')
+_STATION_RE = re.compile(r'[^A-Za-z0-9_.-]')
+
+#%%
+
+
+def _to_ms(timestamp):
+    return int(round(timestamp * 1000))
+
+
+def _native(values):
+    """The files are little endian"""
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class TimeSeriesStore:
+    """Store and query numeric samples of many stations and points
+
+    Example
+    -------
+    store = TimeSeriesStore('./history')
+    store.append('north', ('analogInput', 1), 'presentValue', 74.2)
+    for timestamp, value in store.read('north', ('analogInput', 1),
+                                       'presentValue', start, end):
+        ...
+    for row in store.downsample('north', ('analogInput', 1), 'presentValue',
+                                start, end, step=3600):
+        timestamp, mean, minimum, maximum, count = row
+    """
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        """
+        inputs
+        -------
+        root : (str) directory of the store. Created if it does not exist
+        chunk_size : (int) samples in each compressed chunk
+        """
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+
+        return
+
+    def stations(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def point_path(self, station, object_identifier, property_identifier):
+        """Path of the point files without the extension
+        inputs
+        -------
+        station : (str) station name
+        object_identifier : (tuple) of (object type, instance)
+        property_identifier : (str)"""
+        object_type, instance = object_identifier
+        name = '{}_{}.{}'.format(object_type, int(instance),
+                                 property_identifier)
+        return os.path.join(self.root, _STATION_RE.sub('_', station),
+                            _STATION_RE.sub('_', name))
+
+    def append(self, station, object_identifier, property_identifier, value,
+               timestamp=None):
+        """Add a sample to the end of a point
+        inputs
+        -------
+        value : (float)
+        timestamp : (float) seconds since the epoch. Defaults to now"""
+        if timestamp is None:
+            timestamp = time.time()
+        path = self.point_path(station, object_identifier, property_identifier)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + '.tail', 'ab') as tail:
+            tail.write(TAIL_RECORD.pack(_to_ms(timestamp), float(value)))
+            size = tail.tell()
+        if size >= self.chunk_size * TAIL_RECORD.size:
+            self._compress_tail(path)
+
+        return
+
+    def append_results(self, station, results, timestamp=None):
+        """Add the numeric values of a read
+        inputs
+        -------
+        results : (dict) of {object_identifier: {property: value}}, like the
+            decoded response of a ReadPropertyMultiple request
+        outputs
+        -------
+        count : (int) samples added"""
+        count = 0
+        for object_identifier, properties in results.items():
+            for property_identifier, value in properties.items():
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    continue
+                self.append(station, object_identifier, property_identifier,
+                            value, timestamp)
+                count += 1
+        return count
+
+    def _compress_tail(self, path):
+        """Move the samples of the tail file into a compressed chunk"""
+        mapped = self._mapped(path + '.ts')
+        if mapped is None:
+            times, values = self._read_tail(path + '.tail')
+        else:
+            with mapped:
+                times, values = self._read_tail(path + '.tail', mapped)
+        if not times:
+            open(path + '.tail', 'wb').close()
+            return
+
+        deltas = array('q', [times[0]])
+        deltas.extend(times[i] - times[i - 1] for i in range(1, len(times)))
+        payload = zlib.compress(_native(deltas).tobytes() +
+                                _native(array('d', values)).tobytes())
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, len(times), min(times),
+                                   max(times), len(payload))
+        with open(path + '.ts', 'ab') as chunks:
+            chunks.write(header + payload)
+            chunks.flush()
+            os.fsync(chunks.fileno())
+        # Samples written again after a crash here are skipped by _read_tail
+        open(path + '.tail', 'wb').close()
+
+        return
+
+    @staticmethod
+    def _mapped(path):
+        """Read only memory map of a file, or None if it is empty or does not
+        exist"""
+        try:
+            with open(path, 'rb') as file:
+                if not os.fstat(file.fileno()).st_size:
+                    return None
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def _read_tail(self, path, chunks=None):
+        """(times, values) of the tail file. A partly written last record is
+        ignored
+        inputs
+        -------
+        chunks : (mmap) of the chunk file. Samples that are its last chunk
+            already are skipped. They are left in the tail by a crash after
+            the chunk was written"""
+        mapped = self._mapped(path)
+        if mapped is None:
+            return [], []
+        with mapped:
+            end = len(mapped) - len(mapped) % TAIL_RECORD.size
+            records = list(TAIL_RECORD.iter_unpack(mapped[:end]))
+        if chunks is not None:
+            records = records[self._compressed_count(chunks, records):]
+        times = [timestamp for timestamp, _ in records]
+        values = [value for _, value in records]
+        return times, values
+
+    def _compressed_count(self, mapped, records):
+        """Number of records at the start of a tail that are the same
+        samples as the last chunk, or 0"""
+        last = None
+        for last in self._chunk_headers(mapped):
+            pass
+        if last is None:
+            return 0
+        payload, count, earliest, latest, length = last
+        if len(records) < count:
+            return 0
+        times = array('q', [timestamp for timestamp, _ in records[:count]])
+        if min(times) != earliest or max(times) != latest:
+            return 0
+
+        chunk_times, chunk_values = self._decompress(mapped, payload, count,
+                                                     length)
+        values = array('d', [value for _, value in records[:count]])
+        # Bytes, so NaN values compare equal
+        if chunk_times == times and \
+                chunk_values.tobytes() == values.tobytes():
+            return count
+        return 0
+
+    @staticmethod
+    def _chunk_headers(mapped):
+        """Headers of the complete chunks
+        outputs
+        -------
+        generator of (payload offset, count, earliest time, latest time,
+        payload length)"""
+        offset = 0
+        size = len(mapped)
+        while offset + CHUNK_HEADER.size <= size:
+            magic, count, earliest, latest, length = \
+                CHUNK_HEADER.unpack_from(mapped, offset)
+            payload = offset + CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or payload + length > size:
+                # A chunk being written
+                break
+            offset = payload + length
+            yield payload, count, earliest, latest, length
+
+        return
+
+    @staticmethod
+    def _decompress(mapped, payload, count, length):
+        """(times, values) arrays of a chunk"""
+        data = zlib.decompress(mapped[payload:payload + length])
+        deltas = _native(array('q', data[:count * 8]))
+        values = _native(array('d', data[count * 8:]))
+        return array('q', accumulate(deltas)), values
+
+    def _chunks(self, mapped, start_ms, end_ms):
+        """Decompress the chunks that overlap [start_ms, end_ms]
+        outputs
+        -------
+        generator of (times, values) arrays"""
+        for payload, count, earliest, latest, length in \
+                self._chunk_headers(mapped):
+            if latest < start_ms or earliest > end_ms:
+                continue
+            yield self._decompress(mapped, payload, count, length)
+
+        return
+
+    def read(self, station, object_identifier, property_identifier,
+             start=None, end=None):
+        """Samples of a point in the order they were appended
+        inputs
+        -------
+        start, end : (float) seconds since the epoch. None is unbounded
+        outputs
+        -------
+        generator of (timestamp, value). timestamp in seconds"""
+        path = self.point_path(station, object_identifier, property_identifier)
+        start_ms = -2**63 if start is None else _to_ms(start)
+        end_ms = 2**63 - 1 if end is None else _to_ms(end)
+
+        mapped = self._mapped(path + '.ts')
+        if mapped is not None:
+            with mapped:
+                for times, values in self._chunks(mapped, start_ms, end_ms):
+                    for timestamp, value in zip(times, values):
+                        if start_ms <= timestamp <= end_ms:
+                            yield timestamp / 1000, value
+                times, values = self._read_tail(path + '.tail', mapped)
+        else:
+            times, values = self._read_tail(path + '.tail')
+        for timestamp, value in zip(times, values):
+            if start_ms <= timestamp <= end_ms:
+                yield timestamp / 1000, value
+
+        return
+
+    def downsample(self, station, object_identifier, property_identifier,
+                   start, end, step):
+        """Aggregate the samples of a point into intervals of step seconds
+        from start
+        inputs
+        -------
+        start, end : (float) seconds since the epoch. None is unbounded, and
+            the intervals then start at the first sample
+        outputs
+        -------
+        generator of (interval start, mean, minimum, maximum, count). Only
+        intervals with samples are returned. A sample earlier than the one
+        before it starts a new interval"""
+        if not step > 0:
+            raise ValueError('step must be greater than 0. Got {}'
+                             .format(step))
+
+        origin = start
+        bucket = None
+        for timestamp, value in self.read(station, object_identifier,
+                                          property_identifier, start, end):
+            if origin is None:
+                origin = timestamp
+            index = math.floor((timestamp - origin) / step)
+            if index != bucket:
+                if bucket is not None:
+                    yield (origin + bucket * step, total / count, minimum,
+                           maximum, count)
+                bucket = index
+                total = minimum = maximum = value
+                count = 1
+            else:
+                total += value
+                count += 1
+                minimum = min(minimum, value)
+                maximum = max(maximum, value)
+
+        if bucket is not None:
+            yield (origin + bucket * step, total / count, minimum, maximum,
+                   count)
+
+        return
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Dec 13 11:40:27 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import os
+import tempfile
+import unittest
+
+# Third party imports
+
+# Local imports
+from timeseries import TimeSeriesStore, TAIL_RECORD, CHUNK_HEADER
+
+# Declarations
+START = 1600000000.0
+POINT = ('north', ('analogInput', 1), 'presentValue')
+
+#%%
+
+
+class TimeSeriesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = TimeSeriesStore(self.directory.name, chunk_size=10)
+        # One sample each minute
+        for i in range(35):
+            self.store.append(*POINT, value=i / 2, timestamp=START + i * 60)
+        return
+
+    def tearDown(self):
+        self.directory.cleanup()
+        return
+
+    def test_files(self):
+        """Full chunks are compressed and the rest is in the tail"""
+        path = self.store.point_path(*POINT)
+        self.assertEqual(os.path.getsize(path + '.tail'),
+                         5 * TAIL_RECORD.size)
+        self.assertLess(os.path.getsize(path + '.ts'),
+                        30 * TAIL_RECORD.size + 3 * CHUNK_HEADER.size)
+        self.assertEqual(self.store.stations(), ['north'])
+        return
+
+    def test_read(self):
+        samples = list(self.store.read(*POINT))
+        self.assertEqual(samples, [(START + i * 60, i / 2)
+                                   for i in range(35)])
+
+        # Range across a chunk and the tail
+        samples = list(self.store.read(*POINT, START + 28 * 60,
+                                       START + 31 * 60))
+        self.assertEqual(samples, [(START + i * 60, i / 2)
+                                   for i in range(28, 32)])
+        self.assertEqual(list(self.store.read('north', ('analogInput', 2),
+                                              'presentValue')), [])
+        return
+
+    def test_downsample(self):
+        rows = list(self.store.downsample(*POINT, START, None, 600))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0], (START, 2.25, 0, 4.5, 10))
+        self.assertEqual(rows[3], (START + 1800, 16, 15, 17, 5))
+        with self.assertRaises(ValueError):
+            list(self.store.downsample(*POINT, START, None, 0))
+
+        # Without start the intervals begin at the first sample
+        self.assertEqual(list(self.store.downsample(*POINT, None, None, 600)),
+                         rows)
+        return
+
+    def test_partial_write(self):
+        """Records and chunks still being written are not read"""
+        path = self.store.point_path(*POINT)
+        with open(path + '.tail', 'ab') as tail:
+            tail.write(b'\x00' * 5)
+        with open(path + '.ts', 'ab') as chunks:
+            chunks.write(CHUNK_HEADER.pack(b'TSC1', 10, 0, 0, 1000))
+        self.assertEqual(len(list(self.store.read(*POINT))), 35)
+        return
+
+    def test_duplicate_tail(self):
+        """A tail left behind by a crash after its chunk was written"""
+        path = self.store.point_path(*POINT)
+        with open(path + '.tail', 'rb') as tail:
+            samples = tail.read()
+        store = TimeSeriesStore(self.directory.name, chunk_size=5)
+        store._compress_tail(path)
+        with open(path + '.tail', 'wb') as tail:
+            tail.write(samples)
+        self.assertEqual(len(list(store.read(*POINT))), 35)
+        return
+
+    def test_backward_time(self):
+        """Samples with an earlier time than the last chunk, like after the
+        clock was set back, are kept in the order they were appended"""
+        late = START + 5 * 60 + 30
+        self.store.append(*POINT, value=-1, timestamp=late)
+        samples = list(self.store.read(*POINT))
+        self.assertEqual(len(samples), 36)
+        self.assertEqual(samples[-1], (late, -1))
+
+        # Compressed into a chunk with later samples
+        for i in range(4):
+            self.store.append(*POINT, value=-2, timestamp=late + i)
+        path = self.store.point_path(*POINT)
+        self.assertEqual(os.path.getsize(path + '.tail'), 0)
+        samples = list(self.store.read(*POINT))
+        self.assertEqual(len(samples), 40)
+        self.assertEqual(samples[30:], [(START + i * 60, i / 2)
+                                        for i in range(30, 35)] +
+                         [(late, -1)] + [(late + i, -2) for i in range(4)])
+
+        # Ranges find them in any chunk
+        samples = list(self.store.read(*POINT, START + 5 * 60,
+                                       START + 6 * 60))
+        self.assertEqual(samples, [(START + 300, 2.5), (START + 360, 3),
+                                   (late, -1)] +
+                         [(late + i, -2) for i in range(4)])
+        return
+
+    def test_backward_duplicate_tail(self):
+        """A crash after a chunk with an earlier time than the chunk before
+        it was written"""
+        path = self.store.point_path(*POINT)
+        for i in range(5):
+            self.store.append(*POINT, value=-1, timestamp=START + i)
+        with open(path + '.tail', 'rb') as tail:
+            samples = tail.read()
+        self.store._compress_tail(path)
+        with open(path + '.tail', 'wb') as tail:
+            tail.write(samples + TAIL_RECORD.pack(int(START * 1000), -3))
+        samples = list(self.store.read(*POINT))
+        self.assertEqual(len(samples), 41)
+        self.assertEqual(samples[-1], (START, -3))
+        return
+
+    def test_append_results(self):
+        count = self.store.append_results(
+            'south', {('analogInput', 1): {'presentValue': 70.5,
+                                           'objectName': 'Temperature',
+                                           'outOfService': False}},
+            timestamp=START)
+        self.assertEqual(count, 1)
+        self.assertEqual(list(self.store.read('south', ('analogInput', 1),
+                                              'presentValue')),
+                         [(START, 70.5)])
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(TimeSeriesStoreTest())
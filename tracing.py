@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Dec 22 18:25:40 2020
+
+Opt-in tracing of the stages of a poll. A span is the time taken by one
+stage. Spans opened inside another span are its children, and a trace is
+every span of one poll, from main.py through the BACnet HTTP server and
+back. The trace continues across the HTTP request in the W3C traceparent
+header
+
+Tracing is off until a sink is given to the tracer. Spans are then written
+to a ring buffer in memory or to a JSON lines file, one span per line.
+fold_stacks turns the spans into the folded stack format read by
+flamegraph.pl and speedscope
+
+    python tracing.py traces.jsonl > traces.folded
+
+@author: z003vrzk
+"""
+
+# Python imports
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import nullcontext
+
+# Third party imports
+
+# Local imports
+
+# Declarations
+TRACE_HEADER = 'traceparent'
+# Spans kept by a RingBuffer
+RING_BUFFER_SIZE = 10000
+
+# The span of the running code. Each thread and asyncio task has its own
+_current = contextvars.ContextVar('span', default=None)
+# Returned by a tracer without a sink. Does nothing
+_NULL_SPAN = nullcontext()
+
+#%%
+
+
+class RingBuffer:
+    """Keep the last capacity spans in memory"""
+
+    def __init__(self, capacity=RING_BUFFER_SIZE):
+        self._spans = deque(maxlen=capacity)
+        return
+
+    def write(self, record):
+        # deque.append is thread safe
+        self._spans.append(record)
+        return
+
+    def records(self):
+        return list(self._spans)
+
+    def close(self):
+        return
+
+
+class JSONLFile:
+    """Append spans to a file, one JSON object per line"""
+
+    def __init__(self, path):
+        # Line buffered, so a span is in the file when it ends
+        self._file = open(path, 'a', buffering=1, encoding='utf-8')
+        self._lock = threading.Lock()
+        return
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+        return
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        return
+
+
+class Span:
+    """One timed stage. Use Tracer.span to create it"""
+
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id',
+                 'attributes', 'start', '_perf_start', '_token')
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+
+    def set(self, key, value):
+        """Add an attribute to the span"""
+        self.attributes[key] = value
+        return
+
+    def __enter__(self):
+        self.start = time.time()
+        self._perf_start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._perf_start
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer._record(self, duration)
+        return False
+
+
+class Tracer:
+    """Create spans and give the ended spans to a sink
+
+    Example
+    -------
+    tracer.sink = JSONLFile('traces.jsonl')
+    with tracer.span('main', station='north'):
+        with tracer.span('http.post'):
+            headers.update(tracer.headers())
+            ...
+    # In the HTTP server, continue the trace of the client
+    with tracer.span('http.POST', parent=headers.get(TRACE_HEADER)):
+        ...
+    """
+
+    def __init__(self, sink=None):
+        """
+        inputs
+        -------
+        sink : (RingBuffer, JSONLFile) or None to disable tracing
+        """
+        self.sink = sink
+        return
+
+    @property
+    def enabled(self):
+        return self.sink is not None
+
+    def span(self, name, parent=None, **attributes):
+        """A context manager that times its body
+        inputs
+        -------
+        name : (str) stage name
+        parent : (str) traceparent header of the caller. The span is a child
+            of the caller's span instead of the running span
+        attributes : added to the span record"""
+        if self.sink is None:
+            return _NULL_SPAN
+
+        context = _parse_traceparent(parent) if parent else None
+        if context is not None:
+            trace_id, parent_id = context
+        else:
+            current = _current.get()
+            if current is not None:
+                trace_id, parent_id = current.trace_id, current.span_id
+            else:
+                trace_id, parent_id = os.urandom(16).hex(), None
+        return Span(self, name, trace_id, parent_id, attributes)
+
+    def headers(self):
+        """Headers that continue the running trace in an HTTP request"""
+        current = _current.get()
+        if self.sink is None or current is None:
+            return {}
+        return {TRACE_HEADER: '00-{}-{}-01'.format(current.trace_id,
+                                                   current.span_id)}
+
+    def _record(self, span, duration):
+        sink = self.sink
+        if sink is None:
+            return
+        sink.write({'trace_id':span.trace_id, 'span_id':span.span_id,
+                    'parent_id':span.parent_id, 'name':span.name,
+                    'start':span.start, 'duration':duration,
+                    'thread':threading.current_thread().name,
+                    'attributes':span.attributes})
+        return
+
+
+def _parse_traceparent(header):
+    """(trace id, parent span id) of a traceparent header, or None if it is
+    not valid"""
+    parts = header.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def read_records(path):
+    """Spans of a JSONLFile"""
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def fold_stacks(records):
+    """Self time of each stack of span names for a flame graph
+    inputs
+    -------
+    records : (list) of span records, from RingBuffer.records or
+        read_records
+    outputs
+    -------
+    stacks : (dict) of {'main;http.post;...': microseconds}. Written as
+        '<stack> <microseconds>' lines it is the folded stack format"""
+    spans = {record['span_id']:record for record in records}
+    children = {}
+    for record in records:
+        if record['parent_id'] in spans:
+            children[record['parent_id']] = \
+                children.get(record['parent_id'], 0) + record['duration']
+
+    stacks = {}
+    for record in records:
+        names = []
+        span = record
+        while span is not None and len(names) < 100:
+            names.append(span['name'])
+            span = spans.get(span['parent_id'])
+        stack = ';'.join(reversed(names))
+        self_time = max(record['duration'] -
+                        children.get(record['span_id'], 0), 0)
+        stacks[stack] = stacks.get(stack, 0) + round(self_time * 1e6)
+
+    return stacks
+
+
+# Shared by main.py, CWOPClient and BACnetHTTPServer. Off until a sink is set
+tracer = Tracer()
+
+
+if __name__ == '__main__':
+    for stack, microseconds in sorted(fold_stacks(
+            read_records(sys.argv[1])).items()):
+        print('{} {}'.format(stack, microseconds))
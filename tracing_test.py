@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Dec 22 20:12:51 2020
+
+@author: z003vrzk
+"""
+
+# Python imports
+import asyncio
+import os
+import tempfile
+import unittest
+
+# Third party imports
+
+# Local imports
+from tracing import (Tracer, RingBuffer, JSONLFile, TRACE_HEADER,
+                     read_records, fold_stacks)
+
+# Declarations
+
+#%%
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_disabled(self):
+        tracer = Tracer()
+        with tracer.span('main') as span:
+            self.assertIsNone(span)
+            self.assertEqual(tracer.headers(), {})
+        return
+
+    def test_nested(self):
+        tracer = Tracer(RingBuffer())
+        with tracer.span('main', station='north'):
+            with tracer.span('http.post'):
+                pass
+            with self.assertRaises(KeyError):
+                with tracer.span('form_pdu'):
+                    raise KeyError('temperature')
+        post, form_pdu, main = tracer.sink.records()
+
+        self.assertEqual(main['name'], 'main')
+        self.assertIsNone(main['parent_id'])
+        self.assertEqual(main['attributes'], {'station':'north'})
+        self.assertEqual(post['parent_id'], main['span_id'])
+        self.assertEqual(form_pdu['attributes'], {'error':'KeyError'})
+        self.assertEqual({record['trace_id'] for record in
+                          (post, form_pdu, main)}, {main['trace_id']})
+        self.assertGreaterEqual(main['duration'], post['duration'])
+        return
+
+    def test_header(self):
+        """A trace continues in another process from the header"""
+        client = Tracer(RingBuffer())
+        server = Tracer(RingBuffer())
+        with client.span('http.post'):
+            headers = client.headers()
+            with server.span('http.POST', parent=headers[TRACE_HEADER]):
+                pass
+        request, = server.sink.records()
+        post, = client.sink.records()
+        self.assertEqual(request['trace_id'], post['trace_id'])
+        self.assertEqual(request['parent_id'], post['span_id'])
+
+        # A bad header starts a new trace
+        with server.span('http.POST', parent='00-xyz-abc-01'):
+            pass
+        self.assertIsNone(server.sink.records()[-1]['parent_id'])
+        return
+
+    def test_tasks(self):
+        """Concurrent tasks have their own running span"""
+        tracer = Tracer(RingBuffer())
+
+        async def poll(name):
+            with tracer.span(name):
+                await asyncio.sleep(0.01)
+                with tracer.span('http.post'):
+                    await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(poll('north'), poll('south'))
+
+        asyncio.run(run())
+        records = tracer.sink.records()
+        names = {record['span_id']:record['name'] for record in records}
+        parents = sorted(names[record['parent_id']] for record in records
+                         if record['name'] == 'http.post')
+        self.assertEqual(parents, ['north', 'south'])
+        return
+
+    def test_jsonl(self):
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'traces.jsonl')
+        tracer = Tracer(JSONLFile(path))
+        with tracer.span('main'):
+            with tracer.span('aprs.send'):
+                pass
+        tracer.sink.close()
+        records = read_records(path)
+        self.assertEqual([record['name'] for record in records],
+                         ['aprs.send', 'main'])
+        directory.cleanup()
+        return
+
+    def test_fold_stacks(self):
+        records = [
+            {'trace_id':'t', 'span_id':'a', 'parent_id':None,
+             'name':'main', 'duration':1.0},
+            {'trace_id':'t', 'span_id':'b', 'parent_id':'a',
+             'name':'http.post', 'duration':0.6},
+            {'trace_id':'t', 'span_id':'c', 'parent_id':'b',
+             'name':'iocb_wait', 'duration':0.5},
+            {'trace_id':'t', 'span_id':'d', 'parent_id':'a',
+             'name':'aprs.send', 'duration':0.25},
+            ]
+        self.assertEqual(fold_stacks(records),
+                         {'main':150000, 'main;http.post':100000,
+                          'main;http.post;iocb_wait':500000,
+                          'main;aprs.send':250000})
+        return
+
+
+
+if __name__ == '__main__':
+    unittest.main(TracerTest())
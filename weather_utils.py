@@ -11,17 +11,27 @@ import sys, os
 import asyncio
 import time
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue, Empty
 from logging.handlers import BufferingHandler
 import logging
 
 # Third party imports
 import requests
+from urllib3.util.retry import Retry
+from bacpypes.primitivedata import ObjectIdentifier
 
 # Local imports
+from scheduler import Scheduler, OVERLAP_QUEUE
 
 # Declarations
 process_queue = Queue()
+# CWOPPDU arguments of read_objects when a station does not list its fields
+DEFAULT_STATION_FIELDS = 'temperature,humidity,dewpoint,co2'
+# Connection attempts retried by make_http_session. Only failed connects are
+# retried, a request that reached the server is never sent twice
+HTTP_CONNECT_RETRIES = 2
 
 
 def check_network_interface(interface_name):
@@ -91,7 +101,7 @@ def _check_network_interface_nix(interface_name):
 
 
 
-def read_bacnet_server_ini(config):
+def read_bacnet_server_ini(config, section='bacnet_server'):
     """
     bacnet_object1 = {'object':'analogValue:10000',
                       'property':'presentValue'}
@@ -104,8 +114,8 @@ def read_bacnet_server_ini(config):
     """
     body = {'bacnet_objects':[],
             'address':None}
-    read_objects = config['bacnet_server']['read_objects'].split(',')
-    read_properties = config['bacnet_server']['read_properties'].split(',')
+    read_objects = config[section]['read_objects'].split(',')
+    read_properties = config[section]['read_properties'].split(',')
 
     if len(read_objects) <= 0:
         msg=('The configuration file for the BACnet client must have at ' +
@@ -129,11 +139,92 @@ def read_bacnet_server_ini(config):
                        'property':bac_property}
         body['bacnet_objects'].append(read_object)
 
-    body['address'] = config['bacnet_server']['address']
+    body['address'] = config[section]['address']
 
     return body
 
 
+def read_stations_ini(config):
+    """Read the weather stations polled by main.py
+    Each station is a [station:<name>] section with the keys of
+    [bacnet_server] (address, read_objects, read_properties) and of
+    [cwop_client] (provider_id, latitude, longitude, call_period). The fields
+    key names the CWOPPDU argument of each read object, like
+    fields: temperature,humidity,,barometric_pressure
+    Leave a field empty to read an object without reporting it. Without
+    station sections the single station of [bacnet_server] and [cwop_client]
+    is read with DEFAULT_STATION_FIELDS
+
+    Inputs
+    -------
+    config : (configparser.ConfigParser)
+    Outputs
+    --------
+    stations : (list) of dict with keys name, body, fields, provider_id,
+        latitude, longitude, call_period. body is the readpropertymultiple
+        request body (see read_bacnet_server_ini)
+    """
+    sections = [(section, section.split(':', 1)[1])
+                for section in config.sections()
+                if section.startswith('station:')]
+    if not sections:
+        sections = [('bacnet_server', 'cwop_client')]
+
+    stations = []
+    for section, name in sections:
+        if section == 'bacnet_server':
+            # Single station configuration
+            station_config = dict(config['cwop_client'])
+            station_config.update(config['bacnet_server'])
+            name = config['cwop_client']['provider_id']
+        else:
+            station_config = config[section]
+
+        body = read_bacnet_server_ini(config, section)
+        fields = station_config.get('fields', DEFAULT_STATION_FIELDS)
+        fields = [field.strip() for field in fields.split(',')]
+        if len(fields) != len(body['bacnet_objects']):
+            msg=('Station {} must have one fields entry for each of its ' +
+                 'read_objects. Got {} fields and {} read_objects')\
+                     .format(name, len(fields), len(body['bacnet_objects']))
+            raise ValueError(msg)
+
+        stations.append({
+            'name':name,
+            'body':body,
+            'fields':fields,
+            'provider_id':station_config['provider_id'],
+            'latitude':float(station_config['latitude']),
+            'longitude':float(station_config['longitude']),
+            'call_period':int(station_config.get('call_period', 5*60)),
+            })
+
+    return stations
+
+
+def station_pdu_kwargs(station, results):
+    """CWOPPDU arguments of a station from its readpropertymultiple response
+    Inputs
+    -------
+    station : (dict) see read_stations_ini
+    results : (dict) response of the BACnet HTTP server like
+        {"('analogInput', 1)": {'presentValue': 72.5}}
+    Outputs
+    --------
+    pdu_kwargs : (dict) of {CWOPPDU argument: value}. Objects read without a
+        field are left out
+    """
+    pdu_kwargs = {}
+    for bac_obj, field in zip(station['body']['bacnet_objects'],
+                              station['fields']):
+        if not field:
+            continue
+        identifier = str(ObjectIdentifier(bac_obj['object']).value)
+        pdu_kwargs[field] = results[identifier][bac_obj['property']]
+
+    return pdu_kwargs
+
+
 def enqueue_output(out, queue):
     for line in iter(out.readline, b''):
         queue.put(line)
@@ -192,12 +283,86 @@ def close_BACnet_HTTP_Server():
     return
 
 
-def test_bacnet_server(BACHTTPServerHost, BACHTTPPort):
-    """Send a request to the BACnet HTTP server to see if it is active"""
+def make_http_session(pool_maxsize=2):
+    """Create a requests.Session for the BACnet HTTP server. The session
+    keeps its TCP connection open between requests (HTTP/1.1 keep-alive)
+    instead of connecting for every request
+    Inputs
+    -------
+    pool_maxsize : (int) connections kept open to the server
+    Outputs
+    --------
+    session : (requests.Session) failed connects are retried
+        HTTP_CONNECT_RETRIES times, like a server that is restarting
+    """
+    session = requests.Session()
+    max_retries = Retry(total=HTTP_CONNECT_RETRIES,
+                        connect=HTTP_CONNECT_RETRIES,
+                        read=0, redirect=0, status=0, backoff_factor=0.1)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_maxsize,
+                                            max_retries=max_retries)
+    session.mount('http://', adapter)
+    return session
+
+
+class AsyncHTTPSession:
+    """Await requests to the BACnet HTTP server without blocking the event
+    loop. Each request runs in a dedicated thread pool on a pooled
+    requests.Session (see make_http_session). Cancelling the awaiting task
+    returns immediately; the request thread finishes on its own timeout
+
+    Example
+    -------
+    session = AsyncHTTPSession()
+    res = await session.post(url, data=json.dumps(body), timeout=5)
+    """
+
+    def __init__(self, max_workers=2):
+        """
+        Inputs
+        -------
+        max_workers : (int) requests in progress at once, and connections
+            kept open to the server
+        """
+        self.session = make_http_session(pool_maxsize=max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='http_client')
+        return
+
+    async def request(self, method, url, **kwargs):
+        """Same arguments as requests.Session.request"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.session.request, method, url, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+        return
+
+
+def test_bacnet_server(BACHTTPServerHost, BACHTTPPort, session=None):
+    """Send a request to the BACnet HTTP server to see if it is active
+    Inputs
+    -------
+    session : (requests.Session) reuse the connection of a session. See
+        make_http_session"""
+    if session is None:
+        session = requests
     # Make a simple request
     url = 'http://{}:{}'.format(BACHTTPServerHost, BACHTTPPort)
     headers = {'X-bacnet-timeout':'3', 'Content-Type':'application/json'}
-    res = requests.head(url, headers=headers, timeout=5)
+    res = session.head(url, headers=headers, timeout=5)
     if res.status_code == 200:
         return True
     else:
@@ -205,6 +370,9 @@ def test_bacnet_server(BACHTTPServerHost, BACHTTPPort):
 
 
 class AsyncRecurringTimer:
+    """Call a coroutine every call_period seconds. Kept for the scripts
+    written against it; it runs on a scheduler.Scheduler of its own. Use
+    scheduler.Scheduler to run many timers from one task"""
 
     def __init__(self, call_period, callback, recurring=False):
         """
@@ -217,32 +385,32 @@ class AsyncRecurringTimer:
         self._call_period = call_period
         self._callback = callback
         self._recurring = recurring
+        self._scheduler = Scheduler()
+        self._task = None
 
         return
 
     async def _cycle(self, *args, **kwargs):
-        # Calculate the time at the begining of the cycle
-        self._cycle_start_time = time.time()
-
-        # Execute the callback
-        await self._callback(*args, **kwargs)
-
-        # Calculate how long to sleep after the callback is executed
-        timeout = self._timeout()
-        await asyncio.sleep(timeout)
-
-        # Schedle the callback to run again
-        if self._recurring:
-            self._task = asyncio.ensure_future(self._cycle(*args, **kwargs))
+        if not self._recurring:
+            await self._callback(*args, **kwargs)
+            return
+
+        # The first call is now. A call that takes longer than the period
+        # delays the next call until it finishes
+        self._task = asyncio.current_task()
+        self._scheduler.every(self._call_period, self._callback, *args,
+                              align=False, overlap=OVERLAP_QUEUE, **kwargs)
+        try:
+            await self._scheduler.run()
+        finally:
+            self._scheduler.close()
 
         return
 
-    def _timeout(self):
-        self._next_call = self._cycle_start_time + self._call_period
-        return max(self._next_call - time.time(), 0)
-
     def cancel(self):
-        self._task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+        self._scheduler.close()
         return
 
     def start(self, *args, **kwargs):
@@ -270,7 +438,7 @@ class AsyncRecurringTimer:
         return self._cycle(*args, **kwargs)
 
     def is_task_running(self):
-        return not self._task.done()
+        return self._task is not None and not self._task.done()
 
 
 
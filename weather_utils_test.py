@@ -12,6 +12,9 @@ from argparse import ArgumentParser
 import json
 from datetime import datetime
 import logging
+import unittest
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 # Third party imports
 import requests
@@ -22,7 +25,10 @@ from CWOPpdu import CWOPPDU, Latitude, Longitude
 from CWOPClient import cwop_client
 from weather_utils import (check_network_interface, read_bacnet_server_ini,
                            test_bacnet_server, AsyncRecurringTimer,
-                           BufferedSMTPHandler)
+                           BufferedSMTPHandler, read_stations_ini,
+                           station_pdu_kwargs, DEFAULT_STATION_FIELDS,
+                           make_http_session, HTTP_CONNECT_RETRIES,
+                           AsyncHTTPSession)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -50,6 +56,246 @@ async def main():
     return
 
 
+STATIONS_INI = """
+[station:north]
+address: 101:3
+read_objects: analogInput:1,analogInput:4,analogInput:8,analogInput:12
+read_properties: presentValue,presentValue,presentValue,presentValue
+provider_id: FW8400
+latitude: 29.752
+longitude: -95.375
+
+[station:south]
+address: 101:4
+read_objects: analogInput:2,analogInput:3
+read_properties: presentValue,presentValue
+fields: humidity,temperature
+provider_id: EW9876
+latitude: 29.7
+longitude: -95.4
+call_period: 60
+"""
+
+
+class ReadStationsIniTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigParser()
+        self.config.read_string(STATIONS_INI)
+        return
+
+    def test_stations(self):
+        """Each [station:<name>] section is a station. Fields default to
+        DEFAULT_STATION_FIELDS"""
+        north, south = read_stations_ini(self.config)
+
+        self.assertEqual(north['name'], 'north')
+        self.assertEqual(north['provider_id'], 'FW8400')
+        self.assertEqual(north['fields'], DEFAULT_STATION_FIELDS.split(','))
+        self.assertEqual(north['call_period'], 300)
+        self.assertEqual(north['body']['address'], '101:3')
+        self.assertEqual(len(north['body']['bacnet_objects']), 4)
+
+        self.assertEqual(south['name'], 'south')
+        self.assertEqual(south['provider_id'], 'EW9876')
+        self.assertEqual(south['fields'], ['humidity', 'temperature'])
+        self.assertEqual(south['call_period'], 60)
+        self.assertEqual(south['latitude'], 29.7)
+        self.assertEqual(south['body']['bacnet_objects'][1],
+                         {'object':'analogInput:3', 'property':'presentValue'})
+        return
+
+    def test_fields_count(self):
+        self.config['station:south']['fields'] = 'humidity'
+        with self.assertRaises(ValueError):
+            read_stations_ini(self.config)
+        return
+
+    def test_station_pdu(self):
+        """Each station reports the objects it read, with its own provider
+        ID. Objects without a field are not reported"""
+        self.config['station:north']['fields'] = 'temperature,humidity,,'
+        north, south = read_stations_ini(self.config)
+        results = {"('analogInput', 1)": {'presentValue': 72},
+                   "('analogInput', 2)": {'presentValue': 40},
+                   "('analogInput', 3)": {'presentValue': 65},
+                   "('analogInput', 4)": {'presentValue': 55},
+                   "('analogInput', 8)": {'presentValue': 1},
+                   "('analogInput', 12)": {'presentValue': 2}}
+
+        self.assertEqual(station_pdu_kwargs(north, results),
+                         {'temperature':72, 'humidity':55})
+        self.assertEqual(station_pdu_kwargs(south, results),
+                         {'humidity':40, 'temperature':65})
+
+        for station in (north, south):
+            pdu = CWOPPDU(provider_id=station['provider_id'], time='110649',
+                          latitude=Latitude(station['latitude']),
+                          longitude=Longitude(station['longitude']),
+                          **station_pdu_kwargs(station, results))
+            source = pdu.pdu_data_packet.split(b'>', 1)[0].decode('ascii')
+            self.assertEqual(source, station['provider_id'])
+        return
+
+    def test_single_station(self):
+        """Without station sections [bacnet_server] and [cwop_client] are
+        the one station"""
+        config = ConfigParser()
+        config.read_string("""
+[bacnet_server]
+address: 101:2
+read_objects: analogInput:1,analogInput:4,analogInput:8,analogInput:12
+read_properties: presentValue,presentValue,presentValue,presentValue
+
+[cwop_client]
+provider_id: FW8400
+latitude: 29.752
+longitude: -95.375
+""")
+        station, = read_stations_ini(config)
+        self.assertEqual(station['name'], 'FW8400')
+        self.assertEqual(station['fields'], DEFAULT_STATION_FIELDS.split(','))
+        return
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Answer every request with an empty 200 response on an HTTP/1.1
+    connection. The client port of each request is kept by the server"""
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        self.server.client_ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+
+    do_GET = do_HEAD = _respond
+
+    def log_message(self, format, *args):
+        return
+
+
+class MakeHTTPSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.client_ports = []
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        return
+
+    def test_adapter(self):
+        """The pool size and retries of the session adapter"""
+        session = make_http_session(pool_maxsize=3)
+        adapter = session.get_adapter('http://127.0.0.1')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.connect, HTTP_CONNECT_RETRIES)
+        self.assertEqual(adapter.max_retries.total, HTTP_CONNECT_RETRIES)
+        # A request that reached the server is not sent again
+        self.assertEqual(adapter.max_retries.read, 0)
+        self.assertEqual(adapter.max_retries.status, 0)
+        session.close()
+        return
+
+    def test_reuse(self):
+        """Requests of one session use one connection"""
+        session = make_http_session()
+        url = 'http://127.0.0.1:{}'.format(self.port)
+        for _ in range(3):
+            self.assertEqual(session.get(url, timeout=5).status_code, 200)
+        self.assertTrue(test_bacnet_server('127.0.0.1', self.port,
+                                           session=session))
+        session.close()
+
+        self.assertEqual(len(self.server.client_ports), 4)
+        self.assertEqual(len(set(self.server.client_ports)), 1)
+        return
+
+
+class BarrierSession:
+    """Stands in for requests.Session. Each request waits until parties
+    requests are in progress at once, and raises
+    threading.BrokenBarrierError if they are not"""
+
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=5)
+        self.requests = []
+        self.closed = False
+        return
+
+    def request(self, method, url, **kwargs):
+        self.barrier.wait()
+        self.requests.append((method, url))
+        return method
+
+    def close(self):
+        self.closed = True
+        return
+
+
+class AsyncHTTPSessionTest(unittest.TestCase):
+
+    def _run(self, test):
+        # A loop of its own. asyncio.run would unset the event loop of the
+        # main thread for the tests that use asyncio.get_event_loop
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(test())
+        finally:
+            loop.close()
+        return
+
+    def test_concurrent(self):
+        """Two awaited requests are in progress at the same time, and the
+        event loop runs while they wait"""
+        async def test():
+            http_session = AsyncHTTPSession(max_workers=2)
+            http_session.session = BarrierSession(parties=2)
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.001)
+            ticker = asyncio.create_task(tick())
+            try:
+                results = await asyncio.gather(
+                    http_session.get('http://127.0.0.1/a'),
+                    http_session.post('http://127.0.0.1/b'))
+            finally:
+                ticker.cancel()
+                http_session.close()
+            self.assertEqual(results, ['GET', 'POST'])
+            self.assertEqual(len(http_session.session.requests), 2)
+            self.assertGreater(ticks, 0)
+        self._run(test)
+        return
+
+    def test_close(self):
+        """close shuts down the executor and closes the session"""
+        async def test():
+            http_session = AsyncHTTPSession(max_workers=1)
+            stub = BarrierSession(parties=1)
+            http_session.session = stub
+            self.assertEqual(await http_session.head('http://127.0.0.1'),
+                             'HEAD')
+            http_session.close()
+            self.assertTrue(stub.closed)
+            with self.assertRaises(RuntimeError):
+                await http_session.head('http://127.0.0.1')
+            self.assertEqual(len(stub.requests), 1)
+        self._run(test)
+        return
+
+
 if __name__ == '__main__':
     call_period = 10 # Seconds
 